@@ -18,6 +18,20 @@
 #   -s  Run in simulator mode (disables networking).                           #
 #   -v  Run in verbose mode.                                                   #
 #   -l  Enable logging of results to a file.                                   #
+#   -p  Keep one persistent connection per agent for the whole run.            #
+#   --engine=[threads|async]  Select the coordinator engine.                   #
+#   --scheduled-start[=SECONDS]  Start all agents at a common scheduled time.  #
+#   --udp-start=GROUP[:PORT]  Start all agents with one UDP datagram.          #
+#   --stream=DIR  Stream job output to per-host files under DIR.               #
+#   --stream-console  Echo streamed job output to the console.                 #
+#   --output-cap=BYTES  Keep at most BYTES of each job output stream.          #
+#   --armed  Spawn every job during preparation and only release it on start.  #
+#   --telemetry[=SECONDS]  Sample agent host counters during each test.        #
+#   --progress  Show a live progress line instead of results as they arrive.   #
+#   --db=PATH  Record runs, results, timings and telemetry in an SQLite file.  #
+#   --parallel[=N]  Run up to N (default: any number of) tests at once.        #
+#   --no-config-cache  Always parse the configuration file, bypassing the      #
+#                      cache of compiled configurations.                       #
 # PATH                                                                         #
 #   Relative or absolute path to configuration file (required).                #
 #                                                                              #
@@ -26,42 +40,135 @@
 
 import sys
 import os
+import copy
 import re
 import socket
 import select
 import threading
+import queue
 import time
 import datetime
 import csv
-from collections import deque
+import asyncio
+import json
+import hashlib
+import hmac
+import ipaddress
+import struct
+import shlex
+import sqlite3
+import zlib
+import itertools
+import marshal
 from enum import Enum
 
 # ############################################################################ #
 # Constants and global variables.                                              #
 # ############################################################################ #
-ARGC_MAX = 3
-ARGS_REGEX = '\-[hsvl]+'
-FILE_DELIMITER = ': *'
-TEST_LABEL_REGEX = '^[^:]+ *: *$'
-TEST_SPEC_REGEX = '^(\w|\.)+ *: *(\d+ *[hms] *: *)?.*\s*$'
-TEST_TIMEOUT_REGEX = '^\-timeout *: *((\d+ *[hms])|(none))\s*$'
-TEST_GENERAL_TIMEOUT_REGEX = '^\-generaltimeout *: *((\d+ *[hms])|(none))\s*$'
-TEST_MIN_HOSTS_REGEX = '^\-minhosts *: *(\d+|all)\s*$'
-TEST_END_REGEX = '^end\s*$'
-TIME_FORMAT_REGEX = '\d+ *[hms]'
+ARGS_REGEX = r'^\-[hsvlp]+$'
+LONG_ARGS_REGEX = r'^\-\-[a-z\-]+(=.*)?$'
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNC = 'async'
+ENGINES = (ENGINE_THREADS, ENGINE_ASYNC)
+# Numeric range in a host pattern, e.g. "vm[001-128].lab".
+HOST_RANGE_REGEX = r'\[(\d+)-(\d+)\]'
+# Target: "HOST", "HOST:PORT", "[IPV6]" or "[IPV6]:PORT", where host names
+# and ports may contain numeric ranges, or "@GROUP" for a host group.
+TARGET_PATTERN = (r'@\w[\w\-]*|(\[[0-9A-Fa-f:.]+(%\w+)?\]|(\w|\[\d+-\d+\])([\w.\-]|\[\d+-\d+\])*)'
+                  r'(:(\d+|\[\d+-\d+\]))?')
+# Most hosts a single pattern may expand to, to catch typos like [1-10000000].
+MAX_PATTERN_HOSTS = 65536
+# Kinds of configuration file line, tried in order. Each is matched against
+# a whole line, with leading and trailing whitespace removed.
+CONFIG_LINE_PATTERNS = (
+    ('generaltimeout', r'\-generaltimeout *: *(?P<generalTimeoutValue>.*)'),
+    ('minhosts', r'\-minhosts *: *(?P<minHostsValue>.*)'),
+    ('after', r'\-after *: *(?P<afterLabels>.*)'),
+    ('exclusive', r'\-exclusive'),
+    ('timeout', r'\-timeout *: *(?P<timeoutValue>.*)'),
+    ('exec', r'\-exec *: *(?P<execMode>.*)'),
+    ('placement', r'\-(?P<placementOption>cpus|numa|nice|ionice) *: *(?P<placementValue>.*)'),
+    ('end', r'end'),
+    # Host group definition: "@NAME = TARGET[, TARGET...]".
+    ('group', r'@(?P<groupName>\w[\w\-]*) *= *(?P<groupTargets>.*)'),
+    ('label', r'(?P<labelName>[^:\-@][^:]*?) *:'),
+    ('spec', r'(?P<target>' + TARGET_PATTERN + r') *: *(?P<command>.*)')
+)
+CONFIG_LINE_REGEX = '|'.join('(?P<%s>%s)' % pattern for pattern in CONFIG_LINE_PATTERNS)
+TIMEOUT_VALUE_REGEX = r'\d+ *[hms]|none'
+MIN_HOSTS_VALUE_REGEX = r'\d+|all'
+# Configuration errors listed before giving up.
+MAX_CONFIG_ERRORS = 100
+# Compiled configurations are cached here, one file per configuration file.
+CONFIG_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME')
+                                or os.path.join(os.path.expanduser('~'), '.cache'), 'netjobs')
+CONFIG_CACHE_SUFFIX = '.cache'
+# Cache files kept; the least recently used are removed beyond this.
+CONFIG_CACHE_MAX_ENTRIES = 64
+CPU_LIST_REGEX = r'^\d+(-\d+)?(,\d+(-\d+)?)*$'
+IONICE_REGEX = r'^(idle|best-effort|realtime)(:[0-7])?$'
 TIMEOUT_NONE = 0
 MIN_HOSTS_ALL = -1
+PARALLEL_UNLIMITED = 0
+# Seconds between refreshes of the progress line on a terminal, and between
+# plain progress lines otherwise.
+PROGRESS_INTERVAL = 0.5
+PROGRESS_PLAIN_INTERVAL = 10
+# Job rows buffered by the results database before they are written in one
+# transaction.
+STORE_BATCH_SIZE = 256
+STORE_SCHEMA_VERSION = 1
+# Default seconds between host telemetry samples.
+TELEMETRY_INTERVAL = 1.0
+# Columns of the aggregate "cpu" line of /proc/stat sampled by agents.
+CPU_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+# Resource usage fields reported with each result, in log column order.
+USAGE_FIELDS = ('wall', 'user', 'sys', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw')
+# Command launch modes: through a shell, or split into arguments and run directly.
+LAUNCH_SHELL = 'shell'
+LAUNCH_ARGV = 'argv'
 AGENT_LISTEN_PORT = 16192
 BUFFER_SIZE = 4096
 SOCKET_TIMEOUT = 60
+PREP_TIMEOUT = 60
+CLOCK_SAMPLES = 8
+SCHEDULE_MARGIN = 1.0
+UDP_START_PORT = 16193
+UDP_START_REPEAT = 3
+UDP_START_INTERVAL = 0.005
+UDP_CONFIRM_TIMEOUT = 1.0
+UDP_CONFIRM_POLL = 0.01
 SELECT_TIMEOUT = 1
 SOCKET_DELIMITER = '\t'
-READY_STRING = '// READY //'
+CHUNK_SIZE = 65536
 START_STRING = '// START //'
-KILL_STRING = '// KILL //'
-DONE_STRING = '// DONE //'
-PING_STATUS_STRING = '// STATUS //'
-PING_OK_STRING = 'OK'
+# Frame protocol. Every message is a FRAME_HEADER (magic, protocol version,
+# kind, payload length) followed by the payload.
+FRAME_MAGIC = b'NJ'
+PROTOCOL_VERSION = 3
+FRAME_HEADER = '!2sBBI'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+# Command index, stream, and seconds since the command was spawned.
+CHUNK_HEADER = '!IBd'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER)
+FRAME_SPEC = 1
+FRAME_ACK = 2
+FRAME_NACK = 3
+FRAME_SYNC = 4
+FRAME_START = 5
+FRAME_KILL = 6
+FRAME_PING = 7
+FRAME_PONG = 8
+FRAME_TIMING = 9
+FRAME_CHUNK = 10
+FRAME_RESULT = 11
+FRAME_DONE = 12
+FRAME_BYE = 13
+FRAME_STATUS = 14
+FRAME_TELEMETRY = 15
+STREAM_NONE = 0
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
 SUCCESS_STATUS = 'SUCCESS'
 ERROR_STATUS = 'ERROR'
 TIMEOUT_STATUS = 'TIMEOUT'
@@ -70,6 +177,29 @@ KILLED_STATUS = 'KILLED'
 verbose = False
 simulate = False
 logging = False
+session = False
+engine = ENGINE_THREADS
+# Seconds between sending a scheduled start and the start time, or None.
+scheduledStart = None
+# (group, port) on which to send the UDP start datagram, or None.
+udpStart = None
+# Directory to which job output is streamed, or None to collect it in memory.
+streamDir = None
+streamConsole = False
+# Bytes of each output stream kept per job, or None for no limit.
+outputCap = None
+# Whether agents spawn jobs during preparation and hold them until the start.
+armed = False
+# Seconds between agent host telemetry samples, or None to disable telemetry.
+telemetry = None
+# Show a progress line while waiting for results.
+progress = False
+# Path of the SQLite results database, or None.
+database = None
+# Whether compiled configurations are loaded from and saved to the cache.
+configCache = True
+# Most tests run at once, or PARALLEL_UNLIMITED.
+parallel = 1
 
 # ############################################################################ #
 # NetJobs class.                                                               #
@@ -90,6 +220,15 @@ class NetJobs:
         self.tests = []
         self.sockets = {}
         self.listeners = {}
+        # Persistent agent connections kept between tests in session mode.
+        self.pool = {}
+        # Progress of the running test, if --progress is enabled.
+        self.progress = None
+        # Results database, if --db is given.
+        self.store = None
+        # Result lines of the running test held back until it ends, when
+        # tests run in parallel.
+        self.heldLines = None
 
         # Process CLI arguments.
         self.eval_options(argv)
@@ -98,34 +237,37 @@ class NetJobs:
             print('Setup...')
             print('\t"%s" given as configuration file path.' % (self.path_in))
             
-        # Parse configuration file.
-        self.parse_config()
+        # Parse configuration file, or load it from the config cache.
+        self.load_config()
         
     #
     # Evaluate CLI arguments.
     #
     def eval_options(self, argv):
         "evaluate CLI arguments and act on them"
-        argc = len(argv)
         sample = re.compile(ARGS_REGEX)
+        longSample = re.compile(LONG_ARGS_REGEX)
+        paths = []
+
+        for arg in argv[1:]:
+            if longSample.match(arg):
+                self.act_on_long_option(arg)
+            elif sample.match(arg):
+                self.act_on_options(arg)
+            elif arg.startswith('-'):
+                terminate()
+            else:
+                paths.append(arg)
 
-        if argc > ARGC_MAX:
+        if len(paths) > 1:
+            terminate()
+        elif scheduledStart is not None and udpStart is not None:
+            print('ERROR: --scheduled-start and --udp-start cannot be combined.')
             terminate()
-        elif argc == 1:
+        elif paths:
+            self.path_in = paths[0]
+        else:
             self.path_in = ask_for_path()
-        elif argc == 2:
-            if not sample.match(argv[1]) == None:
-                self.act_on_options(argv[1])
-                self.path_in = ask_for_path()
-            else:
-                self.path_in = argv[1]
-        elif argc == ARGC_MAX:
-            if (sample.match(argv[1]) == None or
-                not sample.match(argv[2]) == None):
-                terminate()
-            else:
-                self.act_on_options(argv[1])
-                self.path_in = argv[2]
 
     #
     # Process optional CLI arguments. Called as part of eval_options.
@@ -145,236 +287,441 @@ class NetJobs:
         if 'l' in args:
             global logging
             logging = True
+        if 'p' in args:
+            global session
+            session = True
+
+    #
+    # Process a long-form "--name=value" CLI argument. Called as part of
+    # eval_options.
+    #
+    def act_on_long_option(self, arg):
+        "act on a long-form CLI argument"
+        option, _, value = arg[2:].partition('=')
+        if option == 'engine' and value in ENGINES:
+            global engine
+            engine = value
+        elif option == 'scheduled-start':
+            global scheduledStart
+            try:
+                scheduledStart = float(value) if value else SCHEDULE_MARGIN
+            except ValueError:
+                terminate()
+            if scheduledStart < 0:
+                terminate()
+        elif option == 'udp-start':
+            global udpStart
+            group, _, port = value.partition(':')
+            try:
+                ipaddress.IPv4Address(group)
+                udpStart = (group, int(port) if port else UDP_START_PORT)
+            except ValueError:
+                terminate()
+        elif option == 'stream' and value:
+            global streamDir
+            streamDir = value
+        elif option == 'stream-console' and not value:
+            global streamConsole
+            streamConsole = True
+        elif option == 'output-cap':
+            global outputCap
+            try:
+                outputCap = int(value)
+            except ValueError:
+                terminate()
+            if outputCap < 0:
+                terminate()
+        elif option == 'armed' and not value:
+            global armed
+            armed = True
+        elif option == 'telemetry':
+            global telemetry
+            try:
+                telemetry = float(value) if value else TELEMETRY_INTERVAL
+            except ValueError:
+                terminate()
+            if telemetry <= 0:
+                terminate()
+        elif option == 'progress' and not value:
+            global progress
+            progress = True
+        elif option == 'db' and value:
+            global database
+            database = value
+        elif option == 'parallel':
+            global parallel
+            try:
+                parallel = int(value) if value else PARALLEL_UNLIMITED
+            except ValueError:
+                terminate()
+            if value and parallel < 1:
+                terminate()
+        elif option == 'no-config-cache' and not value:
+            global configCache
+            configCache = False
+        else:
+            terminate()
 
     #
     # State machine for parsing the input file.
     #
+    # The file is read one line at a time, and each line is classified by a
+    # single match against CONFIG_LINE_REGEX. Errors are collected, with the
+    # file name and line number of each, and reported together once the
+    # whole file has been read.
+    #
     def parse_config(self):
         "configure the run according to the configuration file specifications"
 
-        testLabelRegex = re.compile(TEST_LABEL_REGEX)
-        testSpecRegex = re.compile(TEST_SPEC_REGEX)
-        testTimeoutRegex = re.compile(TEST_TIMEOUT_REGEX)
-        testGeneralTimeoutRegex = re.compile(TEST_GENERAL_TIMEOUT_REGEX)
-        testMinHostsRegex = re.compile(TEST_MIN_HOSTS_REGEX)
-        testEndRegex = re.compile(TEST_END_REGEX)
-
-        numTests = -1
+        lineRegex = re.compile(CONFIG_LINE_REGEX)
+        timeoutRegex = re.compile(TIMEOUT_VALUE_REGEX)
+        minHostsRegex = re.compile(MIN_HOSTS_VALUE_REGEX)
+        targetRegex = re.compile(TARGET_PATTERN)
+        errors = []
+        # Canonical form of each target string seen, as parsing it is the
+        # costliest part of a target line.
+        canonicalTargets = {}
+        # Hosts of each host group, and of each target or pattern seen, as
+        # tuples of canonical targets shared by every line that uses them.
+        groups = {}
+        targetSets = {}
+        # Labels of the tests read so far, which -after may refer to.
+        labels = set()
+
+        # Enum for state machine. After a line that should have been a test
+        # label, the rest of that block is skipped rather than reported line
+        # by line.
+        State = Enum('State', 'outsideTest inTestNoTarget inTestAndTarget skippingTest')
+        # Current state.
+        state = State.outsideTest
+        lineNumber = 0
+
+        def error(message):
+            errors.append('%s:%d: %s' % (self.path_in, lineNumber, message))
+
+        # Timeout in seconds, or None after reporting an invalid value. The
+        # same few timeout values tend to repeat on every target line.
+        timeoutValues = {}
+        def timeout_of(value):
+            timeout = timeoutValues.get(value)
+            if timeout is not None:
+                return timeout
+            if timeoutRegex.fullmatch(value):
+                timeout = timeoutValues[value] = evaluate_timeout_status(value)
+                return timeout
+            error('timeout values must be "none" or an integer >= 0 followed by "s", "m", '
+                  'or "h", not "%s"' % value)
+            return None
+
+        # Canonical targets named by a target, pattern, or group reference.
+        def targets_of(rawTarget):
+            targets = targetSets.get(rawTarget)
+            if targets is not None:
+                return targets
+            if rawTarget.startswith('@'):
+                if rawTarget[1:] not in groups:
+                    error('undefined host group "%s"' % rawTarget)
+                    return ()
+                return groups[rawTarget[1:]]
+            try:
+                hosts = expand_hosts(rawTarget)
+            except ValueError as e:
+                error('invalid host pattern "%s": %s' % (rawTarget, e))
+                return ()
+            targets = []
+            for host in hosts:
+                target = canonicalTargets.get(host)
+                if target is None:
+                    # Targets are keyed by their canonical endpoint, so
+                    # "host" and "host:16192" are the same agent.
+                    try:
+                        target = format_target(*parse_target(host))
+                    except ValueError as e:
+                        error('invalid target "%s": %s' % (host, e))
+                        return ()
+                    canonicalTargets[host] = target
+                targets.append(target)
+            targets = targetSets[rawTarget] = tuple(targets)
+            return targets
 
-        # Enum for state machine.
-        State = Enum('State', 'outsideTest inTestNoTarget inTestAndTarget')
-        
         try:
             with open(self.path_in, 'r', newline='') as file:
-                # Filter out empty lines and commented lines -- those beginning with a hash ('#').
-                # Place remaining lines into a queue.
-                lines = deque(filter(lambda line: not line.startswith('#') and line.strip(),
-                              (line.strip() for line in file)))
-                # Current state.
-                state = State.outsideTest
-
-                # Read rest of file.
-                while lines:
-                    line = lines.popleft()
-                    tokens = re.split(FILE_DELIMITER, line, maxsplit=1)
+                for lineNumber, line in enumerate(file, 1):
+                    line = line.strip()
+                    # Skip empty lines and commented lines -- those beginning with a hash ('#').
+                    if not line or line.startswith('#'):
+                        continue
 
-                    # Outside test block.
-                    if state is State.outsideTest:
-                        if testLabelRegex.match(line) == None:
-                            sys.exit('ERROR: file %s: expected test label but found '\
-                                     '"%s"' % (self.path_in, line))
+                    match = lineRegex.fullmatch(line)
+                    kind = match.lastgroup if match else None
+
+                    if state is State.skippingTest and kind not in ('label', 'group'):
+                        if kind == 'end':
+                            state = State.outsideTest
+                        continue
+
+                    # A label inside a test block starts a new test, so the
+                    # rest of the file is still checked.
+                    if kind == 'label' and state in (State.inTestNoTarget, State.inTestAndTarget):
+                        error('test label "%s" inside test %s (missing "end"?)'
+                              % (match.group('labelName'), testLabel))
+                        state = State.outsideTest
+
+                    # Host group definitions stand between test blocks.
+                    if kind == 'group':
+                        name = match.group('groupName')
+                        if state in (State.inTestNoTarget, State.inTestAndTarget):
+                            error('host group @%s must be defined outside test blocks' % name)
+                        elif name in groups:
+                            error('host group @%s is already defined' % name)
                         else:
-                            target = None
-                            generalTimeout = TIMEOUT_NONE
+                            members = []
+                            for rawTarget in re.split(r'[,\s]+', match.group('groupTargets')):
+                                if not rawTarget:
+                                    continue
+                                if not targetRegex.fullmatch(rawTarget):
+                                    error('invalid target "%s" in host group @%s'
+                                          % (rawTarget, name))
+                                else:
+                                    members.extend(targets_of(rawTarget))
+                            # Keep the first occurrence of each host.
+                            groups[name] = tuple(dict.fromkeys(members))
+                            state = State.outsideTest
+                        continue
+
+                    # Outside test block.
+                    if state in (State.outsideTest, State.skippingTest):
+                        if kind != 'label':
+                            error('expected test label but found "%s"' % line)
+                            state = State.skippingTest
+                            continue
+                        entry = None
+                        generalTimeout = TIMEOUT_NONE
+                        minHosts = MIN_HOSTS_ALL
+                        after = []
+                        exclusive = False
+                        testLabel = match.group('labelName')
+                        # One [targets, command, timeout, launch mode,
+                        # placement] entry per target line, expanded into
+                        # per-target specifications at the end of the block.
+                        entries = []
+                        state = State.inTestNoTarget
+
+                    # Is it a general timeout, minhosts, after or exclusive
+                    # line? These must come before the first target.
+                    elif kind in ('generaltimeout', 'minhosts', 'after', 'exclusive'):
+                        if state is State.inTestAndTarget:
+                            error('-generaltimeout, -minhosts, -after and -exclusive flags '
+                                  'must precede all target specifications')
+                        elif kind == 'after':
+                            for label in re.split(r' *, *', match.group('afterLabels')):
+                                if label not in labels:
+                                    error('-after must name a test defined before test %s, '
+                                          'not "%s"' % (testLabel, label))
+                                elif label not in after:
+                                    after.append(label)
+                        elif kind == 'exclusive':
+                            exclusive = True
+                        elif kind == 'generaltimeout':
+                            timeout = timeout_of(match.group('generalTimeoutValue'))
+                            if timeout is not None:
+                                generalTimeout = timeout
+                        elif not minHostsRegex.fullmatch(match.group('minHostsValue')):
+                            error('minhosts specification must be "all" or an integer >= 0, '
+                                  'not "%s"' % match.group('minHostsValue'))
+                        elif match.group('minHostsValue') == 'all':
                             minHosts = MIN_HOSTS_ALL
-                            testLabel = tokens[0]
-                            specs = {}
-                            timeouts = {}
-
-                            state = State.inTestNoTarget
-
-                    # In test block - no targets specified yet.
-                    elif state is State.inTestNoTarget:
-                        # Is it a general timeout line?
-                        if testGeneralTimeoutRegex.match(line):
-                            try:
-                                generalTimeout = evaluate_timeout_status(
-                                    tokens[1])
-                                if generalTimeout < 0:
-                                    raise ValueError
-                            except ValueError:
-                                sys.exit('ERROR: file %s: timeout values must be '\
-                                         '"none" or integer >= 0'
-                                         % self.path_in)
-                                
-                        # Is it a minhosts line?
-                        elif testMinHostsRegex.match(line):
-                            if tokens[1] == 'all':
-                                minHosts = MIN_HOSTS_ALL
-                            else:
+                        else:
+                            minHosts = int(match.group('minHostsValue'))
+
+                    # Is it a target/spec line?
+                    elif kind == 'spec':
+                        state = State.inTestAndTarget
+                        command = match.group('command')
+                        # Remove start and end quotes (only if both because some commands might already contain quotes).
+                        if len(command) > 1 and command.startswith('"') and command.endswith('"'):
+                            command = command[1:-1]
+                        entry = [targets_of(match.group('target')), command, generalTimeout,
+                                 LAUNCH_SHELL, None]
+                        entries.append(entry)
+
+                    # Timeout, exec and placement lines apply retroactively to
+                    # the current target and command, so they need one.
+                    elif kind in ('timeout', 'exec', 'placement') and state is State.inTestNoTarget:
+                        error('-%s specified but no current target'
+                              % (match.group('placementOption') if kind == 'placement' else kind))
+
+                    elif kind == 'timeout':
+                        timeout = timeout_of(match.group('timeoutValue'))
+                        if timeout is not None:
+                            entry[2] = timeout
+
+                    # In argv mode the command is split into arguments and run
+                    # without a shell.
+                    elif kind == 'exec':
+                        mode = match.group('execMode')
+                        if mode not in (LAUNCH_ARGV, LAUNCH_SHELL):
+                            error('-exec must be "argv" or "shell", not "%s"' % mode)
+                        else:
+                            if mode == LAUNCH_ARGV:
                                 try:
-                                    minHosts = int(tokens[1])
-                                except ValueError:
-                                    sys.exit('ERROR: file %s: minhosts specification '\
-                                         'must be "all" or integer > 0 '
-                                         % self.path_in)
-
-                        # Is it an end marker?
-                        elif testEndRegex.match(line):
-                            sys.exit('ERROR: file %s: test %s contains no targets.'
-                                     % (self.path_in, testLabel))
-
-                        # Is it a timeout line?
-                        elif testTimeoutRegex.match(line):
-                            sys.exit('ERROR: file %s: timeout specified '\
-                                                 'but no current target'
-                                                 % self.path_in)
-
-                        # Is it a target/spec line?
-                        elif testSpecRegex.match(line):
-                            state = State.inTestAndTarget
-                            # This triggers a fall-through to the inTestAndTarget block.
-
-                        # Else unknown.
+                                    if not shlex.split(entry[1]):
+                                        raise ValueError('empty command')
+                                except ValueError as e:
+                                    error('unable to split command "%s" into arguments: %s'
+                                          % (entry[1], e))
+                            entry[3] = mode
+
+                    elif kind == 'placement':
+                        option = match.group('placementOption')
+                        try:
+                            value = evaluate_placement(option, match.group('placementValue'))
+                        except ValueError as e:
+                            error(str(e))
                         else:
-                            sys.exit('ERROR: file %s: unable to interpret line "%s"'
-                                     % (self.path_in, line))
-                    
-                    #
-                    # inTestAndTarget
-                    #
-                    # Note: deliberately NOT an elif case. If the parser detects a
-                    # target/spec line, this block will execute on the same loop iteration.
-                    #
-
-                    # In test block and at least one target specified.
-                    if state is State.inTestAndTarget:
-                        # Is it a target/spec line?
-                        if testSpecRegex.match(line):
-                            target = tokens[0]
-                            command = tokens[1]
-                            # Remove start and end quotes (only if both because some commands might already contain quotes).
-                            if len(command) > 1 and command.startswith('"') and command.endswith('"'):
-                                command = command[1:-1]
-                            if not target in specs:
-                                specs[target] = []
-                            specs[target].append(command)
-                            if not target in timeouts:
-                                timeouts[target] = {}
-                            timeouts[target][command] = generalTimeout
-
-                        # Is it a timeout line? Since at least one test target/spec line must
-                        # have been encountered to transition to this state, we just retroactively
-                        # apply this timeout to the currently open target and command
-                        elif testTimeoutRegex.match(line):
-                            try:
-                                timeout = evaluate_timeout_status(tokens[1])
-                                if timeout < 0:
-                                    raise ValueError
-                                else:
-                                    if not target in timeouts:
-                                        timeouts[target] = {}
-                                    else:
-                                        timeouts[target][command] = timeout
-                            except ValueError:
-                                sys.exit('ERROR: file %s: timeout values must be '\
-                                         '"none" or integer >= 0'
-                                         % self.path_in)
-
-                        # Is it an end marker?
-                        elif testEndRegex.match(line):
-                            state = State.outsideTest
+                            if entry[4] is None:
+                                entry[4] = {}
+                            entry[4][option] = value
+
+                    # Is it an end marker?
+                    elif kind == 'end':
+                        if state is State.inTestNoTarget:
+                            error('test %s contains no targets' % testLabel)
+                        elif not errors:
+                            specs, timeouts, launchModes, placements = expand_entries(entries)
                             # Add the test configuration to the list.
                             self.tests.append(TestConfig(testLabel,
                                                          generalTimeout,
                                                          minHosts,
                                                          specs,
-                                                         timeouts))
+                                                         timeouts,
+                                                         launchModes,
+                                                         placements,
+                                                         tuple(after),
+                                                         exclusive))
+                        labels.add(testLabel)
+                        state = State.outsideTest
 
-                        # Is it a general timeout or minhosts line?
-                        elif testGeneralTimeoutRegex.match(line) or testMinHostsRegex.match(line):
-                            sys.exit('ERROR: file %s: -generalTimeout and -minhosts flags must precede '\
-                                     'all target specifications.' % self.path_in)
+                    # Else unknown.
+                    else:
+                        error('unable to interpret line "%s"' % line)
 
-                        # Else unknown.
-                        else:
-                            sys.exit('ERROR: file %s: unable to interpret line "%s"'
-                                     % (self.path_in, line))
+                if state in (State.inTestNoTarget, State.inTestAndTarget):
+                    errors.append('%s: test %s is missing its "end" line' % (self.path_in, testLabel))
 
         # Catch IOError exception and exit.
         except IOError as e:
             sys.exit('file %s: %s' % (self.path_in, e))
 
+        if errors:
+            for message in errors[:MAX_CONFIG_ERRORS]:
+                print('ERROR: %s' % message, file=sys.stderr)
+            if len(errors) > MAX_CONFIG_ERRORS:
+                print('ERROR: ...and %d more error(s).' % (len(errors) - MAX_CONFIG_ERRORS),
+                      file=sys.stderr)
+            sys.exit('%d error(s) in configuration file %s.' % (len(errors), self.path_in))
+
+    #
+    # Load the test configurations from the config cache, if it holds the
+    # compiled form of the current configuration file, or else parse the file
+    # and cache the result. The cache key covers the content of both the file
+    # and this script, so editing either invalidates the cached copy.
+    #
+    def load_config(self):
+        "load the test configurations, from the config cache if possible"
+
+        if not configCache:
+            self.parse_config()
+            return
+
+        cachePath = config_cache_path(self.path_in)
+        key = config_cache_key(self.path_in)
+        if key is not None:
+            tests = read_config_cache(cachePath, key)
+            if tests is not None:
+                self.tests = [TestConfig(*test) for test in tests]
+                touch_config_cache(cachePath)
+                if verbose:
+                    print('\tLoaded %d test(s) from config cache "%s".'
+                          % (len(self.tests), cachePath))
+                return
+
+        self.parse_config()
+        # Don't cache the result if the file changed while it was being parsed.
+        if key is not None and key == config_cache_key(self.path_in):
+            write_config_cache(cachePath, key,
+                               [(test.label, test.generalTimeout, test.minHosts, test.specs,
+                                 test.timeouts, test.launchModes, test.placements, test.after,
+                                 test.exclusive)
+                                for test in self.tests])
+
     #
     # Prepare remote agents.
     #
+    # All targets are prepared concurrently by PrepThreads, bounded by a single
+    # overall deadline of PREP_TIMEOUT seconds, so one dead host can no longer
+    # stall every target behind it.
+    #
     def prep_agents(self, test):
         if verbose:
             print('\t\tPreparing agents...')
 
-        targets = list(test.specs.keys())
-        for target in targets:
-            # Create TCP socket. Skip if in simulation mode.
-            if not simulate:
-                if verbose:
-                    print('\t\t\tTrying "%s"...' % target, end='')
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                except socket.error as e:
-                    sys.exit('ERROR: failed to create socket for target "%s": %s.'
-                             % (target, e))
-                # Bind socket.
-                try:
-                    port = AGENT_LISTEN_PORT
-                    sock = socket.create_connection((target, port), timeout=SOCKET_TIMEOUT)
-                    # Perform a simple echo test to make sure it works.
-                    testBytes = bytes('name' + SOCKET_DELIMITER + target + '\n', 'UTF-8')
-                    sock.sendall(testBytes)
-                    response = sock.recv(BUFFER_SIZE)
-                    if response != testBytes:
-                        sys.exit('ERROR: agent %s failed echo test. Unsure of agent '\
-                                 'identity. Terminating.' % target)
-
-                    # Send commands and timeouts.
-                    commands = test.specs[target]
-                    timeouts = test.timeouts[target]
-                    for command in commands:
-                        timeout = timeouts[command]
-                        # Command.
-                        testBytes = bytes('command' + SOCKET_DELIMITER + command + '\n', 'UTF-8')
-                        sock.sendall(testBytes)
-                        response = sock.recv(BUFFER_SIZE)
-                        if response != testBytes:
-                            sys.exit('ERROR: agent %s failed to acknowledge command %s. Terminating.' % (target, test.specs[target]))
-
-                        # Timeout.
-                        testBytes = bytes('timeout' + SOCKET_DELIMITER + str(timeout) + '\n', 'UTF-8')
-                        sock.sendall(testBytes)
-                        response = sock.recv(BUFFER_SIZE)
-                        if response != testBytes:
-                            sys.exit('ERROR: agent %s failed to acknowledge timeout. Terminating.' % target)
-
-                    # End of commands/timeouts.
-                    testBytes = bytes(READY_STRING + '\n', 'UTF-8')
-                    sock.sendall(testBytes)
-                    response = sock.recv(BUFFER_SIZE)
-                    if response != testBytes:
-                        sys.exit('ERROR: agent %s failed to acknowledge ready. Terminating.' % target)
-
-                    # Good to go.
-                    self.sockets[target] = sock
-                    if verbose:
-                        print('\tSuccess!')
-                except socket.timeout as e:
-                    self.handle_timeout(target, test, self)
-                    print('ERROR: a socket timeout occurred: %s.' % e)
-                except socket.error as e:
-                    sys.exit('ERROR: failed to open connection to socket for target '\
-                             '"%s": %s.' % (target, e))
+        # Skip if in simulation mode.
+        if simulate:
+            if verbose:
+                print('\t\t...finished.\n')
+            return
+
+        deadline = time.time() + PREP_TIMEOUT
+        preppers = []
+        for target in list(test.specs.keys()):
+            prepper = PrepThread(target, test, deadline, self.pool.pop(target, None))
+            preppers.append(prepper)
+            prepper.start()
+
+        for prepper in preppers:
+            prepper.join(max(0, deadline - time.time()) + SELECT_TIMEOUT)
+
+        # Evaluate outcomes in config order so error reporting is deterministic.
+        for prepper in preppers:
+            target = prepper.target
+            if prepper.is_alive():
+                # Still stuck past the deadline. Abandon it as a timeout.
+                prepper.abandon()
+            test.prepTimes[target] = prepper.duration
+
+            if prepper.timedOut:
+                self.handle_timeout(target, test, self)
+                print('ERROR: a socket timeout occurred: %s.' % prepper.error)
+            elif prepper.error is not None:
+                sys.exit(prepper.error)
+            else:
+                # Good to go.
+                self.sockets[target] = prepper.sock
+
+        self.print_prep_times(test)
 
         if verbose:
             print('\t\t...finished.\n')
 
+    #
+    # Report how long each agent took to complete its handshake.
+    #
+    def print_prep_times(self, test):
+        times = [(t, d) for t, d in test.prepTimes.items() if d is not None]
+        if not times:
+            return
+        slowest = max(times, key=lambda item: item[1])
+        print('\t\tPrepared %d of %d agent(s). Slowest: %s (%.3fs).'
+              % (len(self.sockets), len(test.specs), slowest[0], slowest[1]))
+        if verbose:
+            for target, duration in sorted(times, key=lambda item: item[1], reverse=True):
+                status = 'ready' if target in self.sockets else 'FAILED'
+                if target in test.clockOffsets:
+                    offset, rtt = test.clockOffsets[target]
+                    status += ', clock offset %+.6fs, RTT %.6fs' % (offset, rtt)
+                print('\t\t\t%s: %.3fs (%s)' % (target, duration, status))
+
     #
     # Start remote agents.
     #
@@ -394,27 +741,97 @@ class NetJobs:
         # This is split into two loops to make sure all listener threads are started
         # before any individual test is allowed to begin. This prevents race conditions
         # with processes completing and rejoining while some listeners aren't started.
-        for target in list(self.sockets.keys()):
-            # Send the start command.
-            self.sockets[target].sendall(bytes(START_STRING + '\n', 'UTF-8'))
+        self.results_header(test)
+        if udpStart is not None:
+            send_udp_start(test)
+            self.confirm_udp_start(test)
+        else:
+            startAt = self.schedule_start(test)
+            for target in list(self.sockets.keys()):
+                # Send the start command.
+                self.sockets[target].sendall(pack_frame(FRAME_START,
+                                                        start_payload(test, target, startAt)))
 
         if verbose:
             print('\t\t...finished.\n')
 
     #
-    # Start remote agents.
+    # Print the header under which results are printed as they arrive. It
+    # comes before the start is sent, as results may arrive straight away.
+    #
+    def results_header(self, test):
+        if self.heldLines is None:
+            print()
+            print('\t\t-- %s // RESULTS:' % test.label)
+
+    #
+    # Wait for agents to confirm a UDP start, and fall back to a TCP start
+    # for any that missed every datagram.
+    #
+    def confirm_udp_start(self, test):
+        deadline = time.time() + UDP_CONFIRM_TIMEOUT
+        while time.time() < deadline and self.unconfirmed_listeners(test):
+            time.sleep(UDP_CONFIRM_POLL)
+        self.fall_back_to_tcp_start(test)
+
+    #
+    # Listeners whose agents have not yet reported starting.
+    #
+    def unconfirmed_listeners(self, test):
+        return [listener for listener in list(self.listeners.values())
+                if listener.running and not listener.target in test.startTimes]
+
+    def fall_back_to_tcp_start(self, test):
+        for listener in self.unconfirmed_listeners(test):
+            if verbose:
+                print('\t\t\t%s did not confirm UDP start. Sending TCP start.'
+                      % listener.target)
+            try:
+                listener.send(FRAME_START)
+            except Exception:
+                pass
+
+    #
+    # Pick the coordinator time at which scheduled agents should start.
+    #
+    # Return:
+    #     Start time on the coordinator clock, or None if not scheduled.
+    #
+    def schedule_start(self, test):
+        if scheduledStart is None:
+            return None
+
+        # Allow for the slowest agent's one-way delay on top of the margin.
+        slowest = max([rtt for offset, rtt in test.clockOffsets.values()] or [0])
+        startAt = time.time() + scheduledStart + slowest
+        if verbose:
+            print('\t\t\tScheduling start at %s.'
+                  % datetime.datetime.fromtimestamp(startAt).isoformat())
+        return startAt
+
+    #
+    # Wait for remote agent results.
     #
     def wait_for_results(self, test):
         if verbose:
             print('\t\tWaiting for agent results...')
 
-        print()
-        print('\t\t-- %s // RESULTS:' % test.label)
-
         # Listener threads print results here before joining.
 
-        for listener in self.listeners.values():
-            listener.join()
+        if self.progress is None:
+            for listener in self.listeners.values():
+                listener.join()
+        else:
+            for listener in self.listeners.values():
+                while listener.is_alive():
+                    listener.join(PROGRESS_INTERVAL)
+                    self.progress.render()
+            self.progress.finish(self.heldLines)
+
+        if self.heldLines is not None:
+            # One write, so that the block of a parallel test stays whole.
+            sys.stdout.write('\n'.join(['', '\t\t-- %s // RESULTS:' % test.label] + self.heldLines + ['']))
+            sys.stdout.flush()
 
         if verbose:
             print('\t\t...finished.\n')
@@ -426,12 +843,33 @@ class NetJobs:
         if verbose:
             print('\t\tCleaning up...')
             
-        for sock in list(self.sockets.values()):
-            sock.close()
+        for target, sock in list(self.sockets.items()):
+            # In session mode, connections that finished cleanly are kept for
+            # the next test. Anything else is in an unknown state, so drop it.
+            listener = self.listeners.get(target)
+            if session and listener is not None and listener.done:
+                self.pool[target] = sock
+            else:
+                sock.close()
 
         if verbose:
             print('\t\t...finished.\n')
 
+    #
+    # End the session with every pooled agent.
+    #
+    def close_pool(self):
+        if verbose and self.pool:
+            print('\tClosing %d persistent agent connection(s)...' % len(self.pool))
+
+        for sock in self.pool.values():
+            try:
+                sock.sendall(pack_frame(FRAME_BYE))
+                sock.close()
+            except Exception:
+                pass
+        self.pool = {}
+
     #
     # Timeout handler. Kills all listen threads.
     #
@@ -482,6 +920,124 @@ class NetJobs:
         except IOError as e:
             print('Error writing log file %s: %s.' % (path_out, str(e)))
 
+    #
+    # Write start skew to log file.
+    #
+    def logSkew(self, test):
+        if not test.startTimes:
+            return
+        base = skew_base(test)
+        timestamp = test.timestamp.replace(':', '.')
+        path_out = self.path_in + '_' + test.label + '_' + timestamp + '_skew.log'
+        try:
+            with open(path_out, 'wb') as f:
+                for target, (received, spawned) in test.startTimes.items():
+                    for command in test.specs[target]:
+                        spawnDelta = ''
+                        if command in spawned:
+                            spawnDelta = '%.6f' % (spawned[command] - base)
+                        f.write(bytes(target + SOCKET_DELIMITER + command + SOCKET_DELIMITER
+                                      + '%.6f' % (received - base) + SOCKET_DELIMITER
+                                      + spawnDelta + '\n', 'utf-8'))
+        except IOError as e:
+            print('Error writing log file %s: %s.' % (path_out, str(e)))
+
+    #
+    # Write the placement reported for each placed command to log file.
+    #
+    def logPlacement(self, test):
+        if not test.placementReports:
+            return
+        timestamp = test.timestamp.replace(':', '.')
+        path_out = self.path_in + '_' + test.label + '_' + timestamp + '_placement.log'
+        try:
+            with open(path_out, 'wb') as f:
+                for target, reports in test.placementReports.items():
+                    for command, report in reports.items():
+                        f.write(bytes(target + SOCKET_DELIMITER + command + SOCKET_DELIMITER
+                                      + format_placement(report) + '\n', 'utf-8'))
+        except IOError as e:
+            print('Error writing log file %s: %s.' % (path_out, str(e)))
+
+    #
+    # Write the resource usage of each command to log file, one column per
+    # field of USAGE_FIELDS.
+    #
+    def logUsage(self, test):
+        timestamp = test.timestamp.replace(':', '.')
+        path_out = self.path_in + '_' + test.label + '_' + timestamp + '_usage.log'
+        try:
+            with open(path_out, 'wb') as f:
+                f.write(bytes(SOCKET_DELIMITER.join(('target', 'command') + USAGE_FIELDS) + '\n',
+                              'utf-8'))
+                for target in test.results.keys():
+                    for command in test.results[target]:
+                        result = test.results[target][command]
+                        usage = result[2] if result is not None else None
+                        if usage is None:
+                            continue
+                        f.write(bytes(SOCKET_DELIMITER.join([target, command]
+                                      + [str(usage.get(field, '')) for field in USAGE_FIELDS])
+                                      + '\n', 'utf-8'))
+        except IOError as e:
+            print('Error writing log file %s: %s.' % (path_out, str(e)))
+
+    #
+    # Print start skew statistics for a test.
+    #
+    def report_skew(self, test):
+        if not test.startTimes:
+            return
+        base = skew_base(test)
+        received = [times[0] for times in test.startTimes.values()]
+        spawned = [spawnTime for times in test.startTimes.values()
+                   for spawnTime in times[1].values()]
+
+        print()
+        print('\t\t-- %s // START SKEW (%d host(s), %d job(s)):'
+              % (test.label, len(received), len(spawned)))
+        print('\t\t\tStart received: %s' % format_skew(received, base))
+        if spawned:
+            print('\t\t\tJobs spawned:   %s' % format_skew(spawned, base))
+        for target, (hostReceived, hostSpawned) in sorted(test.startTimes.items(),
+                                                           key=lambda item: item[1][0]):
+            line = '\t\t\t\t%s: received +%.6fs' % (target, hostReceived - base)
+            if hostSpawned:
+                line += ', spawned +%.6fs to +%.6fs' % (min(hostSpawned.values()) - base,
+                                                       max(hostSpawned.values()) - base)
+            print(line)
+        print()
+
+    #
+    # Print a summary of the host telemetry of each agent.
+    #
+    def report_telemetry(self, test):
+        if not test.telemetry:
+            return
+        print('\t\t-- %s // HOST TELEMETRY:' % test.label)
+        for target in sorted(test.telemetry):
+            print('\t\t\t%s: %s' % (target, summarize_telemetry(test.telemetry[target])))
+        print()
+
+    #
+    # Write every telemetry sample to log file, one counter per line.
+    #
+    def logTelemetry(self, test):
+        if not test.telemetry:
+            return
+        timestamp = test.timestamp.replace(':', '.')
+        path_out = self.path_in + '_' + test.label + '_' + timestamp + '_telemetry.log'
+        try:
+            with open(path_out, 'wb') as f:
+                for target, hostTelemetry in test.telemetry.items():
+                    for seconds, values in hostTelemetry['samples']:
+                        for field, value in zip(hostTelemetry['fields'], values):
+                            f.write(bytes(target + SOCKET_DELIMITER + '%.3f' % seconds
+                                          + SOCKET_DELIMITER + field + SOCKET_DELIMITER
+                                          + str(value) + '\n', 'utf-8'))
+        except IOError as e:
+            print('Error writing log file %s: %s.' % (path_out, str(e)))
+
     #
     # Ping agents with a status request.
     #
@@ -498,45 +1054,161 @@ class NetJobs:
         if verbose:
             print('\nStarting run...\n')
 
-        for test in self.tests:
-            # Reset instance variables.
-            self.sockets = {}
-            self.listeners = {}
-            self.testAborted = False
-                    
-            if verbose:
-                print('\t%s...' % test.label)
-            # Prepare remote agents.
-            self.prep_agents(test)
-
-            # Start remote agents.
-            self.start_agents(test)
+        if database is not None:
+            try:
+                self.store = ResultStore(database, self.path_in)
+            except sqlite3.Error as e:
+                print('ERROR: could not open results database %s: %s.' % (database, str(e)))
+                sys.exit(1)
 
-            # Wait for remote agent return status.
-            self.wait_for_results(test)
-            # Log output if enabled.
-            if logging:
-                self.logResults(test)
-            # Clean up.
-            self.clean_up(test)
+        try:
+            if engine == ENGINE_ASYNC:
+                AsyncEngine(self).run()
+            else:
+                self.run_threaded()
+        finally:
+            if self.store is not None:
+                self.store.close()
 
         if verbose:
             print('\nFinishing...\n')
 
+    #
+    # Scheduler of the tests of this run. With --parallel, tests are ordered
+    # by the durations recorded in the results database, if any.
+    #
+    def scheduler(self):
+        durations = None
+        if parallel != 1 and self.store is not None:
+            durations = self.store.durations()
+        return TestScheduler(self.tests, parallel, durations)
+
+    #
+    # Copy of this object for running one test. It shares the configuration,
+    # the connection pool and the results database, but has its own sockets,
+    # listeners and flags, so that tests can run at the same time.
+    #
+    def test_context(self, test):
+        context = copy.copy(self)
+        context.sockets = {}
+        context.listeners = {}
+        context.testAborted = False
+        context.progress = Progress(test) if progress else None
+        context.heldLines = [] if parallel != 1 else None
+        # Logs and the results database record when the test really started.
+        test.timestamp = datetime.datetime.now().isoformat()
+        return context
+
+    #
+    # Run every test with the thread-per-target engine. With --parallel, each
+    # test runs on its own thread.
+    #
+    def run_threaded(self):
+        scheduler = self.scheduler()
+        if parallel == 1:
+            while not scheduler.done():
+                for test in scheduler.ready():
+                    self.test_context(test).run_test(test)
+                    scheduler.finish(test)
+        else:
+            finished = queue.Queue()
+            failure = None
+            while not scheduler.done():
+                # After a failure, only wait for the running tests.
+                if failure is None:
+                    for test in scheduler.ready():
+                        threading.Thread(target=self.run_test_thread,
+                                         args=(test, finished)).start()
+                if not scheduler.running:
+                    break
+                test, error = finished.get()
+                scheduler.finish(test)
+                if failure is None:
+                    failure = error
+            if failure is not None:
+                raise failure
+
+        self.close_pool()
+
+    #
+    # Run a test on its own thread, and queue it along with the exception
+    # that ended it, if any.
+    #
+    def run_test_thread(self, test, finished):
+        error = None
+        try:
+            self.test_context(test).run_test(test)
+        except BaseException as e:
+            error = e
+        finished.put((test, error))
+
+    #
+    # Run a single test. Called on the context returned by test_context.
+    #
+    def run_test(self, test):
+        if self.store is not None:
+            self.store.begin_test(test)
+
+        if verbose:
+            print('\t%s...' % test.label)
+        # Prepare remote agents.
+        self.prep_agents(test)
+
+        # Start remote agents.
+        self.start_agents(test)
+
+        # Wait for remote agent return status.
+        self.wait_for_results(test)
+        # Report how simultaneous the starts were.
+        self.report_skew(test)
+        self.report_telemetry(test)
+        # Log output if enabled.
+        if logging:
+            self.logResults(test)
+            self.logSkew(test)
+            self.logPlacement(test)
+            self.logUsage(test)
+            self.logTelemetry(test)
+        if self.store is not None:
+            self.store.end_test(test, self.testAborted)
+        # Clean up.
+        self.clean_up(test)
+
 # ############################################################################ #
 # TestConfig class for storing test configurations.                            #
 # ############################################################################ #
 class TestConfig:
     "data structure class for storing test configurations"
 
-    def __init__(self, label, generalTimeout, minHosts, specs, timeouts):
+    def __init__(self, label, generalTimeout, minHosts, specs, timeouts, launchModes=None,
+                 placements=None, after=(), exclusive=False):
         "basic initializer"
         self.label = label
         self.generalTimeout = generalTimeout
         self.minHosts = minHosts
         self.specs = specs
         self.timeouts = timeouts
+        # Labels of earlier tests that must finish before this one starts.
+        self.after = after
+        # Whether no other test may run alongside this one.
+        self.exclusive = exclusive
+        # How each command is launched: target -> {command: LAUNCH_SHELL|LAUNCH_ARGV}.
+        self.launchModes = launchModes if launchModes is not None else {}
+        # Requested placement of commands: target -> {command: {option: value}}.
+        self.placements = placements if placements is not None else {}
+        # Placement reported by agents: target -> {command: report}.
+        self.placementReports = {}
+        # Host telemetry sampled by agents, decoded by decode_telemetry.
+        self.telemetry = {}
+        # Row ID of this test in the results database, if any.
+        self.storeId = None
         self.results = {}
+        self.prepTimes = {}
+        # Estimated (offset, RTT) of each agent's clock relative to ours.
+        self.clockOffsets = {}
+        # When each agent received its start command and spawned each command,
+        # on our clock: target -> (received, {command: spawned}).
+        self.startTimes = {}
         if minHosts == 0:
             self.timeoutsRemaining = None
         else:
@@ -544,160 +1216,1407 @@ class TestConfig:
         
         # Setting up dictionaries.
         self.listenerTimeouts = {}
+        # Targets expanded from one range or group share their timeouts
+        # dictionary, so its longest timeout is only worked out once.
+        longest = {}
         for target in specs.keys():
             # Results dictionary.
-            self.results[target] = {}
+            self.results[target] = dict.fromkeys(specs[target])
             # Timeouts for the ListenThreads.
-            timeout = generalTimeout
-            for command in specs[target]:
-                # Initialize results contents.
-                self.results[target][command] = None
-                # Calculate longest timeout - use for thread.
-                if timeouts[target][command] == TIMEOUT_NONE:
-                    timeout = TIMEOUT_NONE
-                    break
-                else:
-                    t = int(timeouts[target][command])
-                    if t > timeout:
-                        timeout = t
+            timeout = longest.get(id(timeouts[target]))
+            if timeout is None:
+                timeout = generalTimeout
+                for command in specs[target]:
+                    # Calculate longest timeout - use for thread.
+                    if timeouts[target][command] == TIMEOUT_NONE:
+                        timeout = TIMEOUT_NONE
+                        break
+                    else:
+                        t = int(timeouts[target][command])
+                        if t > timeout:
+                            timeout = t
+                longest[id(timeouts[target])] = timeout
             self.listenerTimeouts[target] = timeout
 
             self.successesReceived = 0
 
+        # Identifies and authenticates this test's UDP start datagram.
+        self.startId = os.urandom(8).hex()
+        self.startKey = os.urandom(16).hex()
+
         # Used for log file.
         self.timestamp = datetime.datetime.now().isoformat()
 
 # ############################################################################ #
-# ListenThread class for listening for test results.                           #
+# TestScheduler class for deciding which tests run when.                       #
 # ############################################################################ #
-class ListenThread(threading.Thread):
-    "listens for test results for a given agent"
-
-    def __init__(self, target, sock, timeout, netJobs, test):
-        threading.Thread.__init__(self)
-        self.target = target
-        self.sock = sock
-        self.timeout = timeout
-        self.netJobs = netJobs
-        self.test = test
-        self.running = False
-        self.pingActive = False
-        self.pingStart = None
-
-    def run(self):
-        self.running = True
-        startTime = time.time()
-        try:
-            while self.running:
-                currentTime = time.time()
-                elapsedTime = currentTime - startTime
-                # Check for timeout.
-                if not self.timeout == TIMEOUT_NONE and elapsedTime >= self.timeout:
-                    self.handle_timeout()
-                # Check for ping timeout.
-                elif self.pingActive and currentTime - self.pingStart >= SOCKET_TIMEOUT:
-                    self.handle_timeout()
-                else:
-                    # Wait for result to be transmitted from agent.
-                    ready = select.select([self.sock], [], [], SELECT_TIMEOUT)
-                    if ready[0]:
-                        buff = self.sock.recv(BUFFER_SIZE)
+class TestScheduler:
+    "starts tests as their dependencies, hosts, and the parallel limit allow"
+
+    def __init__(self, tests, limit, durations=None):
+        self.limit = limit
+        # Tests not yet started, in the order they are tried: with durations,
+        # tests never run before come first (they might be the longest), then
+        # the rest longest first. Otherwise, configuration file order.
+        durations = durations or {}
+        order = sorted(range(len(tests)),
+                       key=lambda index: (tests[index].label in durations,
+                                          -durations.get(tests[index].label, 0), index))
+        self.waiting = [tests[index] for index in order]
+        self.running = []
+        self.finished = set()
+        # Targets of the running tests.
+        self.busy = set()
+        # Earlier tests named by each test's -after labels.
+        self.dependencies = {}
+        byLabel = {}
+        for test in tests:
+            self.dependencies[test] = [earlier for label in test.after
+                                       for earlier in byLabel.get(label, ())]
+            byLabel.setdefault(test.label, []).append(test)
+
+    def done(self):
+        return not self.waiting and not self.running
 
-                        if buff:
-                            # In case multiple commands were in the buffer, split them up before
-                            # sending to process_result_string. Filter empty strings.
-                            commands = filter(None, buff.decode('UTF-8').split('\n'))
-                            for command in commands:
-                                self.process_result_string(command)
-                            
-        except Exception as e:
-            print('\t\t\t\t-- NOTICE: while waiting for %s, the following exception occurred: %s.' 
-                % (self.target, str(e)))
+    #
+    # Pick the tests that can start now and mark them running. A test can
+    # start once the tests it comes after have finished, if none of its
+    # targets is in a running test, and neither it nor a running test is
+    # exclusive.
+    #
+    # Return:
+    #     List of tests to start.
+    #
+    def ready(self):
+        started = []
+        for test in list(self.waiting):
+            if self.limit != PARALLEL_UNLIMITED and len(self.running) >= self.limit:
+                break
+            if self.running and (test.exclusive or self.running[0].exclusive):
+                continue
+            if not all(earlier in self.finished for earlier in self.dependencies[test]):
+                continue
+            if not self.busy.isdisjoint(test.specs):
+                continue
+            self.waiting.remove(test)
+            self.running.append(test)
+            self.busy.update(test.specs)
+            started.append(test)
+        return started
+
+    def finish(self, test):
+        self.running.remove(test)
+        self.busy.difference_update(test.specs)
+        self.finished.add(test)
 
-        self.update_incomplete_and_print(TIMEOUT_STATUS)
+# ############################################################################ #
+# Progress class for tracking and displaying the progress of a test.           #
+# ############################################################################ #
+class Progress:
+    "aggregated counters of a running test, rendered as a single status line"
+
+    def __init__(self, test):
+        self.lock = threading.Lock()
+        self.startTime = time.monotonic()
+        # Jobs still pending, by target.
+        self.pending = {target: len(commands) for target, commands in test.specs.items()}
+        self.total = sum(self.pending.values())
+        self.pendingTotal = self.total
+        self.hosts = len(self.pending)
+        self.lost = set()
+        # Result lines held back until the test is over.
+        self.lines = []
+        # Tests running in parallel share the console, so say which is which,
+        # and print plain lines rather than overwrite each other's.
+        self.tty = sys.stdout.isatty() and parallel == 1
+        self.lastRender = None
+        self.label = test.label if parallel != 1 else None
 
-    def handle_timeout(self):
-        if self.running:
-            self.running = False
-            if verbose:
-                print('\t\t\t\t-- %s timed out before completion of all jobs.' % self.target)
-            self.netJobs.handle_timeout(self.target, self.test, self.netJobs)
+    #
+    # Count completed jobs of a target and keep their result lines.
+    #
+    def complete(self, target, count, lines):
+        with self.lock:
+            count = min(count, self.pending.get(target, 0))
+            self.pending[target] = self.pending.get(target, 0) - count
+            self.pendingTotal -= count
+            self.lines.extend(lines)
 
-    def kill(self):
-        if self.running:
-            self.running = False
-            if verbose:
-                print('\t\t\t\t-- %s was sent remote kill command.' % self.target)
-            try:
-                self.sock.sendall(bytes(KILL_STRING + '\n', 'UTF-8'))
-            except:
-                pass
+    def host_lost(self, target):
+        with self.lock:
+            self.lost.add(target)
 
-    def process_result_string(self, message):
-        tokens = message.split(SOCKET_DELIMITER)
-        count = len(tokens)
+    #
+    # Current status line, e.g. "(0:01:15) Pending jobs: 2 of 4. Hosts lost:
+    # 0 of 2. Slowest: 10.0.0.5 (2 pending)."
+    #
+    def line(self):
+        with self.lock:
+            elapsed = int(time.monotonic() - self.startTime)
+            line = '(%d:%02d:%02d) Pending jobs: %d of %d. Hosts lost: %d of %d.' % (
+                elapsed // 3600, elapsed // 60 % 60, elapsed % 60, self.pendingTotal,
+                self.total, len(self.lost), self.hosts)
+            if self.pendingTotal:
+                slowest = max(self.pending, key=self.pending.get)
+                line += ' Slowest: %s (%d pending).' % (slowest, self.pending[slowest])
+        if self.label is not None:
+            line = '%s: %s' % (self.label, line)
+        return line
 
-        if DONE_STRING == message:
-            self.running = False
-            if verbose:
-                print('\t\t\t\t-- %s reported all jobs complete.' % self.target)
-        elif PING_OK_STRING == message:
-            self.pingActive = False
+    #
+    # Refresh the status line in place on a terminal, at most every
+    # PROGRESS_INTERVAL seconds, or print it as a plain line every
+    # PROGRESS_PLAIN_INTERVAL seconds otherwise.
+    #
+    def render(self):
+        now = time.monotonic()
+        interval = PROGRESS_INTERVAL if self.tty else PROGRESS_PLAIN_INTERVAL
+        if self.lastRender is not None and now - self.lastRender < interval:
+            return
+        if self.lastRender is None and not self.tty:
+            # Skip the plain line at time zero.
+            self.lastRender = now
+            return
+        self.lastRender = now
+        if self.tty:
+            sys.stdout.write('\r\t\t' + self.line() + '\x1b[K')
         else:
-            if count < 4:
-                # Messages sent here should always have 4 tokens each, even if some
-                # are empty. Check just in case and pad.
-                print('\t\t\t\t-- %s sent an invalid string: %s' % (self.target, message))
-                for i in range(4-count):
-                    tokens.append('')
-            target = tokens[0]
-            command = tokens[1]
-            status = tokens[2]
-            output = tokens[3]
-
-            # Store in test.
-            self.test.results[target][command] = (status, output)
-
-            # Print.
-            print('\t\t\t%s' % message)
-
-            # Ping test.
-            if status == SUCCESS_STATUS:
-                self.test.successesReceived += 1
-                if self.test.successesReceived >= self.test.minHosts:
-                    self.netJobs.ping_agent_status()
+            sys.stdout.write('\t\t' + self.line() + '\n')
+        sys.stdout.flush()
 
-    def update_incomplete_and_print(self, message):
-        for command in self.test.specs[self.target]:
-            if not command in self.test.results[self.target]:
-                self.test.results[self.target][command] = (message, '')
-                print('\t\t\t' + self.target + SOCKET_DELIMITER + command 
-                    + SOCKET_DELIMITER + self.test.results[self.target][command][0]
-                    + SOCKET_DELIMITER + self.test.results[self.target][command][1])
+    #
+    # Show the final status, then every result line held back, at once.
+    #
+    # Params:
+    #     heldLines List to append the status and result lines to instead, for
+    #         a test whose output is held until it can be printed as a block.
+    #
+    def finish(self, heldLines=None):
+        line = '\t\t' + self.line()
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if heldLines is not None:
+            heldLines.append(line)
+            heldLines.extend(lines)
+            return
+        if self.tty:
+            sys.stdout.write('\r' + line + '\x1b[K\n')
+        else:
+            sys.stdout.write(line + '\n')
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
 
-    def ping_status_check(self):
-        if self.running and not self.pingActive:
-            try:
-                self.sock.sendall(bytes(PING_STATUS_STRING + '\n', 'UTF-8'))
-            except Exception as e:
-                self.handle_timeout
-            self.pingStart = time.time()
-            self.pingActive = True
-        
 
 # ############################################################################ #
-# Functions.                                                                   #
+# ResultStore class for recording results in an SQLite database.               #
 # ############################################################################ #
+class ResultStore:
+    "indexed SQLite database of runs, tests, hosts, jobs, timings and telemetry"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY, config TEXT, engine TEXT, started TEXT, finished TEXT);
+        CREATE TABLE IF NOT EXISTS tests (
+            id INTEGER PRIMARY KEY, run INTEGER REFERENCES runs(id), label TEXT,
+            started TEXT, finished TEXT, aborted INTEGER);
+        CREATE TABLE IF NOT EXISTS hosts (
+            id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY, test INTEGER REFERENCES tests(id),
+            host INTEGER REFERENCES hosts(id), command TEXT, status TEXT, output TEXT,
+            spawned REAL, finished REAL, wall REAL, user REAL, sys REAL, maxrss INTEGER,
+            inblock INTEGER, oublock INTEGER, nvcsw INTEGER, nivcsw INTEGER);
+        CREATE TABLE IF NOT EXISTS timings (
+            test INTEGER REFERENCES tests(id), host INTEGER REFERENCES hosts(id),
+            prep REAL, clock_offset REAL, rtt REAL, received REAL);
+        CREATE TABLE IF NOT EXISTS telemetry (
+            test INTEGER REFERENCES tests(id), host INTEGER REFERENCES hosts(id),
+            seconds REAL, field TEXT, value INTEGER);
+        CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+        CREATE INDEX IF NOT EXISTS tests_label ON tests(label, started);
+        CREATE INDEX IF NOT EXISTS tests_started ON tests(started);
+        CREATE INDEX IF NOT EXISTS jobs_test ON jobs(test);
+        CREATE INDEX IF NOT EXISTS jobs_host ON jobs(host, test);
+        CREATE INDEX IF NOT EXISTS timings_test ON timings(test, host);
+        CREATE INDEX IF NOT EXISTS telemetry_test ON telemetry(test, host, field);
+    """
+
+    def __init__(self, path, config):
+        # Results arrive on listener threads; every use of the connection is
+        # serialized by the lock.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Let queries run against the database while a run is writing to it.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+            self.connection.execute('PRAGMA user_version=%d' % STORE_SCHEMA_VERSION)
+            self.runId = self.connection.execute(
+                'INSERT INTO runs (config, engine, started) VALUES (?, ?, ?)',
+                (os.path.abspath(config), engine, datetime.datetime.now().isoformat())).lastrowid
+        self.config = os.path.abspath(config)
+        self.hostIds = {}
+        # Job rows waiting to be written.
+        self.pending = []
+
+    #
+    # Row ID of a host, added on first use. Called with the lock held.
+    #
+    def host_id(self, name):
+        hostId = self.hostIds.get(name)
+        if hostId is None:
+            self.connection.execute('INSERT OR IGNORE INTO hosts (name) VALUES (?)', (name,))
+            hostId = self.connection.execute('SELECT id FROM hosts WHERE name = ?',
+                                             (name,)).fetchone()[0]
+            self.hostIds[name] = hostId
+        return hostId
+
+    def begin_test(self, test):
+        with self.lock, self.connection:
+            test.storeId = self.connection.execute(
+                'INSERT INTO tests (run, label, started) VALUES (?, ?, ?)',
+                (self.runId, test.label, test.timestamp)).lastrowid
+
+    #
+    # Queue a job's result, writing the queue once STORE_BATCH_SIZE rows are
+    # waiting.
+    #
+    def add_job(self, test, target, command, status, output, usage):
+        spawned = test.startTimes.get(target, (None, {}))[1].get(command)
+        usage = usage or {}
+        row = ((test.storeId, target, command, status, output, spawned, time.time())
+               + tuple(usage.get(field) for field in USAGE_FIELDS))
+        with self.lock:
+            self.pending.append(row)
+            if len(self.pending) >= STORE_BATCH_SIZE:
+                self.flush()
+
+    #
+    # Write every queued job row in one transaction. Called with the lock held.
+    # Rows that cannot be written are reported and dropped.
+    #
+    def flush(self):
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT INTO jobs (test, host, command, status, output, spawned, finished, '
+                    + ', '.join(USAGE_FIELDS) + ') VALUES ('
+                    + ', '.join('?' * (7 + len(USAGE_FIELDS))) + ')',
+                    [row[:1] + (self.host_id(row[1]),) + row[2:] for row in rows])
+        except sqlite3.Error as e:
+            print('Error writing results database: %s.' % str(e))
+
+    #
+    # Write the remaining jobs, the timings and telemetry of each host, and
+    # close the test, in one transaction.
+    #
+    def end_test(self, test, aborted):
+        try:
+            with self.lock:
+                self.flush()
+                with self.connection:
+                    rows = []
+                    for target in test.specs:
+                        offset, rtt = test.clockOffsets.get(target, (None, None))
+                        rows.append((test.storeId, self.host_id(target),
+                                     test.prepTimes.get(target), offset, rtt,
+                                     test.startTimes.get(target, (None, {}))[0]))
+                    self.connection.executemany('INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?)',
+                                                rows)
+                    for target, hostTelemetry in test.telemetry.items():
+                        hostId = self.host_id(target)
+                        self.connection.executemany(
+                            'INSERT INTO telemetry VALUES (?, ?, ?, ?, ?)',
+                            ((test.storeId, hostId, seconds, field, value)
+                             for seconds, values in hostTelemetry['samples']
+                             for field, value in zip(hostTelemetry['fields'], values)))
+                    self.connection.execute(
+                        'UPDATE tests SET finished = ?, aborted = ? WHERE id = ?',
+                        (datetime.datetime.now().isoformat(), int(aborted), test.storeId))
+        except sqlite3.Error as e:
+            print('Error writing results database: %s.' % str(e))
+
+    #
+    # Mean duration, in seconds, of each test label in the earlier runs of the
+    # same configuration file.
+    #
+    def durations(self):
+        with self.lock:
+            try:
+                return dict(self.connection.execute(
+                    'SELECT tests.label, AVG((julianday(tests.finished) '
+                    '- julianday(tests.started)) * 86400) FROM tests '
+                    'JOIN runs ON runs.id = tests.run '
+                    'WHERE runs.config = ? AND runs.id != ? AND tests.finished IS NOT NULL '
+                    'GROUP BY tests.label', (self.config, self.runId)))
+            except sqlite3.Error as e:
+                print('Error reading results database: %s.' % str(e))
+                return {}
+
+    def close(self):
+        with self.lock:
+            try:
+                self.flush()
+                with self.connection:
+                    self.connection.execute('UPDATE runs SET finished = ? WHERE id = ?',
+                                            (datetime.datetime.now().isoformat(), self.runId))
+            except sqlite3.Error as e:
+                print('Error writing results database: %s.' % str(e))
+            self.connection.close()
+
+
+# ############################################################################ #
+# PrepThread class for preparing a single agent.                               #
+# ############################################################################ #
+class PrepThread(threading.Thread):
+    "connects to an agent and sends it the test specifications"
+
+    def __init__(self, target, test, deadline, pooled=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target = target
+        self.test = test
+        self.deadline = deadline
+        self.pooled = pooled
+        self.sock = None
+        self.error = None
+        self.timedOut = False
+        self.duration = None
+        self.startTime = None
+        # Set once prep_agents has given up on this thread, after which the
+        # thread must not touch the socket or the test.
+        self.abandoned = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        self.startTime = time.time()
+        error = None
+        timedOut = False
+        try:
+            self.handshake()
+        except socket.timeout as e:
+            timedOut = True
+            error = str(e)
+        except (PrepError, ProtocolError) as e:
+            error = str(e)
+        except socket.error as e:
+            error = ('ERROR: failed to open connection to socket for target '\
+                     '"%s": %s.' % (self.target, e))
+        with self.lock:
+            if self.abandoned:
+                return
+            self.error = error
+            self.timedOut = timedOut
+            if error is not None:
+                self.close()
+            self.duration = time.time() - self.startTime
+
+    def handshake(self):
+        # Reuse the persistent connection from the previous test if there is
+        # one. If the agent has gone away since, fall back to reconnecting.
+        if self.pooled is not None:
+            self.attach(self.pooled)
+            try:
+                self.send_spec()
+                return
+            except (socket.timeout, PrepError):
+                raise
+            except socket.error:
+                with self.lock:
+                    self.close()
+
+        self.attach(socket.create_connection(parse_target(self.target),
+                                             timeout=self.remaining()))
+        self.send_spec()
+
+    #
+    # Adopt a connection, or close it if the thread has been abandoned while
+    # connecting, since nothing else would.
+    #
+    def attach(self, sock):
+        with self.lock:
+            if self.abandoned:
+                sock.close()
+                raise PrepError('abandoned after the prep deadline')
+            self.sock = sock
+
+    #
+    # Send the test specification and wait for the acknowledgement.
+    #
+    def send_spec(self):
+        target = self.target
+        sock = self.sock
+
+        # Send the whole test specification in a single frame.
+        message, digest = spec_message(target, self.test)
+        sock.settimeout(self.remaining())
+        specSent = time.time()
+        sock.sendall(message)
+
+        # The agent acknowledges with the checksum of what it received, and
+        # when it received it and replied, as a first clock sample.
+        agentTimes = check_ack(target, *self.recv_frame(sock), digest=digest)
+        ack = (specSent, agentTimes, time.time())
+
+        # Estimate the agent's clock offset for scheduled starts and skew reports.
+        samples = []
+        for i in range(clock_samples()):
+            sent = time.time()
+            sock.sendall(pack_frame(FRAME_SYNC))
+            kind, payload = self.recv_frame(sock)
+            samples.append((sent, kind, payload, time.time()))
+        clockOffset = estimate_clock_offset(target, samples, ack)
+        with self.lock:
+            if not self.abandoned:
+                self.test.clockOffsets[target] = clockOffset
+
+        # The ListenThread manages its own timeouts from here on.
+        sock.settimeout(SOCKET_TIMEOUT)
+
+    #
+    # Receive a single frame. The agent only ever answers what we sent, so
+    # nothing can follow it.
+    #
+    def recv_frame(self, sock):
+        received = b''
+        while True:
+            frames, remainder = unpack_frames(received)
+            if frames:
+                return frames[0]
+            sock.settimeout(self.remaining())
+            chunk = sock.recv(BUFFER_SIZE)
+            if not chunk:
+                raise socket.error('connection closed by agent')
+            received += chunk
+
+    #
+    # Seconds left before the overall prep deadline.
+    #
+    def remaining(self):
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('prep deadline of %d second(s) exceeded' % PREP_TIMEOUT)
+        return remaining
+
+    #
+    # Give up on this agent after the deadline has passed. The thread may
+    # still be running, but leaves everything alone from here on.
+    #
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            if self.startTime is not None:
+                self.duration = time.time() - self.startTime
+            self.error = 'prep deadline of %d second(s) exceeded' % PREP_TIMEOUT
+            self.timedOut = True
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+            self.sock = None
+
+
+# ############################################################################ #
+# PrepError exception raised when an agent fails its handshake.                #
+# ############################################################################ #
+class PrepError(Exception):
+    "raised when an agent fails to acknowledge a setup message"
+    pass
+
+
+# ############################################################################ #
+# ProtocolError exception raised on malformed frames.                          #
+# ############################################################################ #
+class ProtocolError(Exception):
+    "raised when a frame does not match the protocol"
+    pass
+
+
+# ############################################################################ #
+# ResultListener class for handling the results of a single agent.             #
+# ############################################################################ #
+class ResultListener:
+    "transport-independent handling of the messages received from an agent"
+
+    def __init__(self, target, timeout, netJobs, test):
+        self.target = target
+        self.timeout = timeout
+        self.netJobs = netJobs
+        self.test = test
+        self.running = False
+        self.done = False
+        self.pingActive = False
+        self.pingStart = None
+        # Output received so far, by (command index, stream).
+        self.chunks = {}
+        # Open output files when streaming, by (command index, stream).
+        self.sinks = {}
+
+    #
+    # Send a frame to the agent. Implemented by each engine.
+    #
+    def send(self, kind, payload=b''):
+        raise NotImplementedError
+
+    def handle_timeout(self):
+        if self.running:
+            self.running = False
+            if self.netJobs.progress is not None:
+                self.netJobs.progress.host_lost(self.target)
+            if verbose:
+                print('\t\t\t\t-- %s timed out before completion of all jobs.' % self.target)
+            self.netJobs.handle_timeout(self.target, self.test, self.netJobs)
+
+    def kill(self):
+        if self.running:
+            self.running = False
+            if verbose:
+                print('\t\t\t\t-- %s was sent remote kill command.' % self.target)
+            try:
+                self.send(FRAME_KILL)
+            except:
+                pass
+
+    def process_frame(self, kind, payload):
+        if kind == FRAME_DONE:
+            self.running = False
+            self.done = True
+            if verbose:
+                print('\t\t\t\t-- %s reported all jobs complete.' % self.target)
+        elif kind == FRAME_PONG:
+            self.pingActive = False
+        elif kind == FRAME_TIMING:
+            self.process_timing(payload)
+        elif kind == FRAME_CHUNK:
+            self.process_chunk(payload)
+        elif kind == FRAME_RESULT:
+            self.process_result(payload)
+        elif kind == FRAME_TELEMETRY:
+            try:
+                self.test.telemetry[self.target] = decode_telemetry(payload)
+            except (zlib.error, ValueError, KeyError, TypeError):
+                print('\t\t\t\t-- %s sent invalid telemetry.' % self.target)
+        else:
+            print('\t\t\t\t-- %s sent an unknown frame kind: %d' % (self.target, kind))
+
+    #
+    # Handle a chunk of job output, either collecting it for the result or
+    # writing it straight to its output file.
+    #
+    def process_chunk(self, payload):
+        index, stream, capturedAt = struct.unpack_from(CHUNK_HEADER, payload)
+        data = memoryview(payload)[CHUNK_HEADER_SIZE:]
+        if streamDir is None:
+            self.chunks.setdefault((index, stream), bytearray()).extend(data)
+        else:
+            sink = self.open_sink(index, stream)
+            if sink is not None:
+                sink.write(data)
+            # Record when each chunk was captured, so the relative order of
+            # the two streams can be reconstructed.
+            timeline = self.open_sink(index, STREAM_NONE)
+            if timeline is not None:
+                timeline.write(bytes('%.6f\t%s\t%d\n' % (capturedAt,
+                    'stdout' if stream == STREAM_STDOUT else 'stderr', len(data)), 'UTF-8'))
+        if streamConsole:
+            prefix = '\t\t\t\t%s [%d +%.3fs]> ' % (self.target, index, capturedAt)
+            text = bytes(data).decode('UTF-8', 'replace')
+            print(''.join(prefix + line for line in text.splitlines(True)), end='')
+            if not text.endswith('\n'):
+                print()
+
+    #
+    # Output file of a command's stream, opened on first use. Returns None if
+    # the file cannot be written.
+    #
+    def open_sink(self, index, stream):
+        sink = self.sinks.get((index, stream))
+        if sink is None:
+            path = stream_path(self.test, self.target, index, stream)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                sink = open(path, 'wb')
+            except OSError as e:
+                print('\t\t\t\t-- Error writing output file %s: %s.' % (path, str(e)))
+                return None
+            self.sinks[(index, stream)] = sink
+        return sink
+
+    #
+    # Close the output files of a command once its result arrives.
+    #
+    def close_sinks(self, index=None):
+        for key in list(self.sinks.keys()):
+            if index is None or key[0] == index:
+                self.sinks.pop(key).close()
+
+    #
+    # Record a command's result, along with the output sent ahead of it.
+    #
+    def process_result(self, payload):
+        try:
+            result = json.loads(payload.decode('UTF-8'))
+            index = result['index']
+            command = self.test.specs[self.target][index]
+            status = result['status']
+        except (ValueError, KeyError, IndexError, TypeError):
+            print('\t\t\t\t-- %s sent an invalid result: %r' % (self.target, payload))
+            return
+        stream = result.get('stream', STREAM_NONE)
+        if streamDir is not None:
+            # Report where the output went instead of the output itself.
+            self.close_sinks(index)
+            output = ''
+            if stream != STREAM_NONE:
+                output = stream_path(self.test, self.target, index, stream)
+        else:
+            output = bytes(self.chunks.pop((index, stream), b'')).decode('UTF-8', 'replace')
+            # Drop the output of the stream not reported.
+            for key in [key for key in self.chunks if key[0] == index]:
+                del self.chunks[key]
+        if result.get('dropped'):
+            output += ' [%d byte(s) over the output cap discarded]' % result['dropped']
+        if result.get('detail'):
+            output = result['detail']
+
+        # Store in test.
+        self.test.results[self.target][command] = (status, output, result.get('usage'))
+        if self.netJobs.store is not None:
+            self.netJobs.store.add_job(self.test, self.target, command, status, output,
+                                       result.get('usage'))
+        if result.get('placement'):
+            self.test.placementReports.setdefault(self.target, {})[command] = result['placement']
+
+        # Print.
+        lines = ['\t\t\t' + self.target + SOCKET_DELIMITER + command + SOCKET_DELIMITER
+                 + status + SOCKET_DELIMITER + output]
+        if result.get('placement'):
+            lines.append('\t\t\t\t-- placement: %s' % format_placement(result['placement']))
+        if result.get('usage'):
+            lines.append('\t\t\t\t-- usage: %s' % format_usage(result['usage']))
+        self.report(lines, 1)
+
+        # Ping test.
+        if status == SUCCESS_STATUS:
+            self.test.successesReceived += 1
+            if self.test.successesReceived >= self.test.minHosts:
+                self.netJobs.ping_agent_status()
+
+    #
+    # Record the agent's start timestamps, converted to our clock.
+    #
+    def process_timing(self, payload):
+        offset = self.test.clockOffsets.get(self.target, (0, 0))[0]
+        try:
+            timing = json.loads(payload.decode('UTF-8'))
+            received = timing['received'] - offset
+            spawned = {}
+            for command, spawnTime in zip(self.test.specs[self.target], timing['spawned']):
+                # None if the command failed to spawn.
+                if spawnTime is not None:
+                    spawned[command] = spawnTime - offset
+        except (ValueError, KeyError, TypeError):
+            print('\t\t\t\t-- %s sent invalid timings: %r' % (self.target, payload))
+            return
+        self.test.startTimes[self.target] = (received, spawned)
+
+    def update_incomplete_and_print(self, message):
+        self.close_sinks()
+        lines = []
+        for command in self.test.specs[self.target]:
+            if self.test.results[self.target].get(command) is None:
+                self.test.results[self.target][command] = (message, '', None)
+                if self.netJobs.store is not None:
+                    self.netJobs.store.add_job(self.test, self.target, command, message, '', None)
+                lines.append('\t\t\t' + self.target + SOCKET_DELIMITER + command
+                             + SOCKET_DELIMITER + self.test.results[self.target][command][0]
+                             + SOCKET_DELIMITER + self.test.results[self.target][command][1])
+        if lines:
+            self.report(lines, len(lines))
+
+    #
+    # Print result lines as they arrive or, when showing progress or running
+    # tests in parallel, keep the lines until the test is over. Progress takes
+    # precedence, and hands its lines to the held block when it finishes.
+    #
+    def report(self, lines, completed):
+        if self.netJobs.progress is not None:
+            self.netJobs.progress.complete(self.target, completed, lines)
+        elif self.netJobs.heldLines is not None:
+            self.netJobs.heldLines.extend(lines)
+        else:
+            print('\n'.join(lines))
+
+    def ping_status_check(self):
+        if self.running and not self.pingActive:
+            try:
+                self.send(FRAME_PING)
+            except Exception as e:
+                self.handle_timeout()
+                return
+            self.pingStart = time.time()
+            self.pingActive = True
+
+
+# ############################################################################ #
+# ListenThread class for listening for test results.                           #
+# ############################################################################ #
+class ListenThread(ResultListener, threading.Thread):
+    "listens for test results for a given agent"
+
+    def __init__(self, target, sock, timeout, netJobs, test):
+        ResultListener.__init__(self, target, timeout, netJobs, test)
+        threading.Thread.__init__(self)
+        self.sock = sock
+
+    def run(self):
+        self.running = True
+        startTime = time.time()
+        received = b''
+        try:
+            while self.running:
+                currentTime = time.time()
+                elapsedTime = currentTime - startTime
+                # Check for timeout.
+                if not self.timeout == TIMEOUT_NONE and elapsedTime >= self.timeout:
+                    self.handle_timeout()
+                # Check for ping timeout.
+                elif self.pingActive and currentTime - self.pingStart >= SOCKET_TIMEOUT:
+                    self.handle_timeout()
+                else:
+                    # Wait for result to be transmitted from agent.
+                    ready = select.select([self.sock], [], [], SELECT_TIMEOUT)
+                    if ready[0]:
+                        buff = self.sock.recv(CHUNK_SIZE)
+
+                        if buff:
+                            # The buffer may hold several frames, or only part of one.
+                            frames, received = unpack_frames(received + buff)
+                            for kind, payload in frames:
+                                self.process_frame(kind, payload)
+                        else:
+                            # Connection closed by agent.
+                            self.handle_timeout()
+
+        except Exception as e:
+            print('\t\t\t\t-- NOTICE: while waiting for %s, the following exception occurred: %s.' 
+                % (self.target, str(e)))
+
+        self.update_incomplete_and_print(TIMEOUT_STATUS)
+
+    def send(self, kind, payload=b''):
+        self.sock.sendall(pack_frame(kind, payload))
+
+
+# ############################################################################ #
+# AsyncEngine class for driving all agents from a single event loop.           #
+# ############################################################################ #
+class AsyncEngine:
+    "asyncio alternative to the thread-per-target engine"
+
+    def __init__(self, netJobs):
+        self.netJobs = netJobs
+
+    #
+    # Run every test in the configuration.
+    #
+    def run(self):
+        asyncio.run(self.run_tests())
+
+    #
+    # Run each test as its own task, with its own engine and test context, as
+    # soon as the scheduler allows it.
+    #
+    async def run_tests(self):
+        netJobs = self.netJobs
+        scheduler = netJobs.scheduler()
+        loop = asyncio.get_event_loop()
+
+        # A SystemExit raised within a task would escape the event loop, so
+        # each test hands it back to be raised here instead.
+        async def run(test):
+            try:
+                await AsyncEngine(netJobs.test_context(test)).run_test(test)
+            except SystemExit as e:
+                return e
+
+        tasks = {}
+        while not scheduler.done():
+            for test in scheduler.ready():
+                tasks[loop.create_task(run(test))] = test
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                scheduler.finish(tasks.pop(task))
+                # Raise any exception that ended the test.
+                error = task.result()
+                if error is not None:
+                    raise error
+
+        await self.close_pool()
+
+    #
+    # Run a single test.
+    #
+    async def run_test(self, test):
+        netJobs = self.netJobs
+
+        if netJobs.store is not None:
+            netJobs.store.begin_test(test)
+
+        if verbose:
+            print('\t%s...' % test.label)
+        # Prepare remote agents.
+        await self.prep_agents(test)
+
+        # Start remote agents.
+        await self.start_agents(test)
+
+        # Wait for remote agent return status.
+        await self.wait_for_results(test)
+        # Report how simultaneous the starts were.
+        netJobs.report_skew(test)
+        netJobs.report_telemetry(test)
+        # Log output if enabled.
+        if logging:
+            netJobs.logResults(test)
+            netJobs.logSkew(test)
+            netJobs.logPlacement(test)
+            netJobs.logUsage(test)
+            netJobs.logTelemetry(test)
+        if netJobs.store is not None:
+            netJobs.store.end_test(test, netJobs.testAborted)
+        # Clean up.
+        self.clean_up(test)
+
+    #
+    # Prepare remote agents concurrently, bounded by PREP_TIMEOUT.
+    #
+    async def prep_agents(self, test):
+        netJobs = self.netJobs
+
+        if verbose:
+            print('\t\tPreparing agents...')
+
+        # Skip if in simulation mode.
+        if simulate:
+            if verbose:
+                print('\t\t...finished.\n')
+            return
+
+        deadline = time.time() + PREP_TIMEOUT
+        targets = list(test.specs.keys())
+        outcomes = await asyncio.gather(*[self.prep_target(target, test, deadline)
+                                          for target in targets])
+
+        # Evaluate outcomes in config order so error reporting is deterministic.
+        for target, (streams, error, timedOut, duration) in zip(targets, outcomes):
+            test.prepTimes[target] = duration
+            if timedOut:
+                netJobs.handle_timeout(target, test, netJobs)
+                print('ERROR: a socket timeout occurred: %s.' % error)
+            elif error is not None:
+                sys.exit(error)
+            else:
+                # Good to go.
+                netJobs.sockets[target] = streams
+
+        netJobs.print_prep_times(test)
+
+        if verbose:
+            print('\t\t...finished.\n')
+
+    #
+    # Prepare a single agent.
+    #
+    # Return:
+    #     (reader, writer) stream pair, or None on failure.
+    #     Error message, or None on success.
+    #     Whether the failure was a timeout.
+    #     Handshake duration in seconds.
+    #
+    async def prep_target(self, target, test, deadline):
+        startTime = time.time()
+        streams = None
+        error = None
+        timedOut = False
+        try:
+            streams = await asyncio.wait_for(self.handshake(target, test),
+                                             max(0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            timedOut = True
+            error = 'prep deadline of %d second(s) exceeded' % PREP_TIMEOUT
+        except (PrepError, ProtocolError) as e:
+            error = str(e)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            error = ('ERROR: failed to open connection to socket for target '\
+                     '"%s": %s.' % (target, e))
+        return streams, error, timedOut, time.time() - startTime
+
+    async def handshake(self, target, test):
+        # Reuse the persistent connection from the previous test if there is
+        # one. If the agent has gone away since, fall back to reconnecting.
+        pooled = self.netJobs.pool.pop(target, None)
+        if pooled is not None:
+            try:
+                await self.send_spec(target, test, *pooled)
+                return pooled
+            except (OSError, asyncio.IncompleteReadError):
+                pooled[1].close()
+            except BaseException:
+                pooled[1].close()
+                raise
+
+        reader, writer = await asyncio.open_connection(*parse_target(target))
+        try:
+            await self.send_spec(target, test, reader, writer)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def send_spec(self, target, test, reader, writer):
+        message, digest = spec_message(target, test)
+        specSent = time.time()
+        writer.write(message)
+        await writer.drain()
+        agentTimes = check_ack(target, *await recv_frame(reader), digest=digest)
+        ack = (specSent, agentTimes, time.time())
+
+        # Estimate the agent's clock offset for scheduled starts and skew reports.
+        samples = []
+        for i in range(clock_samples()):
+            sent = time.time()
+            writer.write(pack_frame(FRAME_SYNC))
+            await writer.drain()
+            kind, payload = await recv_frame(reader)
+            samples.append((sent, kind, payload, time.time()))
+        test.clockOffsets[target] = estimate_clock_offset(target, samples, ack)
+
+    #
+    # Start remote agents.
+    #
+    async def start_agents(self, test):
+        netJobs = self.netJobs
+
+        if verbose:
+            print('\t\tStarting agents...')
+
+        for target, (reader, writer) in netJobs.sockets.items():
+            netJobs.listeners[target] = AsyncListener(target, reader, writer,
+                                                      test.listenerTimeouts[target],
+                                                      netJobs, test)
+
+        # All listeners are started before any START is sent, as in the
+        # threaded engine.
+        for listener in list(netJobs.listeners.values()):
+            listener.start()
+        netJobs.results_header(test)
+        if udpStart is not None:
+            send_udp_start(test)
+            deadline = time.time() + UDP_CONFIRM_TIMEOUT
+            while time.time() < deadline and netJobs.unconfirmed_listeners(test):
+                await asyncio.sleep(UDP_CONFIRM_POLL)
+            netJobs.fall_back_to_tcp_start(test)
+        else:
+            startAt = netJobs.schedule_start(test)
+            for target, listener in list(netJobs.listeners.items()):
+                listener.send(FRAME_START, start_payload(test, target, startAt))
+        await asyncio.gather(*[listener.writer.drain()
+                               for listener in netJobs.listeners.values()],
+                             return_exceptions=True)
+
+        if verbose:
+            print('\t\t...finished.\n')
+
+    #
+    # Wait for remote agent results.
+    #
+    async def wait_for_results(self, test):
+        if verbose:
+            print('\t\tWaiting for agent results...')
+
+        heldLines = self.netJobs.heldLines
+        tasks = [listener.task for listener in self.netJobs.listeners.values()]
+        progress = self.netJobs.progress
+        if progress is None:
+            await asyncio.gather(*tasks)
+        else:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=PROGRESS_INTERVAL)
+                progress.render()
+            progress.finish(heldLines)
+
+        if heldLines is not None:
+            # One write, so that the block of a parallel test stays whole.
+            sys.stdout.write('\n'.join(['', '\t\t-- %s // RESULTS:' % test.label] + heldLines + ['']))
+            sys.stdout.flush()
+
+        if verbose:
+            print('\t\t...finished.\n')
+
+    #
+    # Clean up after test.
+    #
+    def clean_up(self, test):
+        netJobs = self.netJobs
+
+        if verbose:
+            print('\t\tCleaning up...')
+
+        for target, streams in list(netJobs.sockets.items()):
+            listener = netJobs.listeners.get(target)
+            if session and listener is not None and listener.done:
+                netJobs.pool[target] = streams
+            else:
+                streams[1].close()
+
+        if verbose:
+            print('\t\t...finished.\n')
+
+    #
+    # End the session with every pooled agent.
+    #
+    async def close_pool(self):
+        netJobs = self.netJobs
+
+        if verbose and netJobs.pool:
+            print('\tClosing %d persistent agent connection(s)...' % len(netJobs.pool))
+
+        for reader, writer in netJobs.pool.values():
+            try:
+                writer.write(pack_frame(FRAME_BYE))
+                await writer.drain()
+                writer.close()
+            except Exception:
+                pass
+        netJobs.pool = {}
+
+
+# ############################################################################ #
+# AsyncListener class for listening for test results on the event loop.        #
+# ############################################################################ #
+class AsyncListener(ResultListener):
+    "listens for test results for a given agent without a dedicated thread"
+
+    def __init__(self, target, reader, writer, timeout, netJobs, test):
+        ResultListener.__init__(self, target, timeout, netJobs, test)
+        self.reader = reader
+        self.writer = writer
+        self.task = None
+        self.timer = None
+
+    #
+    # Schedule the listener on the running event loop. Timeouts are timer
+    # callbacks rather than periodic checks.
+    #
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.running = True
+        self.task = loop.create_task(self.run())
+        if not self.timeout == TIMEOUT_NONE:
+            self.timer = loop.call_later(self.timeout, self.handle_timeout)
+
+    async def run(self):
+        try:
+            while self.running:
+                try:
+                    kind, payload = await recv_frame(self.reader)
+                except asyncio.IncompleteReadError:
+                    # Connection closed by agent.
+                    self.handle_timeout()
+                    break
+                self.process_frame(kind, payload)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print('\t\t\t\t-- NOTICE: while waiting for %s, the following exception occurred: %s.' 
+                % (self.target, str(e)))
+
+        if self.timer is not None:
+            self.timer.cancel()
+        self.update_incomplete_and_print(TIMEOUT_STATUS)
+
+    def send(self, kind, payload=b''):
+        self.writer.write(pack_frame(kind, payload))
+
+    #
+    # Stop reading once the listener is no longer running, unless called from
+    # within the listener's own task, which exits its loop by itself.
+    #
+    def stop_task(self):
+        if self.task is not None and not self.task.done() \
+                and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def handle_timeout(self):
+        ResultListener.handle_timeout(self)
+        self.stop_task()
+
+    def kill(self):
+        ResultListener.kill(self)
+        self.stop_task()
+
+    def ping_status_check(self):
+        ResultListener.ping_status_check(self)
+        if self.pingActive:
+            asyncio.get_event_loop().call_later(SOCKET_TIMEOUT, self.check_ping,
+                                                self.pingStart)
+
+    def check_ping(self, pingStart):
+        if self.pingActive and self.pingStart == pingStart:
+            self.handle_timeout()
+
+
+# ############################################################################ #
+# Functions.                                                                   #
+# ############################################################################ #
+
+#
+# Ask the user to provide the config file path.
+#
+def ask_for_path():
+    "ask user to provide config file path"
+    
+    return input('Please enter the configuration file path: ')
+
+#
+# Split a target into the host and port of its agent.
+#
+# Params:
+#     target "HOST", "HOST:PORT", "[IPV6]", or "[IPV6]:PORT".
+#
+# Return:
+#     Host name or address, without brackets.
+#     Port, AGENT_LISTEN_PORT if none is given.
+#
+def parse_target(target):
+    "split a target into host and port"
+
+    host, port = target, ''
+    if target.startswith('['):
+        host, bracket, port = target[1:].partition(']')
+        if not bracket or (port and not port.startswith(':')):
+            raise ValueError('unterminated IPv6 address')
+        ipaddress.IPv6Address(host.partition('%')[0])
+        port = port[1:]
+    elif target.count(':') == 1:
+        host, _, port = target.partition(':')
+    if not host:
+        raise ValueError('missing host')
+    port = int(port) if port else AGENT_LISTEN_PORT
+    if not 0 < port < 65536:
+        raise ValueError('port %d out of range' % port)
+    return host, port
+
+#
+# Expand the numeric ranges of a host pattern. A range whose first number has
+# leading zeros is zero-padded to that width, e.g. "vm[08-10]" gives "vm08",
+# "vm09", and "vm10". Several ranges give every combination.
+#
+# Params:
+#     pattern Target, possibly containing "[FIRST-LAST]" ranges.
+#
+# Return:
+#     List of targets.
+#
+def expand_hosts(pattern):
+    "expand the numeric ranges of a host pattern"
+
+    parts = re.split(HOST_RANGE_REGEX, pattern)
+    if len(parts) == 1:
+        return [pattern]
+
+    # parts holds the text before each range, its bounds, and the text after
+    # the last range.
+    ranges = []
+    count = 1
+    for i in range(0, len(parts) - 1, 3):
+        text, first, last = parts[i:i + 3]
+        if int(first) > int(last):
+            raise ValueError('range [%s-%s] is descending' % (first, last))
+        width = len(first) if first.startswith('0') else 0
+        ranges.append((text, int(first), int(last), width))
+        count *= int(last) - int(first) + 1
+    if count > MAX_PATTERN_HOSTS:
+        raise ValueError('expands to %d hosts, more than %d' % (count, MAX_PATTERN_HOSTS))
+
+    choices = [[text + str(number).zfill(width) for number in range(first, last + 1)]
+               for text, first, last, width in ranges]
+    return [''.join(combination) + parts[-1] for combination in itertools.product(*choices)]
+
+#
+# Expand the target lines of a test block into the per-target dictionaries of
+# TestConfig. Targets named by the same sequence of target lines, such as the
+# hosts of a range or group, share one command list and one dictionary of
+# each kind instead of each getting a copy. So do targets whose lines are
+# different but identical in content, which also keeps the config cache
+# compact.
+#
+# Params:
+#     entries List of [targets, command, timeout, launch mode, placement or
+#         None], one per target line.
+#
+# Return:
+#     Commands, timeouts, launch modes, and placements, by target.
+#
+def expand_entries(entries):
+    "expand target lines into per-target specifications"
+
+    lines = {}
+    for index, entry in enumerate(entries):
+        for target in entry[0]:
+            lines.setdefault(target, []).append(index)
+
+    specs, timeouts, launchModes, placements = {}, {}, {}, {}
+    shared = {}
+    profiles = {}
+    for target, indices in lines.items():
+        indices = tuple(indices)
+        profile = shared.get(indices)
+        if profile is None:
+            profile = ([], {}, {}, {})
+            for index in indices:
+                targets, command, timeout, launch, placement = entries[index]
+                profile[0].append(command)
+                profile[1][command] = timeout
+                profile[2][command] = launch
+                if placement is not None:
+                    profile[3][command] = placement
+            profile = profiles.setdefault(marshal.dumps(profile), profile)
+            shared[indices] = profile
+        specs[target], timeouts[target], launchModes[target] = profile[:3]
+        if profile[3]:
+            placements[target] = profile[3]
+    return specs, timeouts, launchModes, placements
+
+#
+# Path of the config cache file of a configuration file.
+#
+def config_cache_path(path):
+    "config cache file of a configuration file"
+
+    name = hashlib.sha256(os.path.abspath(path).encode('UTF-8', 'surrogateescape'))
+    return os.path.join(CONFIG_CACHE_DIR, name.hexdigest() + CONFIG_CACHE_SUFFIX)
+
+#
+# Key of the compiled form of a configuration file: a SHA-256 digest of this
+# script, the Python version, and the content of the file.
+#
+# Return:
+#     Hexadecimal digest, or None if a file could not be read.
+#
+def config_cache_key(path):
+    "content hash identifying a compiled configuration"
+
+    digest = hashlib.sha256()
+    try:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            digest.update(f.read())
+        digest.update(bytes('%d %s\n' % (marshal.version, sys.version), 'UTF-8'))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+#
+# Read a compiled configuration from the config cache.
+#
+# Return:
+#     List of TestConfig arguments, one tuple per test, or None if the cache
+#     file is missing, unreadable, or holds a different key.
+#
+def read_config_cache(path, key):
+    "load a compiled configuration"
+
+    try:
+        with open(path, 'rb') as f:
+            # Much faster than marshal.load on the file object itself.
+            cachedKey, tests = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return tests if cachedKey == key else None
+
+#
+# Write a compiled configuration to the config cache. marshal keeps the
+# dictionaries shared between targets of one range or group shared. Failures
+# are not fatal: the configuration is simply parsed again next time.
+#
+def write_config_cache(path, key, tests):
+    "save a compiled configuration"
+
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+        with open(temp, 'wb') as f:
+            marshal.dump((key, tests), f)
+        # Replace atomically, so concurrent runs never read a partial file.
+        os.replace(temp, path)
+    except (OSError, ValueError) as e:
+        if verbose:
+            print('\tWARNING: unable to write config cache "%s": %s' % (path, e))
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        return
+    prune_config_cache()
+
+#
+# Mark a cache file as used, so pruning keeps it.
+#
+def touch_config_cache(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+#
+# Remove the least recently used cache files beyond CONFIG_CACHE_MAX_ENTRIES,
+# such as those of configuration files that no longer exist.
+#
+def prune_config_cache():
+    "bound the size of the config cache"
+
+    try:
+        entries = []
+        for entry in os.scandir(CONFIG_CACHE_DIR):
+            if entry.name.endswith(CONFIG_CACHE_SUFFIX):
+                entries.append((entry.stat().st_mtime, entry.path))
+    except OSError:
+        return
+    entries.sort(reverse=True)
+    for mtime, path in entries[CONFIG_CACHE_MAX_ENTRIES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+#
+# Canonical form of a target, as used to key results and logs: IPv6
+# addresses in brackets, and the port only if it is not AGENT_LISTEN_PORT.
+#
+def format_target(host, port):
+    "canonical endpoint of an agent"
+
+    if ':' in host:
+        address, percent, scope = host.partition('%')
+        host = '[%s%s%s]' % (ipaddress.IPv6Address(address).compressed, percent, scope)
+    if port == AGENT_LISTEN_PORT:
+        return host
+    return '%s:%d' % (host, port)
 
 #
-# Ask the user to provide the config file path.
-#
-def ask_for_path():
-    "ask user to provide config file path"
-    
-    return input('Please enter the configuration file path: ')
-
-#
 # Evaluate timeout string.
 #
 # Params:
@@ -715,15 +2634,415 @@ def evaluate_timeout_status(timeout):
         unit = timeout[-1] # Last character in string.
         value = int(timeout[:-1]) # Everything except last character in string.
 
-        if unit is 'h':
+        if unit == 'h':
             multiplier = 60 * 60
-        elif unit is 'm':
+        elif unit == 'm':
             multiplier = 60
         else:
             multiplier = 1
             
         return value * multiplier
 
+#
+# Check and convert the value of a placement option from the config file.
+#
+# Params:
+#     option "cpus", "numa", "nice", or "ionice".
+#     value Value string.
+#
+# Return:
+#     Value to send to the agent.
+#
+def evaluate_placement(option, value):
+    "check and convert a -cpus, -numa, -nice, or -ionice value"
+
+    if option == 'cpus' and re.match(CPU_LIST_REGEX, value):
+        return value
+    elif option == 'numa' and value.isdigit():
+        return int(value)
+    elif option == 'nice' and re.match(r'^-?\d+$', value) and -20 <= int(value) <= 19:
+        return int(value)
+    elif option == 'ionice' and re.match(IONICE_REGEX, value):
+        return value
+    raise ValueError({
+        'cpus': '-cpus must be a CPU list such as "0-3,6"',
+        'numa': '-numa must be a NUMA node number',
+        'nice': '-nice must be an integer from -20 to 19',
+        'ionice': '-ionice must be idle, best-effort[:LEVEL], or realtime[:LEVEL]'
+    }[option] + ', not "%s"' % value)
+
+#
+# Format a placement report from an agent.
+#
+def format_placement(report):
+    "format the placement an agent applied to a command"
+
+    return ', '.join('%s %s' % (key, report[key])
+                     for key in ('cpus', 'numa', 'nice', 'ionice') if key in report)
+
+#
+# Format the resource usage an agent reported for a command.
+#
+def format_usage(usage):
+    "format a command's resource usage"
+
+    return ('wall %.3fs, user %.3fs, sys %.3fs, maxrss %d KiB, blocks in/out %d/%d, '
+            'context switches vol/invol %d/%d'
+            % tuple(usage[field] for field in USAGE_FIELDS))
+
+#
+# Decode a telemetry frame from an agent.
+#
+# Agents send the counters of their first sample in full, then one row per
+# later sample holding the milliseconds since the previous sample and the
+# change of each counter.
+#
+# Params:
+#     payload zlib-compressed JSON telemetry payload.
+#
+# Return:
+#     Dictionary of "interval", "fields" (counter names), and "samples", a
+#     list of (seconds since the first sample, [counter values]).
+#
+def decode_telemetry(payload):
+    "decode delta-encoded agent telemetry"
+
+    encoded = json.loads(zlib.decompress(payload).decode('UTF-8'))
+    samples = []
+    if encoded['fields']:
+        seconds = 0.0
+        values = encoded['base']
+        samples.append((seconds, values))
+        for row in encoded['deltas']:
+            seconds += row[0] / 1000
+            values = [value + delta for value, delta in zip(values, row[1:])]
+            samples.append((seconds, values))
+    return {'interval': encoded['interval'], 'fields': encoded['fields'], 'samples': samples}
+
+#
+# Summarize decoded telemetry: CPU steal and I/O wait over the whole test
+# (and steal in the worst interval), the busiest disk, network traffic, and
+# the lowest available memory.
+#
+def summarize_telemetry(hostTelemetry):
+    "one-line summary of an agent's telemetry"
+
+    fields, samples = hostTelemetry['fields'], hostTelemetry['samples']
+    if len(samples) < 2:
+        return 'too few samples'
+    column = {field: i for i, field in enumerate(fields)}
+
+    def change(field, first, last):
+        return last[column[field]] - first[column[field]]
+
+    def cpu_share(field, first, last):
+        total = sum(change('cpu.' + name, first, last) for name in CPU_FIELDS
+                    if 'cpu.' + name in column)
+        return 100.0 * change('cpu.' + field, first, last) / total if total else 0.0
+
+    first, last = samples[0][1], samples[-1][1]
+    elapsed = samples[-1][0] - samples[0][0]
+    parts = []
+    if 'cpu.steal' in column:
+        worst = max(cpu_share('steal', a[1], b[1]) for a, b in zip(samples, samples[1:]))
+        parts.append('steal %.1f%% (worst interval %.1f%%)' % (cpu_share('steal', first, last), worst))
+    if 'cpu.iowait' in column:
+        parts.append('iowait %.1f%%' % cpu_share('iowait', first, last))
+    disks = [field[len('disk.'):-len('.io_ms')] for field in fields
+             if field.startswith('disk.') and field.endswith('.io_ms')]
+    if disks and elapsed > 0:
+        busy, disk = max((change('disk.%s.io_ms' % disk, first, last), disk) for disk in disks)
+        parts.append('busiest disk %s %.1f%% busy' % (disk, 100.0 * busy / (elapsed * 1000)))
+    received = sum(change(field, first, last) for field in fields if field.endswith('.rx_bytes'))
+    sent = sum(change(field, first, last) for field in fields if field.endswith('.tx_bytes'))
+    parts.append('net rx/tx %.1f/%.1f MiB' % (received / 2**20, sent / 2**20))
+    if 'mem.MemAvailable' in column:
+        lowest = min(values[column['mem.MemAvailable']] for seconds, values in samples)
+        parts.append('min available memory %d MiB' % (lowest // 1024))
+    return ', '.join(parts)
+
+#
+# Encode the specifications for a single target.
+#
+# Params:
+#     target Target whose specifications to encode.
+#     test TestConfig containing the specifications.
+#
+# Return:
+#     Encoded payload bytes.
+#     SHA-256 hex digest of the payload.
+#
+def encode_spec(target, test):
+    "encode the name, commands, timeouts, and options sent to an agent"
+
+    spec = {
+        'name': target,
+        'commands': test.specs[target],
+        'timeouts': [test.timeouts[target][command] for command in test.specs[target]],
+        'launch': [test.launchModes.get(target, {}).get(command, LAUNCH_SHELL)
+                   for command in test.specs[target]],
+        'placement': [test.placements.get(target, {}).get(command)
+                      for command in test.specs[target]],
+        'options': {
+            'session': session,
+            'clockSamples': clock_samples(),
+            'outputCap': outputCap,
+            'armed': armed,
+            'telemetry': telemetry,
+            'udpStart': None if udpStart is None else {
+                'group': udpStart[0],
+                'port': udpStart[1],
+                'key': test.startKey,
+                'id': test.startId
+            }
+        }
+    }
+    payload = bytes(json.dumps(spec), 'UTF-8')
+    return payload, hashlib.sha256(payload).hexdigest()
+
+#
+# Build a single frame.
+#
+# Params:
+#     kind Frame kind.
+#     payload Payload bytes or string.
+#
+# Return:
+#     Frame bytes.
+#
+def pack_frame(kind, payload=b''):
+    "prefix a payload with the frame header"
+
+    if isinstance(payload, str):
+        payload = bytes(payload, 'UTF-8')
+    return struct.pack(FRAME_HEADER, FRAME_MAGIC, PROTOCOL_VERSION, kind,
+                       len(payload)) + payload
+
+#
+# Split complete frames off the front of a receive buffer.
+#
+# Params:
+#     buffer Received bytes.
+#
+# Return:
+#     List of (kind, payload) tuples.
+#     Remaining bytes of any incomplete frame.
+#
+# Raises:
+#     ProtocolError if the buffer does not start with a valid frame header.
+#
+def unpack_frames(buffer):
+    "parse the complete frames in a receive buffer"
+
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER_SIZE:
+        magic, version, kind, length = struct.unpack_from(FRAME_HEADER, buffer, offset)
+        if magic != FRAME_MAGIC or version != PROTOCOL_VERSION:
+            raise ProtocolError('unsupported protocol (magic %r, version %d)'
+                                % (magic, version))
+        end = offset + FRAME_HEADER_SIZE + length
+        if len(buffer) < end:
+            break
+        frames.append((kind, bytes(buffer[offset + FRAME_HEADER_SIZE:end])))
+        offset = end
+    return frames, buffer[offset:]
+
+#
+# Receive a single frame from an asyncio stream.
+#
+# Params:
+#     reader asyncio StreamReader.
+#
+# Return:
+#     Frame kind.
+#     Frame payload.
+#
+async def recv_frame(reader):
+    "read one frame from a stream"
+
+    header = await reader.readexactly(FRAME_HEADER_SIZE)
+    magic, version, kind, length = struct.unpack(FRAME_HEADER, header)
+    if magic != FRAME_MAGIC or version != PROTOCOL_VERSION:
+        raise ProtocolError('unsupported protocol (magic %r, version %d)'
+                            % (magic, version))
+    return kind, await reader.readexactly(length)
+
+#
+# Build the specification frame for a single target.
+#
+# Params:
+#     target Target whose specifications to send.
+#     test TestConfig containing the specifications.
+#
+# Return:
+#     Frame bytes.
+#     SHA-256 hex digest of the payload.
+#
+def spec_message(target, test):
+    "build the single frame carrying an agent's specifications"
+
+    payload, digest = encode_spec(target, test)
+    return pack_frame(FRAME_SPEC, payload), digest
+
+#
+# Check an agent's acknowledgement of its specifications.
+#
+# Params:
+#     target Target that sent the acknowledgement.
+#     kind Kind of the frame received.
+#     payload Payload of the frame received.
+#     digest SHA-256 hex digest of the payload that was sent.
+#
+# Raises:
+#     PrepError if the agent rejected or failed to acknowledge the payload.
+#
+def check_ack(target, kind, payload, digest):
+    "verify the checksum acknowledged by an agent"
+
+    if kind == FRAME_NACK:
+        raise PrepError('ERROR: agent %s rejected test specification: %s. Terminating.'
+                        % (target, payload.decode('UTF-8', 'replace')))
+    fields = payload.split(b' ')
+    if kind != FRAME_ACK or len(fields) != 3 or fields[0] != bytes(digest, 'UTF-8'):
+        raise PrepError('ERROR: agent %s failed to acknowledge test specification. '\
+                        'Unsure of agent identity. Terminating.' % target)
+    try:
+        return float(fields[1]), float(fields[2])
+    except ValueError:
+        raise PrepError('ERROR: agent %s sent an invalid clock sample %r. '\
+                        'Terminating.' % (target, payload))
+
+#
+# Estimate an agent's clock offset from NTP-style samples.
+#
+# Params:
+#     target Target that was sampled.
+#     samples List of (sent, kind, payload, received) tuples, where sent and
+#         received are local times and kind and payload are the agent's reply.
+#     ack (sent, (agentReceived, agentSent), received) times of the spec and
+#         its acknowledgement. The agent's own two times leave the time it
+#         spent before acknowledging out of the estimate.
+#
+# Return:
+#     (offset, RTT) of the lowest-latency sample, where offset is the agent's
+#     clock minus ours.
+#
+# Raises:
+#     PrepError if a reply is malformed.
+#
+def estimate_clock_offset(target, samples, ack):
+    "estimate the offset of an agent's clock relative to ours"
+
+    sent, (agentReceived, agentSent), received = ack
+    estimates = [(((agentReceived - sent) + (agentSent - received)) / 2,
+                  (received - sent) - (agentSent - agentReceived))]
+    for sent, kind, payload, received in samples:
+        try:
+            if kind != FRAME_SYNC:
+                raise ValueError
+            agentTime = float(payload.decode('UTF-8'))
+        except ValueError:
+            raise PrepError('ERROR: agent %s sent an invalid clock sample %r. '\
+                            'Terminating.' % (target, payload))
+        # Assume the reply was stamped halfway through the round trip.
+        estimates.append((agentTime - (sent + received) / 2, received - sent))
+    return min(estimates, key=lambda estimate: estimate[1])
+
+#
+# Number of SYNC clock samples taken after the acknowledgement, which already
+# carries one. Only scheduled starts need the more precise offset.
+#
+def clock_samples():
+    return CLOCK_SAMPLES if scheduledStart is not None else 0
+
+#
+# Earliest start timestamp of a test, against which skew is measured.
+#
+def skew_base(test):
+    "earliest start received or spawn time of a test"
+
+    return min(min([received] + list(spawned.values()))
+               for received, spawned in test.startTimes.values())
+
+#
+# Format min/max/spread statistics for a list of timestamps.
+#
+def format_skew(times, base):
+    "format start skew statistics"
+
+    return ('min +%.6fs, max +%.6fs, spread %.6fs'
+            % (min(times) - base, max(times) - base, max(times) - min(times)))
+
+#
+# Path of the file to which a command's output stream is written.
+#
+# Params:
+#     test TestConfig being run.
+#     target Target running the command.
+#     index Index of the command in the target's specifications.
+#     stream STREAM_STDOUT, STREAM_STDERR, or STREAM_NONE for the timeline of
+#         both streams.
+#
+# Return:
+#     DIR/[TARGET]/[LABEL]_[TIMESTAMP]_[INDEX].[stdout|stderr|timeline]
+#
+def stream_path(test, target, index, stream):
+    "output file path for a streamed command"
+
+    extension = {STREAM_STDOUT: 'stdout', STREAM_STDERR: 'stderr'}.get(stream, 'timeline')
+    name = '%s_%s_%d.%s' % (test.label, test.timestamp.replace(':', '.'), index, extension)
+    return os.path.join(streamDir, re.sub(r'[\\/:]', '_', target), name)
+
+#
+# Build the start frame payload for a single target.
+#
+# Params:
+#     test TestConfig being started.
+#     target Target to start.
+#     startAt Coordinator time at which to start, or None to start immediately.
+#
+# Return:
+#     Empty payload, or the start time on the agent's clock if scheduled.
+#
+def start_payload(test, target, startAt):
+    "build the start frame payload for a target"
+
+    if startAt is None:
+        return b''
+    offset, rtt = test.clockOffsets[target]
+    return '%.6f' % (startAt + offset)
+
+#
+# Send the UDP start datagram for a test, repeated for loss tolerance.
+#
+# Params:
+#     test TestConfig being started.
+#
+def send_udp_start(test):
+    "fire the authenticated start datagram at every agent at once"
+
+    message = START_STRING + SOCKET_DELIMITER + test.startId
+    signature = hmac.new(bytes.fromhex(test.startKey), bytes(message, 'UTF-8'),
+                         hashlib.sha256).hexdigest()
+    datagram = bytes(message + SOCKET_DELIMITER + signature, 'UTF-8')
+
+    group, port = udpStart
+    udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if ipaddress.ip_address(group).is_multicast:
+            # Stay on the local vLAN.
+            udpSock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        for i in range(UDP_START_REPEAT):
+            if i > 0:
+                time.sleep(UDP_START_INTERVAL)
+            udpSock.sendto(datagram, (group, port))
+    except OSError as e:
+        print('\t\tWARNING: failed to send UDP start: %s.' % e)
+    finally:
+        udpSock.close()
+
 #
 # Print CLI usage instructions.
 #
@@ -736,6 +3055,45 @@ def instructions():
     print(r'    -h    Display this message.')
     print(r'    -s    Run in simulator mode (disables networking).')
     print(r'    -v    Run in verbose mode.')
+    print(r'    -l    Enable logging of results to a file.')
+    print(r'    -p    Keep one persistent connection per agent for the whole run.')
+    print(r'    --engine=[threads|async]')
+    print(r'          Select the coordinator engine. "threads" (default) uses one')
+    print(r'          listener thread per target; "async" drives every target from a')
+    print(r'          single asyncio event loop.')
+    print(r'    --scheduled-start[=SECONDS]')
+    print(r'          Estimate each agent\'s clock offset during preparation and')
+    print(r'          tell every agent to start at the same instant, SECONDS (default')
+    print(r'          1) after the start messages are sent.')
+    print(r'    --udp-start=GROUP[:PORT]')
+    print(r'          Start all agents with one authenticated UDP datagram sent to a')
+    print(r'          multicast group or broadcast address (default port 16193).')
+    print(r'    --stream=DIR')
+    print(r'          Write job output to per-host files under DIR as it arrives,')
+    print(r'          instead of collecting it in memory.')
+    print(r'    --stream-console')
+    print(r'          Echo job output to the console as it arrives.')
+    print(r'    --output-cap=BYTES')
+    print(r'          Keep at most BYTES of each job\'s standard output and standard')
+    print(r'          error. Agents keep reading past the cap but discard the rest.')
+    print(r'    --armed')
+    print(r'          Have agents spawn every job during preparation, held at a gate,')
+    print(r'          so the start only releases already-running processes.')
+    print(r'    --telemetry[=SECONDS]')
+    print(r'          Have agents sample CPU (including steal time), memory, disk and')
+    print(r'          network counters every SECONDS (default 1) while each test runs.')
+    print(r'    --progress')
+    print(r'          Show a live progress line (elapsed time, pending jobs, hosts')
+    print(r'          lost, slowest host) and print the results once each test ends.')
+    print(r'    --db=PATH')
+    print(r'          Record every run, result, resource usage, timing and telemetry')
+    print(r'          sample in the SQLite database PATH (created if missing).')
+    print(r'    --parallel[=N]')
+    print(r'          Run up to N (default: any number of) tests at the same time,')
+    print(r'          as long as they share no targets. See -after and -exclusive.')
+    print(r'    --no-config-cache')
+    print(r'          Always parse the configuration file, instead of loading its')
+    print(r'          compiled form from the config cache.')
     print(r'PATH')
     print(r'    Relative or absolute path to source file (required).')
     print()
@@ -12,11 +12,13 @@
 # For: Deepstorage, LLC (deepstorage.net)                                      #
 # Version: 2.3                                                                 #
 #                                                                              #
-# Usage: NetJobsAgent.py                                                       #
+# Usage: NetJobsAgent.py [--echo] [--max-sessions=N] [--bind=ADDRESS]          #
+#                        [--port=PORT] [--status[=HOST[:PORT]]]                #
 #                                                                              #
 # Example: $ NetJobsAgent.py                                                   #
 # ############################################################################ #
 
+import sys
 import socket
 import select
 import subprocess
@@ -24,6 +26,17 @@ import signal
 import threading
 import os
 import time
+import json
+import hashlib
+import hmac
+import ipaddress
+import struct
+import shlex
+import shutil
+import platform
+import ctypes
+import zlib
+import selectors
 
 from subprocess import PIPE
 
@@ -35,128 +48,513 @@ SOCKET_TIMEOUT = 60
 TIMEOUT_NONE = 0
 SOCKET_DELIMITER = '\t'
 CONNECTION_CLOSE_DELAY = 3
-READY_STRING = '// READY //'
+# Many coordinator sessions may connect at once; a short backlog drops their
+# SYNs and delays preparation by a retransmit timeout.
+LISTEN_BACKLOG = socket.SOMAXCONN
+# Final stretch before a scheduled start that is busy-waited for precision.
+START_SPIN_WINDOW = 0.002
+CHUNK_SIZE = 65536
 START_STRING = '// START //'
-KILL_STRING = '// KILL //'
-DONE_STRING = '// DONE //'
-PING_STATUS_STRING = '// STATUS //'
-PING_OK_STRING = 'OK'
+# Command launch modes: through a shell, or split into arguments and run directly.
+LAUNCH_SHELL = 'shell'
+LAUNCH_ARGV = 'argv'
+# I/O scheduling classes accepted by -ionice, as ioprio_set(2) classes.
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_DEFAULT_LEVEL = 4
+# ioprio_set(2) system call numbers, which Python does not wrap.
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                       'riscv64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+NUMA_CPULIST_PATH = '/sys/devices/system/node/node%d/cpulist'
+# Host counters sampled by the telemetry sampler. The columns of the aggregate
+# "cpu" line of /proc/stat, in jiffies.
+PROC_STAT_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+PROC_MEMINFO_FIELDS = ('MemTotal', 'MemFree', 'MemAvailable', 'Cached', 'Dirty', 'Writeback')
+# Columns of /proc/diskstats after the device name.
+PROC_DISKSTATS_FIELDS = {'reads': 0, 'read_sectors': 2, 'writes': 4, 'write_sectors': 6,
+                         'io_ms': 9, 'weighted_io_ms': 10}
+# Columns of /proc/net/dev after the interface name.
+PROC_NET_DEV_FIELDS = {'rx_bytes': 0, 'rx_packets': 1, 'tx_bytes': 8, 'tx_packets': 9}
+# Virtual block devices that are not worth sampling.
+IGNORED_DISK_PREFIXES = ('loop', 'ram', 'zram')
+# Shell prefix that holds an armed command until its standard input closes.
+GATE_PREFIX = 'read -r netjobsGate; '
+# Frame protocol. Every message is a FRAME_HEADER (magic, protocol version,
+# kind, payload length) followed by the payload.
+FRAME_MAGIC = b'NJ'
+PROTOCOL_VERSION = 3
+FRAME_HEADER = '!2sBBI'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+# Command index, stream, and seconds since the command was spawned.
+CHUNK_HEADER = '!IBd'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER)
+FRAME_SPEC = 1
+FRAME_ACK = 2
+FRAME_NACK = 3
+FRAME_SYNC = 4
+FRAME_START = 5
+FRAME_KILL = 6
+FRAME_PING = 7
+FRAME_PONG = 8
+FRAME_TIMING = 9
+FRAME_CHUNK = 10
+FRAME_RESULT = 11
+FRAME_DONE = 12
+FRAME_BYE = 13
+FRAME_STATUS = 14
+FRAME_TELEMETRY = 15
+STREAM_NONE = 0
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
 SUCCESS_STATUS = 'SUCCESS'
 ERROR_STATUS = 'ERROR'
 TIMEOUT_STATUS = 'TIMEOUT'
 KILLED_STATUS = 'KILLED'
+USAGE = ('Usage: NetJobsAgent.py [--echo] [--max-sessions=N] [--bind=ADDRESS] [--port=PORT] '
+         '[--status[=HOST[:PORT]]]')
 
-# Used to track the number of active subprocesses.
-processcount = 0
+# Echo job output to the console as it is captured.
+echo = False
+
+# Admission queue shared by all sessions.
+admission = None
 
 #
-# Get run specifications from remote process.
+# Send a single frame to the client.
 #
 # Params:
-#     conn Socket connection to remote process.
+#     sock Socket on which we're communicating with the client.
+#     kind Frame kind.
+#     payload Payload bytes or string.
+#
+def send_frame(sock, kind, payload=b''):
+    if isinstance(payload, str):
+        payload = bytes(payload, 'UTF-8')
+    header = struct.pack(FRAME_HEADER, FRAME_MAGIC, PROTOCOL_VERSION, kind, len(payload))
+    sock.sendall(header + payload)
+
+#
+# Split complete frames off the front of a receive buffer.
+#
+# Params:
+#     buffer Received bytes.
 #
 # Return:
-#     List of command strings.
-#     List of timeouts.
+#     List of (kind, payload) tuples.
+#     Remaining bytes of any incomplete frame.
 #
-def get_specs(conn):
-    global name
-    global ready
-    global sosTimeout
+def unpack_frames(buffer):
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER_SIZE:
+        magic, version, kind, length = struct.unpack_from(FRAME_HEADER, buffer, offset)
+        if magic != FRAME_MAGIC or version != PROTOCOL_VERSION:
+            raise ProtocolError('unsupported protocol (magic %r, version %d)'
+                                % (magic, version))
+        end = offset + FRAME_HEADER_SIZE + length
+        if len(buffer) < end:
+            break
+        frames.append((kind, bytes(buffer[offset + FRAME_HEADER_SIZE:end])))
+        offset = end
+    return frames, buffer[offset:]
 
-    sosTimeout = TIMEOUT_NONE
+#
+# Receive a single frame.
+#
+# Params:
+#     conn Socket connection to remote process.
+#     received Bytes already received.
+#
+# Return:
+#     Frame kind.
+#     Frame payload.
+#     Any bytes received after the frame.
+#
+def recv_frame(conn, received=b''):
+    while True:
+        frames, remainder = unpack_frames(received)
+        if frames:
+            kind, payload = frames[0]
+            return kind, payload, received[FRAME_HEADER_SIZE + len(payload):]
+        chunk = conn.recv(max(BUFFER_SIZE, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError('connection closed by remote host')
+        received += chunk
 
-    commands = []
-    timeouts = []
+#
+# Open the UDP socket on which to listen for a start datagram.
+#
+# Params:
+#     group Multicast group, broadcast address, or unicast address.
+#     port UDP port.
+#
+# Return:
+#     Bound UDP socket.
+#
+def open_start_channel(group, port):
+    udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Several agents on one host may listen on the same group.
+        udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udpSock.bind(('', port))
+        if ipaddress.ip_address(group).is_multicast:
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            udpSock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except Exception:
+        udpSock.close()
+        raise
+    return udpSock
 
-    receiveBuffer = ''
+#
+# Check whether a UDP datagram is the authentic start for this test.
+#
+# Params:
+#     datagram Received bytes: START<TAB>[TEST ID]<TAB>[HMAC-SHA256].
+#     udpStart UDP start options received with the specifications.
+#
+# Return:
+#     True if the datagram carries this test's ID and a valid signature.
+#
+def is_start_datagram(datagram, udpStart):
+    try:
+        message, signature = datagram.decode('UTF-8').rsplit(SOCKET_DELIMITER, 1)
+    except (UnicodeDecodeError, ValueError):
+        return False
+    expected = hmac.new(bytes.fromhex(udpStart['key']), bytes(message, 'UTF-8'),
+                        hashlib.sha256).hexdigest()
+    return (message == START_STRING + SOCKET_DELIMITER + udpStart['id']
+            and hmac.compare_digest(signature, expected))
 
-    while not ready:
+#
+# Spawn every command of a test block behind a gate, for armed mode.
+#
+# Each shell starts, parses its command, and then blocks reading its
+# standard input, which is a pipe held by the agent. Closing the pipe opens
+# the gate, so the start command only has to release already-running shells.
+#
+# Params:
+#     commands List of command strings.
+#     timeouts List of timeouts for each command.
+#     launchModes List of launch modes for each command.
+#     placements List of resolved placements for each command.
+#
+# Return:
+#     List of Jobs. A Job whose process could not be spawned has no process
+#     and carries the error as its detail.
+#
+def arm_jobs(commands, timeouts, launchModes, placements):
+    jobs = []
+    for i in range(0, min(len(commands), len(timeouts))):
+        job = Job(i, commands[i], timeouts[i], launchModes[i], placements[i])
         try:
-            # Since the client waits for each setup string to be echoed before
-            # sending the next one, we don't need to lexify the string on newlines
-            # the way we do later when listening to the socket asynchronously.
-            receiveBuffer = conn.recv(BUFFER_SIZE)
-            conn.sendall(receiveBuffer) # Echo test.
-            receiveString = receiveBuffer.decode('UTF-8').replace('\n', '')
+            job.proc = spawn(job, gated=True)
         except Exception as e:
-            print("ERROR: an exception occurred while trying to receive specs: %s" % str(e))
-            break
+            print('\nERROR: an exception occurred while trying to spawn the subprocess for "%s": %s\n'\
+                  % (job.command, str(e)))
+            job.detail = str(e)
+        jobs.append(job)
+    return jobs
 
-        print('\tReceived: "%s".' % receiveString)
+#
+# Spawn the process for a job.
+#
+# In argv mode the command is split into arguments and run without a shell.
+# The executable is resolved up front and descriptors are inherited (the
+# agent's own are all non-inheritable), which lets subprocess launch it with
+# posix_spawn, i.e. vfork semantics, instead of fork and exec.
+#
+# Params:
+#     job Job to spawn.
+#     gated Whether to hold the process at a gate until its standard input
+#         is closed, for armed mode.
+#
+# Return:
+#     Popen object.
+#
+def spawn(job, gated=False):
+    # A placed job is held at the gate while its placement is applied, so the
+    # command itself never runs unplaced.
+    held = gated or job.placement is not None
+    proc = launch(job, held)
+    if job.placement is not None:
+        try:
+            job.placementReport = apply_placement(proc.pid, job.placement)
+        except Exception:
+            proc.kill()
+            proc.wait()
+            raise
+        if not gated:
+            proc.stdin.close()
+    return proc
 
-        if receiveString == READY_STRING:
-            ready = True
-            print('\t\t--> Ready string received. Awaiting start message.')
-        else:
-            tokens = receiveString.replace('\n', '').split(SOCKET_DELIMITER)
-            if len(tokens) < 2:
-                print('\t\t--> WARNING: invalid message received -- insufficient number of tokens.')
-                break
-            elif tokens[0] == 'name':
-                name = tokens[1]
-                print('\t\t--> Registering name: %s.' % tokens[1])
-            elif tokens[0] == 'command':
-                command = tokens[1]
-                commands.append(command)
-                print('\t\t--> Registering command: "%s".' % command)
-            elif tokens[0] == 'timeout':
-                try:
-                    timeout = int(tokens[1])
-                    if timeout == TIMEOUT_NONE:
-                        timeouts.append(None)
-                        print('\t\t--> Registering timeout: None.')
-                    else:
-                        timeouts.append(timeout)
-                        print('\t\t--> Registering timeout: %d second(s).' % timeout)
-                        # Check if sosTimeout needs to be updated.
-                        if not sosTimeout == TIMEOUT_NONE and timeout > sosTimeout:
-                            sosTimeout = timeout
-                except ValueError as e:
-                    print('ERROR: invalid timeout.')
-                    break
-            else:
-                print('\t\t--> WARNING: unknown message received. Breaking.')
-                break
+#
+# Start a job's process, optionally held at its gate.
+#
+def launch(job, gated):
+    stdin = PIPE if gated else None
+    if job.launch != LAUNCH_ARGV:
+        command = GATE_PREFIX + job.command if gated else job.command
+        return subprocess.Popen(command, shell=True, stdin=stdin, stdout=PIPE, stderr=PIPE)
 
-    print() # Blank line.
+    args = shlex.split(job.command)
+    executable = shutil.which(args[0])
+    if executable is None:
+        raise FileNotFoundError('%s: command not found' % args[0])
+    if gated:
+        # The gate needs a shell, which then replaces itself with the command.
+        args = ['/bin/sh', '-c', GATE_PREFIX + 'exec "$@"', 'sh', executable] + args[1:]
+        executable = '/bin/sh'
+    return subprocess.Popen(args, executable=executable, close_fds=False,
+                            stdin=stdin, stdout=PIPE, stderr=PIPE)
+
+#
+# Parse a CPU list such as "0-3,6".
+#
+# Params:
+#     cpuList CPU list string, in the format used by taskset and sysfs.
+#
+# Return:
+#     Set of CPU numbers.
+#
+def parse_cpu_list(cpuList):
+    cpus = set()
+    for part in cpuList.strip().split(','):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
 
-    return commands, timeouts
+#
+# Format a set of CPU numbers as a CPU list such as "0-3,6".
+#
+def format_cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
 
 #
-# Execute the main run.
+# Check a command's requested placement against this host, and work out what
+# to apply. Called when the specifications arrive, so a placement the host
+# cannot honour is rejected before the run.
 #
 # Params:
-#     sock Socket on which we're with communicating client.
-#     commands List of commands to execute.
-#     timeouts List of timeouts for each command.
+#     placement Requested placement: any of "cpus", "numa", "nice", and
+#         "ionice", or None.
 #
-# Returns:
-#     List of subprocess threads.
+# Return:
+#     Resolved placement: the requested values plus the CPU set ("cpuSet")
+#     and I/O priority ("ioprio") to apply, or None.
 #
-def start_run(sock, commands, timeouts):
-    global subthreads
-    global processcount
+def resolve_placement(placement):
+    if not placement:
+        return None
+    resolved = dict(placement)
+    cpus = None
+    if 'cpus' in placement:
+        cpus = parse_cpu_list(placement['cpus'])
+    if 'numa' in placement:
+        try:
+            with open(NUMA_CPULIST_PATH % placement['numa']) as f:
+                nodeCpus = parse_cpu_list(f.read())
+        except (OSError, ValueError):
+            raise ValueError('NUMA node %d not found' % placement['numa'])
+        # Running on the node's CPUs keeps the default local-allocation memory
+        # policy on the node's memory as well.
+        cpus = nodeCpus if cpus is None else cpus & nodeCpus
+    if cpus is not None:
+        cpus &= os.sched_getaffinity(0)
+        if not cpus:
+            raise ValueError('no requested CPU is available')
+        resolved['cpuSet'] = cpus
+    if 'ionice' in placement:
+        name, _, level = placement['ionice'].partition(':')
+        if platform.machine() not in IOPRIO_SET_SYSCALLS:
+            raise ValueError('-ionice is not supported on %s' % platform.machine())
+        level = 0 if name == 'idle' else int(level or IOPRIO_DEFAULT_LEVEL)
+        resolved['ioprio'] = (IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT) | level
+    return resolved
+
+#
+# Apply a resolved placement to a process held at its gate.
+#
+# Params:
+#     pid Process ID.
+#     placement Resolved placement.
+#
+# Return:
+#     Placement report: the CPUs and niceness the process ended up with, as
+#     read back from the process, plus any NUMA node and I/O class applied.
+#
+def apply_placement(pid, placement):
+    report = {}
+    if 'cpuSet' in placement:
+        os.sched_setaffinity(pid, placement['cpuSet'])
+    if 'nice' in placement:
+        os.setpriority(os.PRIO_PROCESS, pid, placement['nice'])
+    if 'ioprio' in placement:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(IOPRIO_SET_SYSCALLS[platform.machine()], IOPRIO_WHO_PROCESS,
+                        pid, placement['ioprio']) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'ioprio_set: %s' % os.strerror(errno))
+        report['ionice'] = placement['ionice']
+    if 'numa' in placement:
+        report['numa'] = placement['numa']
+    report['cpus'] = format_cpu_list(os.sched_getaffinity(pid))
+    report['nice'] = os.getpriority(os.PRIO_PROCESS, pid)
+    return report
 
-    results = []
-    output = []
-    # The lists should be the same length, but do a sanity check, just in case.
-    processcount = min(len(commands), len(timeouts))
+#
+# Read the host counters sampled by the telemetry sampler.
+#
+# Return:
+#     Dictionary of integer counters and gauges: "cpu.[FIELD]",
+#     "mem.[FIELD]" (kB), "disk.[DEVICE].[FIELD]", and "net.[IFACE].[FIELD]".
+#     Files that cannot be read are skipped.
+#
+def read_host_counters():
+    counters = {}
+    try:
+        with open('/proc/stat') as f:
+            for line in f:
+                name, *values = line.split()
+                if name == 'cpu':
+                    for field, value in zip(PROC_STAT_FIELDS, values):
+                        counters['cpu.' + field] = int(value)
+                elif name in ('ctxt', 'procs_running', 'procs_blocked'):
+                    counters['cpu.' + name] = int(values[0])
+    except OSError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in PROC_MEMINFO_FIELDS:
+                    counters['mem.' + name] = int(value.split()[0])
+    except OSError:
+        pass
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                values = line.split()
+                device, values = values[2], values[3:]
+                if device.startswith(IGNORED_DISK_PREFIXES):
+                    continue
+                for field, column in PROC_DISKSTATS_FIELDS.items():
+                    counters['disk.%s.%s' % (device, field)] = int(values[column])
+    except OSError:
+        pass
+    try:
+        with open('/proc/net/dev') as f:
+            for line in f:
+                iface, sep, values = line.partition(':')
+                if not sep or iface.strip() == 'lo':
+                    continue
+                values = values.split()
+                for field, column in PROC_NET_DEV_FIELDS.items():
+                    counters['net.%s.%s' % (iface.strip(), field)] = int(values[column])
+    except (OSError, IndexError):
+        pass
+    return counters
 
-    print('\n---RESULTS---\n')
+#
+# Split "HOST", "HOST:PORT", "[IPV6]", or "[IPV6]:PORT" into host and port.
+#
+# Params:
+#     target Address to split.
+#     defaultPort Port if none is given.
+#
+def parse_target(target, defaultPort):
+    host, port = target, ''
+    if target.startswith('['):
+        host, bracket, port = target[1:].partition(']')
+        if not bracket or (port and not port.startswith(':')):
+            raise ValueError('unterminated IPv6 address')
+        port = port[1:]
+    elif target.count(':') == 1:
+        host, _, port = target.partition(':')
+    port = int(port) if port else defaultPort
+    if not host or not 0 < port < 65536:
+        raise ValueError('invalid address')
+    return host, port
 
-    for i in range(0, processcount):
-        command = commands[i]
-        timeout = timeouts[i]
+#
+# Open the socket on which scheduler connections are accepted. With no bind
+# address, listen on every IPv6 and IPv4 interface where the host supports
+# dual-stack sockets, and on every IPv4 interface otherwise.
+#
+# Params:
+#     address Address to bind to, or '' for all interfaces.
+#     port TCP port.
+#
+# Return:
+#     Listening socket.
+#
+def open_listen_socket(address, port):
+    if address:
+        family, kind, proto, canonname, sockaddr = socket.getaddrinfo(
+            address.strip('[]'), port, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+        candidates = [(family, sockaddr)]
+    else:
+        candidates = [(socket.AF_INET, ('', port))]
+        if socket.has_ipv6:
+            candidates.insert(0, (socket.AF_INET6, ('::', port)))
 
+    for i, (family, sockaddr) in enumerate(candidates):
+        listenSock = socket.socket(family, socket.SOCK_STREAM)
         try:
-            proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except Exception as e:
-            print('\nERROR: an exception occurred while trying to spawn the subprocess thread for "%s": %s\n'\
-                  % (command, str(e)))
-        thread = ProcThread(sock, command, timeout, proc)
-        subthreads.append(thread)
-        thread.start()
+            # Allow an immediate restart while old connections linger in TIME_WAIT.
+            listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6 and not address:
+                listenSock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            listenSock.bind(sockaddr)
+            listenSock.listen(LISTEN_BACKLOG)
+            return listenSock
+        except OSError:
+            listenSock.close()
+            if i == len(candidates) - 1:
+                raise
+
+#
+# Format a socket address as "HOST:PORT", or "[IPV6]:PORT".
+#
+def format_address(addr):
+    host = addr[0]
+    if host.startswith('::ffff:') and '.' in host:
+        # IPv4 peer of a dual-stack socket.
+        host = host[len('::ffff:'):]
+    elif ':' in host:
+        host = '[%s]' % host
+    return '%s:%d' % (host, addr[1])
+
+#
+# Query the status of a running agent and print it.
+#
+# Params:
+#     host Host name or IP address of the agent.
+#     port Port on which the agent listens.
+#
+def print_status(host, port):
+    try:
+        sock = socket.create_connection((host, port), SOCKET_TIMEOUT)
+        send_frame(sock, FRAME_STATUS)
+        kind, payload, remainder = recv_frame(sock)
+        sock.close()
+        status = json.loads(payload.decode('UTF-8'))
+    except Exception as e:
+        exit('ERROR: unable to query the status of %s: %s.' % (host, str(e)))
+
+    print('%s: %d running, %d queued, %d session(s) allowed at once.'
+          % (format_address((host, port)), status['running'], status['queued'], status['maxSessions']))
+    for entry in status['sessions']:
+        print('\t%s\t%s\t%s\t%d job(s) active' % (entry['peer'], entry['name'] or '-',
+                                                  entry['state'], entry['active']))
 
 #
 # Main.
@@ -164,28 +562,55 @@ def start_run(sock, commands, timeouts):
 def main():
     "main function"
 
-    global name
-    global ready
-    global results
-    global subthreads
+    global echo
+    global admission
+
+    # Jobs are supervised through selectors on their pipes and reaped with
+    # wait4, neither of which Windows supports.
+    if os.name != 'posix':
+        exit('ERROR: NetJobsAgent requires a POSIX system such as Linux.')
+
+    maxSessions = 1
+    # Listen on every interface unless told otherwise.
+    bindAddress = ''
+    listenPort = AGENT_LISTEN_PORT
+    statusHost = None
+    for arg in sys.argv[1:]:
+        option, _, value = arg.partition('=')
+        if arg == '--echo':
+            echo = True
+        elif option == '--max-sessions' and value.isdigit() and int(value) > 0:
+            maxSessions = int(value)
+        elif option == '--bind' and value:
+            bindAddress = value
+        elif option == '--port' and value.isdigit() and 0 < int(value) < 65536:
+            listenPort = int(value)
+        elif option == '--status':
+            statusHost = value or 'localhost'
+        else:
+            exit(USAGE)
+
+    if statusHost is not None:
+        try:
+            host, port = parse_target(statusHost, listenPort)
+        except ValueError:
+            exit(USAGE)
+        print_status(host, port)
+        return
+
+    admission = Admission(maxSessions)
 
     try:
-        listenSock = socket.socket()
-        listenPort = AGENT_LISTEN_PORT
-        listenSock.bind(('', listenPort))
-        listenSock.listen(1) # Only allow single connection.
+        listenSock = open_listen_socket(bindAddress, listenPort)
     except OSError as e:
         exit('CRITICAL ERROR: NetJobsAgent failed to initialize: %s.' % str(e))
 
-    while True:
-        print('// NetJobsAgent: listening for scheduler connection on port %d.' \
-              % listenPort)
-        print('//     Process blocks indefinitely. Exit with ctrl-C/ctrl-break.\n')
-        name = ''
-        subthreads = []
-        results = {}
-        ready = False
+    print('// NetJobsAgent: listening for scheduler connections on %s port %d.' \
+          % (bindAddress or 'all interfaces,', listenPort))
+    print('//     Running up to %d session(s) at once.' % maxSessions)
+    print('//     Process blocks indefinitely. Exit with ctrl-C/ctrl-break.\n')
 
+    while True:
         # Establish connection with client.
         try:
             sock, addr = listenSock.accept()
@@ -194,205 +619,971 @@ def main():
             continue
      
         print('Got connection from %s. Communicating on port %s.\n' \
-              % (addr, listenPort))
+              % (format_address(addr), listenPort))
 
-        # Set the socket timeout.
-        sock.settimeout(SOCKET_TIMEOUT)
+        # Each connection is served by its own session thread, so a busy
+        # session never keeps another client waiting in the backlog.
+        Session(sock, addr).start()
 
-        # Get the run specifications.
-        commands, timeouts = get_specs(sock)
 
-        # Spawn the SOSThread.
-        sosThread = SOSThread(sock, sosTimeout, commands, timeouts)
+# ############################################################################ #
+# Admission class for limiting the number of concurrently running sessions.    #
+# ############################################################################ #
+class Admission:
+    "first-come, first-served queue of sessions waiting to run a test block"
+
+    def __init__(self, maxSessions):
+        self.maxSessions = maxSessions
+        self.condition = threading.Condition()
+        self.running = []
+        self.queued = []
+
+    #
+    # Wait until the session may run, or until it gives up.
+    #
+    # Params:
+    #     session Session requesting admission.
+    #     abandoned Function returning True if the session no longer needs
+    #         admission. Checked every SELECT_TIMEOUT seconds while queued.
+    #
+    # Return:
+    #     True if admitted.
+    #
+    def acquire(self, session, abandoned):
+        with self.condition:
+            self.queued.append(session)
+            try:
+                while self.queued[0] is not session or len(self.running) >= self.maxSessions:
+                    if abandoned():
+                        return False
+                    self.condition.wait(SELECT_TIMEOUT)
+                self.running.append(session)
+                return True
+            finally:
+                self.queued.remove(session)
+                self.condition.notify_all()
+
+    def release(self, session):
+        with self.condition:
+            if session in self.running:
+                self.running.remove(session)
+                self.condition.notify_all()
 
-        # Listen for go command.
-        sosThread.start()
+    #
+    # Snapshot of the admission state, for status queries.
+    #
+    def status(self):
+        with self.condition:
+            return {
+                'maxSessions': self.maxSessions,
+                'running': len(self.running),
+                'queued': len(self.queued),
+                'sessions': [session.status() for session in self.running + self.queued]
+            }
+
+
+# ############################################################################ #
+# Session class for serving a single client connection.                        #
+# ############################################################################ #
+class Session(threading.Thread):
+    "runs the test blocks sent by one client, isolated from other sessions"
 
-        # Block until sosThread has finished starting.
-        while not sosThread.started:
-            time.sleep(0) # Yield.
+    def __init__(self, sock, addr):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.peer = format_address(addr)
+        self.name = ''
+        self.ready = False
+        self.persistent = False
+        self.sosTimeout = TIMEOUT_NONE
+        self.udpStart = None
+        self.udpSock = None
+        self.outputCap = None
+        self.launchModes = None
+        self.placements = None
+        self.telemetryInterval = None
+        # Jobs spawned ahead of the start command in armed mode, or None.
+        self.armedJobs = None
+        self.state = 'connected'
+        self.supervisor = None
 
-        # Block until all subprocesses complete.
-        for t in subthreads:
-            t.join()
+    def run(self):
+        sock = self.sock
 
-        # Stop SOSThread
-        sosThread.stop()
-        sosThread.join()
+        # Detect a vanished client while idling between test blocks of a session.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
-        # Close the connection.
         try:
-            # Wait for any remaining processes.
-            if processcount > 0:
-                while processcount > 0:
-                    time.sleep(0) # Yield.
-            # Notify client to stop listener thread for this agent.
-            print('\nActive processes: %d. Notifying client.\n' % (processcount))
-            sock.sendall(bytes(DONE_STRING + '\n', 'UTF-8'))
-            for i in range(CONNECTION_CLOSE_DELAY):
-                print('Closing connection in %d...' % (CONNECTION_CLOSE_DELAY-i))
-                time.sleep(1)
-            sock.close()
+            # Set the socket timeout.
+            sock.settimeout(SOCKET_TIMEOUT)
+
+            # In a persistent session, keep running test blocks on this
+            # connection until the client says goodbye or disconnects.
+            while self.run_test():
+                print('Session active. Awaiting next test block.\n')
+                sock.settimeout(None)
+
+            if not self.ready:
+                sock.close()
+            else:
+                # Close the connection.
+                for i in range(CONNECTION_CLOSE_DELAY):
+                    print('Closing connection in %d...' % (CONNECTION_CLOSE_DELAY-i))
+                    time.sleep(1)
+                sock.close()
         except Exception as e:
             print(str(e))
-            pass
-        print('\nConnection closed. Returning to wait mode.\n')
+            try:
+                sock.close()
+            except Exception:
+                pass
+        print('\nConnection from %s closed.\n' % self.peer)
+
+    #
+    # Summary of the session, for status queries.
+    #
+    def status(self):
+        supervisor = self.supervisor
+        return {
+            'peer': self.peer,
+            'name': self.name,
+            'state': self.state,
+            'active': supervisor.active if supervisor is not None else 0
+        }
+
+    #
+    # Get run specifications from remote process.
+    #
+    # The whole specification arrives as a single spec frame with a JSON
+    # payload, and is acknowledged with the SHA-256 checksum of the payload
+    # as received once the session has been admitted to run.
+    #
+    # Return:
+    #     List of command strings.
+    #     List of timeouts.
+    #
+    def get_specs(self):
+        conn = self.sock
+        self.sosTimeout = TIMEOUT_NONE
+
+        commands = []
+        timeouts = []
+
+        try:
+            kind, payload, remainder = recv_frame(conn)
+            # Skip status pings that arrived after the previous test block ended.
+            while kind == FRAME_PING:
+                kind, payload, remainder = recv_frame(conn, remainder)
+            if kind == FRAME_STATUS:
+                # Answered straight away, whatever other sessions are doing.
+                send_frame(conn, FRAME_STATUS, json.dumps(admission.status()))
+                return commands, timeouts
+            if kind == FRAME_BYE:
+                print('Session ended by remote client.')
+                return commands, timeouts
+            # The next test block of a session is bounded by the normal timeout.
+            conn.settimeout(SOCKET_TIMEOUT)
+            if kind != FRAME_SPEC:
+                raise ValueError('expected specification but received frame kind %d' % kind)
+            specReceived = time.time()
+            digest = hashlib.sha256(payload).hexdigest()
+            spec = json.loads(payload.decode('UTF-8'))
+            if len(spec['commands']) != len(spec['timeouts']):
+                raise ValueError('command and timeout counts differ')
+            if len(spec.get('launch') or spec['commands']) != len(spec['commands']):
+                raise ValueError('command and launch mode counts differ')
+            placements = [resolve_placement(placement) for placement
+                          in spec.get('placement') or [None] * len(spec['commands'])]
+            if len(placements) != len(spec['commands']):
+                raise ValueError('command and placement counts differ')
+        except ConnectionError as e:
+            print('Connection closed by remote client.')
+            return commands, timeouts
+        except Exception as e:
+            print("ERROR: an exception occurred while trying to receive specs: %s" % str(e))
+            try:
+                send_frame(conn, FRAME_NACK, str(e))
+            except Exception:
+                pass
+            return commands, timeouts
+
+        self.name = spec['name']
+        self.persistent = spec['options'].get('session', False)
+        self.udpStart = spec['options'].get('udpStart')
+        self.outputCap = spec['options'].get('outputCap')
+        self.launchModes = spec.get('launch') or [LAUNCH_SHELL] * len(spec['commands'])
+        self.telemetryInterval = spec['options'].get('telemetry')
+        self.placements = placements
+        armed = spec['options'].get('armed', False)
+        print('\t--> Registering name: %s.' % self.name)
+        for command, timeout in zip(spec['commands'], spec['timeouts']):
+            commands.append(command)
+            print('\t--> Registering command: "%s".' % command)
+            if self.launchModes[len(commands) - 1] == LAUNCH_ARGV:
+                print('\t\t--> Registering launch mode: argv.')
+            placement = self.placements[len(commands) - 1]
+            if placement is not None:
+                print('\t\t--> Registering placement: %s.' % ', '.join(
+                    '%s %s' % (key, placement[key])
+                    for key in ('cpus', 'numa', 'nice', 'ionice') if key in placement))
+            if timeout == TIMEOUT_NONE:
+                timeouts.append(None)
+                print('\t\t--> Registering timeout: None.')
+            else:
+                timeouts.append(timeout)
+                print('\t\t--> Registering timeout: %d second(s).' % timeout)
+                # Check if sosTimeout needs to be updated.
+                if not self.sosTimeout == TIMEOUT_NONE and timeout > self.sosTimeout:
+                    self.sosTimeout = timeout
+
+        # Wait for a free slot before acknowledging, so the client's
+        # preparation does not complete until this session can run.
+        self.state = 'queued'
+        if not admission.acquire(self, self.abandoned):
+            print('Connection from %s closed while queued.' % self.peer)
+            return commands, timeouts
+        self.state = 'preparing'
+
+        # Spawn every job ahead of the start command, blocked on its gate, so
+        # the client's preparation includes the cost of spawning.
+        if armed:
+            self.armedJobs = arm_jobs(commands, timeouts, self.launchModes, self.placements)
+            print('\t--> Armed %d job(s).' % len(self.armedJobs))
+
+        # Listen for a UDP start datagram before acknowledging, so that the
+        # client cannot send it before we can receive it. The TCP start
+        # command remains available as a fallback.
+        if self.udpStart is not None:
+            try:
+                self.udpSock = open_start_channel(self.udpStart['group'], self.udpStart['port'])
+            except Exception as e:
+                print('ERROR: unable to listen for UDP start: %s.' % str(e))
+                self.disarm()
+                admission.release(self)
+                try:
+                    send_frame(conn, FRAME_NACK, 'unable to listen for UDP start: %s' % str(e))
+                except Exception:
+                    pass
+                return commands, timeouts
+            print('\t--> Listening for UDP start on %s:%d.'
+                  % (self.udpStart['group'], self.udpStart['port']))
+
+        try:
+            # Our clock when the spec arrived and now, for the client's
+            # first clock sample.
+            send_frame(conn, FRAME_ACK, '%s %.6f %.6f' % (digest, specReceived, time.time()))
+        except Exception:
+            self.close_start_channel()
+            self.disarm()
+            admission.release(self)
+            raise
+
+        # Answer clock samples so the client can estimate our clock offset.
+        try:
+            for i in range(spec['options'].get('clockSamples', 0)):
+                kind, payload, remainder = recv_frame(conn, remainder)
+                if kind != FRAME_SYNC:
+                    raise ValueError('expected clock sample but received frame kind %d' % kind)
+                send_frame(conn, FRAME_SYNC, '%.6f' % time.time())
+        except Exception as e:
+            print("ERROR: an exception occurred during clock synchronization: %s" % str(e))
+            self.close_start_channel()
+            self.disarm()
+            admission.release(self)
+            return commands, timeouts
+
+        self.ready = True
+        if self.outputCap is not None:
+            print('\t--> Output capped at %d byte(s) per stream.' % self.outputCap)
+        if self.telemetryInterval:
+            print('\t--> Sampling telemetry every %g second(s).' % self.telemetryInterval)
+        print('\t--> Specification verified. Awaiting start message.')
+
+        print() # Blank line.
+
+        return commands, timeouts
+
+    #
+    # Kill any jobs armed for a test block that will not run.
+    #
+    def disarm(self):
+        for job in self.armedJobs or []:
+            if job.proc is not None:
+                job.proc.kill()
+                job.proc.stdin.close()
+                job.proc.stdout.close()
+                job.proc.stderr.close()
+                job.proc.wait()
+        self.armedJobs = None
+
+    def close_start_channel(self):
+        if self.udpSock is not None:
+            self.udpSock.close()
+            self.udpSock = None
+
+    #
+    # Check whether the client has gone away while the session is queued.
+    #
+    def abandoned(self):
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    #
+    # Run a single test block on the session's connection.
+    #
+    # Return:
+    #     True if the client requested a persistent session, so the connection
+    #     should be kept open for the next test block.
+    #
+    def run_test(self):
+        sock = self.sock
+
+        self.name = ''
+        self.ready = False
+        self.persistent = False
+        self.udpStart = None
+        self.udpSock = None
+        self.outputCap = None
+        self.armedJobs = None
+        self.state = 'connected'
+
+        # Get the run specifications.
+        commands, timeouts = self.get_specs()
+        if not self.ready:
+            self.state = 'closing'
+            return False
+
+        try:
+            # Wait for the start command, run every job, and wait for them to finish.
+            self.state = 'running'
+            self.supervisor = Supervisor(sock, self.name, self.sosTimeout, commands, timeouts,
+                                         self.udpSock, self.udpStart, self.outputCap,
+                                         self.armedJobs, self.launchModes, self.placements,
+                                         self.telemetryInterval)
+            try:
+                self.supervisor.run()
+            finally:
+                self.supervisor.close()
+                self.close_start_channel()
+        finally:
+            admission.release(self)
+
+        # Notify client to stop listener thread for this agent.
+        print('\nActive processes: %d. Notifying client.\n' % self.supervisor.active)
+        self.state = 'idle'
+        send_frame(sock, FRAME_DONE)
+
+        return self.persistent
 
 
 # ############################################################################ #
-# SOSThread class for listening for client kill command while running.         #
+# Job class for tracking a single command and its subprocess.                  #
 # ############################################################################ #
-class SOSThread(threading.Thread):
-    "listens for kill command from client"
+class Job:
+    "a single command, its subprocess, and the state of its output pipes"
 
-    def __init__(self, sock, timeout, commandsList, timeoutsList):
-        threading.Thread.__init__(self)
-        self.running = False
+    def __init__(self, index, command, timeout, launch=LAUNCH_SHELL, placement=None):
+        self.index = index
+        self.command = command
+        self.timeout = timeout
+        self.launch = launch
+        # Resolved placement to apply, and the report of what was applied.
+        self.placement = placement
+        self.placementReport = None
+        # Resource usage of the process and its descendants, once reaped.
+        self.usage = None
+        self.proc = None
+        # Monotonic time at which the process was spawned.
+        self.spawnedAt = None
+        # Monotonic time after which the job is killed, if it has a timeout.
+        self.deadline = None
+        self.status = None
+        self.detail = ''
+        # Output pipes not yet at end of file.
+        self.openStreams = set()
+        # Bytes forwarded to the client so far, by stream.
+        self.sent = {STREAM_STDOUT: 0, STREAM_STDERR: 0}
+        # Bytes read past the output cap and discarded, by stream.
+        self.dropped = {STREAM_STDOUT: 0, STREAM_STDERR: 0}
+        # File descriptor signalled when the process exits, where supported.
+        self.pidfd = None
+        self.exited = False
+        self.finished = False
+
+
+# ############################################################################ #
+# Supervisor class for running a test block.                                   #
+# ############################################################################ #
+class Supervisor:
+    "multiplexes the client socket and every job's pipes, exit and deadline"
+
+    def __init__(self, sock, name, timeout, commandsList, timeoutsList, udpSock=None,
+                 udpStart=None, outputCap=None, armedJobs=None, launchModes=None,
+                 placements=None, telemetryInterval=None):
         self.sock = sock
+        self.name = name
         self.timeout = timeout
         self.commandsList = commandsList
         self.timeoutsList = timeoutsList
+        self.launchModes = launchModes or [LAUNCH_SHELL] * len(commandsList)
+        self.placements = placements or [None] * len(commandsList)
+        self.udpSock = udpSock
+        self.udpStart = udpStart
+        # Bytes of each output stream forwarded per job, or None for no limit.
+        self.outputCap = outputCap
+        self.selector = selectors.DefaultSelector()
+        self.jobs = []
+        # Number of jobs that have not yet finished.
+        self.active = 0
+        # Whether the jobs were spawned ahead of the start command.
+        self.armed = armedJobs is not None
+        if self.armed:
+            for job in armedJobs:
+                self.jobs.append(job)
+                self.active += 1
+                if job.proc is not None:
+                    self.watch(job)
+        self.running = False
         self.started = False
+        # Local time of a scheduled start, if one is pending.
+        self.startAt = None
+        # Local time at which the start command was received.
+        self.receivedAt = None
+        # Whether a start command has been accepted. Later ones are duplicates.
+        self.triggered = False
+        # Bytes of any incomplete frame received so far.
+        self.buffer = b''
+        # Killed processes that have not been reaped yet.
+        self.reaping = []
+        # Status of each command, for logging.
+        self.results = {}
+        # Host telemetry sampled while the jobs run, if requested.
+        self.telemetry = Telemetry(telemetryInterval) if telemetryInterval else None
 
+    #
+    # Run until every job has finished or the run is killed or times out.
+    #
     def run(self):
         self.running = True
-        startTime = time.time()
+        if not self.timeout == TIMEOUT_NONE:
+            self.deadline = time.monotonic() + self.timeout
+        else:
+            self.deadline = None
+
+        self.selector.register(self.sock, selectors.EVENT_READ, self.on_control)
+        if self.udpSock is not None:
+            self.selector.register(self.udpSock, selectors.EVENT_READ, self.on_datagram)
+
         try:
             while self.running:
-                elapsedTime = time.time() - startTime
-                if not self.timeout == TIMEOUT_NONE and elapsedTime >= self.timeout:
-                    self.timeout_handler()
-                    break
-
-                ready = select.select([self.sock], [], [], SELECT_TIMEOUT)
-                
-                if ready[0]:
-                    buffer = self.sock.recv(BUFFER_SIZE)
-                
-                    if buffer:
-                        commands = buffer.decode('UTF-8').split('\n')
-                        commands = filter(None, commands)
-                        for command in commands:
-                            if command == START_STRING:
-                                print('Start command received. Beginning run...')
-                                start_run(self.sock, self.commandsList, self.timeoutsList)
-                                self.started = True
-                            elif command == KILL_STRING:
-                                print('Run killed by remote client.')
-                                self.stop_and_kill_run()
-                            elif command == PING_STATUS_STRING:
-                                print('Status ping received.')
-                                self.sock.sendall(bytes(PING_OK_STRING + '\n', 'UTF-8'))
-                            else:
-                                print('Unknown command received from client:' % command)
-        except:
-            self.timeout_handler()
+                # Sleep until something happens. There is no periodic wake-up
+                # unless a job's exit can only be detected by polling.
+                for key, mask in self.selector.select(self.next_timeout()):
+                    # An earlier event of the batch may have ended the run or
+                    # released this key, whose fd may since have been reused.
+                    if not self.running:
+                        break
+                    if self.selector.get_map().get(key.fileobj) is not key:
+                        continue
+                    key.data(key)
+                self.check_start()
+                self.check_deadlines()
+                self.check_exits()
+                self.check_telemetry()
+                if self.started and self.active == 0:
+                    self.running = False
+        except Exception as e:
+            print('ERROR: during supervision of the run: %s.' % str(e))
+            self.stop_and_kill_run(ERROR_STATUS)
+            raise
 
-    def timeout_handler(self):
-        if self.running:
-            self.running = False
-            print('ERROR: a global timeout occurred for this agent.')
+        if self.telemetry is not None and self.started:
+            self.telemetry.sample()
             try:
-                # Kill all subprocess threads.
-                for thread in subthreads:
-                    thread.stop_and_kill_subproc(TIMEOUT_STATUS + SOCKET_DELIMITER)
-            except:
-                pass
+                send_frame(self.sock, FRAME_TELEMETRY, self.telemetry.encode())
+            except Exception as e:
+                print('NOTICE: an exception was caught during transmission of telemetry: %s.'
+                    % str(e))
 
-    def stop_and_kill_run(self):
-        if self.running:
-            self.running = False
-            print('Agent killed by remote host.')
-            try:
-                # Kill all subprocess threads.
-                for thread in subthreads:
-                    thread.stop_and_kill_subproc(KILLED_STATUS + SOCKET_DELIMITER)
-            except:
+    #
+    # Seconds until the next deadline, scheduled start or exit poll, or None
+    # to wait indefinitely.
+    #
+    def next_timeout(self):
+        now = time.monotonic()
+        timeouts = []
+        if self.deadline is not None:
+            timeouts.append(self.deadline - now)
+        for job in self.jobs:
+            if not job.finished and job.deadline is not None:
+                timeouts.append(job.deadline - now)
+            if job.proc is not None and not job.exited and job.pidfd is None \
+                    and not job.openStreams:
+                # Pipes are closed but the process lives on and its exit can
+                # only be detected by polling.
+                timeouts.append(SELECT_TIMEOUT)
+        if self.startAt is not None:
+            timeouts.append(self.startAt - time.time() - START_SPIN_WINDOW)
+        if self.telemetry is not None and self.telemetry.nextAt is not None:
+            timeouts.append(self.telemetry.nextAt - now)
+        if self.reaping:
+            timeouts.append(SELECT_TIMEOUT)
+        if not timeouts:
+            return None
+        return max(0, min(timeouts))
+
+    #
+    # Handle frames from the client.
+    #
+    def on_control(self, key):
+        try:
+            received = self.sock.recv(max(BUFFER_SIZE, CHUNK_SIZE))
+        except ConnectionError:
+            received = b''
+        bufferTime = time.time()
+
+        if not received:
+            print('Connection closed by remote client.')
+            self.stop_and_kill_run(KILLED_STATUS)
+            return
+
+        frames, self.buffer = unpack_frames(self.buffer + received)
+        for kind, payload in frames:
+            if kind == FRAME_START and self.triggered:
+                print('Duplicate start command ignored.')
+            elif kind == FRAME_START and not payload:
+                print('Start command received. Beginning run...')
+                self.triggered = True
+                self.receivedAt = bufferTime
+                self.begin_run()
+            elif kind == FRAME_START:
+                self.triggered = True
+                self.receivedAt = bufferTime
+                self.schedule_run(payload.decode('UTF-8'))
+            elif kind == FRAME_KILL:
+                print('Run killed by remote client.')
+                self.stop_and_kill_run(KILLED_STATUS)
+            elif kind == FRAME_PING:
+                print('Status ping received.')
+                send_frame(self.sock, FRAME_PONG)
+            else:
+                print('Unknown frame kind received from client: %d' % kind)
+
+    #
+    # Handle a UDP start datagram.
+    #
+    def on_datagram(self, key):
+        datagram = self.udpSock.recv(BUFFER_SIZE)
+        datagramTime = time.time()
+        if self.triggered:
+            return
+        if is_start_datagram(datagram, self.udpStart):
+            print('UDP start datagram received. Beginning run...')
+            self.triggered = True
+            self.receivedAt = datagramTime
+            self.selector.unregister(self.udpSock)
+            self.begin_run()
+        else:
+            print('WARNING: ignoring unauthenticated UDP datagram.')
+
+    #
+    # Handle output from a job.
+    #
+    def on_output(self, key):
+        job, stream = key.data.job, key.data.stream
+        try:
+            data = os.read(key.fd, CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        if data:
+            self.forward(job, stream, data)
+        else:
+            self.close_stream(job, stream, key.fileobj)
+            self.maybe_finish(job)
+
+    #
+    # Handle a job's exit, signalled by its pidfd.
+    #
+    def on_exit(self, key):
+        job = key.data.job
+        self.selector.unregister(job.pidfd)
+        os.close(job.pidfd)
+        job.pidfd = None
+        job.exited = self.reap(job)
+        self.maybe_finish(job)
+
+    def schedule_run(self, startAt):
+        self.startAt = float(startAt)
+        delay = self.startAt - time.time()
+        if delay > 0:
+            print('Scheduled start command received. Beginning run in %.6f second(s)...'
+                  % delay)
+        else:
+            print('WARNING: scheduled start time passed %.6f second(s) ago. '\
+                  'Beginning run...' % -delay)
+
+    #
+    # Begin a scheduled run once its start time is close.
+    #
+    def check_start(self):
+        if self.startAt is not None and self.startAt - time.time() <= START_SPIN_WINDOW:
+            # Spin through the last instant instead of trusting the scheduler
+            # to wake us on time.
+            while time.time() < self.startAt:
                 pass
+            self.begin_run()
 
-    def stop(self):
-        self.running = False
+    #
+    # Take a telemetry sample when one is due.
+    #
+    def check_telemetry(self):
+        if self.telemetry is not None and self.telemetry.nextAt is not None \
+                and time.monotonic() >= self.telemetry.nextAt:
+            self.telemetry.sample()
 
+    #
+    # Spawn every job.
+    #
+    def begin_run(self):
+        self.startAt = None
 
-# ############################################################################ #
-# ProcThread class for listening for subprocess completion.                    #
-# ############################################################################ #
-class ProcThread(threading.Thread):
-    "listens for subprocess completion"
+        # The lists should be the same length, but do a sanity check, just in case.
+        count = min(len(self.commandsList), len(self.timeoutsList))
 
-    def __init__(self, sock, command, timeout, proc):
-        threading.Thread.__init__(self)
-        self.running = False
-        self.sock = sock
-        self.command = command
-        self.timeout = timeout
-        self.proc = proc
-        self.result = 'NONE'
+        # Local time at which each process was spawned, for start skew reporting.
+        spawnTimes = []
 
-    def run(self):
-        global processcount
+        print('\n---RESULTS---\n')
 
-        self.running = True
-        startTime = time.time()
+        if self.armed:
+            # The jobs are already running; open every gate at once. Spawn
+            # times are listed in job order, None for jobs that failed to spawn.
+            for job in self.jobs:
+                if job.proc is not None:
+                    job.proc.stdin.close()
+                    self.release_gate(job)
+                    spawnTimes.append(time.time())
+                else:
+                    spawnTimes.append(None)
+            # Report the failures only once every gate is open.
+            for job in self.jobs:
+                if job.proc is None:
+                    self.finish(job, ERROR_STATUS, job.detail)
+        else:
+            for i in range(0, count):
+                job = Job(i, self.commandsList[i], self.timeoutsList[i], self.launchModes[i],
+                          self.placements[i])
+                self.jobs.append(job)
+                self.active += 1
+                try:
+                    job.proc = spawn(job)
+                    self.release_gate(job)
+                    spawnTimes.append(time.time())
+                except Exception as e:
+                    spawnTimes.append(None)
+                    print('\nERROR: an exception occurred while trying to spawn the subprocess for "%s": %s\n'\
+                          % (job.command, str(e)))
+                    self.finish(job, ERROR_STATUS, str(e))
+                    continue
+                self.watch(job)
+
+        self.started = True
+        if self.telemetry is not None:
+            self.telemetry.sample()
+
+        # Report when the start command arrived and when each process was spawned.
         try:
-            while self.running and self.proc.poll() is None: # Checks returncode attribute.
-                print(self.proc.stdout.readline().decode('UTF-8'), end='')
-                elapsedTime = time.time() - startTime
-                # If timeout exceeded and subprocess is still running. Short-circuits
-                # if self.timeout is None.
-                if not self.timeout == None and elapsedTime >= self.timeout:
-                    self.stop_and_kill_subproc(TIMEOUT_STATUS + SOCKET_DELIMITER)
-                # Yield context.
-                time.sleep(0)
+            send_frame(self.sock, FRAME_TIMING, json.dumps({'received': self.receivedAt,
+                                                            'spawned': spawnTimes}))
         except Exception as e:
-            print('ERROR: during subprocess execution: %s.' % str(e))
-            self.stop_and_kill_subproc(ERROR_STATUS + SOCKET_DELIMITER + str(e))
-
-        self.send_result()
-        processcount -= 1
-
-    def send_result(self):
-        global results
-        
-        if self.result == 'NONE':
-            output, errors = self.proc.communicate()
-            if self.proc.returncode > 0 or errors:
-                self.result = (name + SOCKET_DELIMITER + self.command + SOCKET_DELIMITER
-                    + ERROR_STATUS + SOCKET_DELIMITER + errors.decode('UTF-8'))
-            else:
-                self.result = (name + SOCKET_DELIMITER + self.command + SOCKET_DELIMITER
-                    + SUCCESS_STATUS + SOCKET_DELIMITER + output.decode('UTF-8'))
+            print('NOTICE: an exception was caught during transmission of timings: %s.'
+                % str(e))
 
-        print('* ' + self.result)
+    #
+    # Start a job's clock: its output offsets and its timeout count from here.
+    #
+    def release_gate(self, job):
+        job.spawnedAt = time.monotonic()
+        if job.timeout is not None:
+            job.deadline = job.spawnedAt + job.timeout
 
-        # Store for logging.
-        results[self.command] = self.result
+    #
+    # Register a job's pipes and exit with the supervisor.
+    #
+    def watch(self, job):
+        for pipe, stream in ((job.proc.stdout, STREAM_STDOUT), (job.proc.stderr, STREAM_STDERR)):
+            os.set_blocking(pipe.fileno(), False)
+            self.selector.register(pipe, selectors.EVENT_READ,
+                                   Handler(self.on_output, job, stream))
+            job.openStreams.add(stream)
+        if hasattr(os, 'pidfd_open'):
+            try:
+                job.pidfd = os.pidfd_open(job.proc.pid)
+                self.selector.register(job.pidfd, selectors.EVENT_READ,
+                                       Handler(self.on_exit, job))
+            except OSError:
+                job.pidfd = None
+
+    #
+    # Send a chunk of output to the client, stamped with its offset from the
+    # spawn of the job so the relative order of both streams is preserved.
+    # Output past the cap is still read, so the job never blocks on a full
+    # pipe, but is discarded.
+    #
+    def forward(self, job, stream, data):
+        capturedAt = time.monotonic() - (job.spawnedAt or time.monotonic())
+        if self.outputCap is not None:
+            room = max(0, self.outputCap - job.sent[stream])
+            job.dropped[stream] += max(0, len(data) - room)
+            data = data[:room]
+            if not data:
+                return
+        send_frame(self.sock, FRAME_CHUNK,
+                   struct.pack(CHUNK_HEADER, job.index, stream, capturedAt) + data)
+        job.sent[stream] += len(data)
+        if echo:
+            print(data.decode('UTF-8', 'replace'), end='')
+
+    def close_stream(self, job, stream, pipe):
+        self.selector.unregister(pipe)
+        pipe.close()
+        job.openStreams.discard(stream)
+
+    #
+    # Finish a job once it has exited and both of its pipes are drained.
+    #
+    def maybe_finish(self, job):
+        if job.finished or job.openStreams:
+            return
+        if not job.exited and job.pidfd is None:
+            job.exited = self.reap(job)
+        if not job.exited:
+            return
+        if job.proc.returncode > 0 or job.sent[STREAM_STDERR] or job.dropped[STREAM_STDERR]:
+            self.finish(job, ERROR_STATUS)
+        else:
+            self.finish(job, SUCCESS_STATUS)
+
+    #
+    # Reap a job's process if it has exited, collecting the resource usage of
+    # the process and all of its descendants with wait4.
+    #
+    # Return:
+    #     True if the process has exited.
+    #
+    def reap(self, job):
+        if job.proc.returncode is not None:
+            return True
+        try:
+            pid, status, rusage = os.wait4(job.proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            job.proc.poll()
+            return True
+        if pid == 0:
+            return False
+        # Hand the exit status to the Popen object, as it would have set it.
+        if os.WIFSIGNALED(status):
+            job.proc.returncode = -os.WTERMSIG(status)
+        else:
+            job.proc.returncode = os.WEXITSTATUS(status)
+        job.usage = {
+            'wall': round(time.monotonic() - job.spawnedAt, 6),
+            'user': round(rusage.ru_utime, 6),
+            'sys': round(rusage.ru_stime, 6),
+            'maxrss': rusage.ru_maxrss,
+            'inblock': rusage.ru_inblock,
+            'oublock': rusage.ru_oublock,
+            'nvcsw': rusage.ru_nvcsw,
+            'nivcsw': rusage.ru_nivcsw
+        }
+        return True
+
+    #
+    # Poll for the exit of jobs whose pipes closed before they exited, where
+    # no pidfd is available, and reap killed processes.
+    #
+    def check_exits(self):
+        for job in self.jobs:
+            if not job.finished and not job.openStreams and job.pidfd is None:
+                self.maybe_finish(job)
+        self.reaping = [proc for proc in self.reaping if proc.poll() is None]
+
+    #
+    # Kill jobs whose timeouts have passed, and everything on a global timeout.
+    #
+    def check_deadlines(self):
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            print('ERROR: a global timeout occurred for this agent.')
+            self.stop_and_kill_run(TIMEOUT_STATUS)
+            return
+        for job in self.jobs:
+            if not job.finished and job.deadline is not None and now >= job.deadline:
+                self.kill(job, TIMEOUT_STATUS)
+
+    #
+    # Kill a single job and report it with the given status.
+    #
+    def kill(self, job, status, detail=''):
+        if job.finished:
+            return
+        print('\tCommand "%s" killed.' % job.command)
+        try:
+            # Kill the subprocess.
+            job.proc.terminate()
+            self.reaping.append(job.proc)
+        except:
+            pass
+        self.finish(job, status, detail)
+
+    #
+    # Kill every job, or end the run if it has not started yet.
+    #
+    def stop_and_kill_run(self, status):
+        for job in self.jobs:
+            self.kill(job, status)
+        self.startAt = None
+        self.running = False
+
+    #
+    # Report a job's result and stop watching it.
+    #
+    def finish(self, job, status, detail=''):
+        job.finished = True
+        job.status = status
+        job.detail = detail
+        self.active -= 1
+        self.release(job)
 
-        # Check to make sure we're not overrunning the socket buffer.
-        if len(self.result) > BUFFER_SIZE:
-            self.result = self.result[:BUFFER_SIZE-2]
-        # Add the terminating newline.
-        if not self.result[:-1] == '\n':
-            self.result = self.result + '\n'
+        if status == SUCCESS_STATUS:
+            stream = STREAM_STDOUT
+        elif status == ERROR_STATUS and not detail:
+            stream = STREAM_STDERR
+        else:
+            stream = STREAM_NONE
+
+        print('\n* ' + self.name + SOCKET_DELIMITER + job.command + SOCKET_DELIMITER
+              + status + SOCKET_DELIMITER + detail)
+
+        # Store for logging.
+        self.results[job.command] = status
 
+        # The output itself has already been streamed in chunks.
         try:
-            self.sock.sendall(bytes(self.result, 'UTF-8'))
+            send_frame(self.sock, FRAME_RESULT, json.dumps({
+                'index': job.index,
+                'status': status,
+                'stream': stream,
+                'detail': detail,
+                'dropped': job.dropped[stream] if stream != STREAM_NONE else 0,
+                'placement': job.placementReport,
+                'usage': job.usage
+            }))
         except Exception as e:
             print('NOTICE: an exception was caught during transmission of results: %s.'
                 % str(e))
 
-    def stop_and_kill_subproc(self, reason):
-        if self.running:
-            self.running = False
-            print('\tCommand "%s" killed.' % self.command)
-            try:
-                # Kill the subprocess.
-                self.proc.terminate()
-            except:
-                pass
+    #
+    # Stop watching a job's pipes and exit.
+    #
+    def release(self, job):
+        if job.proc is None:
+            return
+        if job.proc.stdin is not None and not job.proc.stdin.closed:
+            job.proc.stdin.close()
+        for pipe, stream in ((job.proc.stdout, STREAM_STDOUT), (job.proc.stderr, STREAM_STDERR)):
+            if stream in job.openStreams:
+                self.close_stream(job, stream, pipe)
+        if job.pidfd is not None:
+            self.selector.unregister(job.pidfd)
+            os.close(job.pidfd)
+            job.pidfd = None
+
+    #
+    # Release everything still being watched.
+    #
+    def close(self):
+        for job in self.jobs:
+            self.release(job)
+        for proc in self.reaping:
+            proc.poll()
+        self.selector.close()
+
 
-            self.result = (name + SOCKET_DELIMITER + self.command + SOCKET_DELIMITER
-                + reason)
+# ############################################################################ #
+# Telemetry class for sampling host counters during a run.                     #
+# ############################################################################ #
+class Telemetry:
+    "periodic samples of host counters, delta-encoded against the previous one"
+
+    def __init__(self, interval):
+        self.interval = interval
+        # Monotonic time of the next sample, once sampling has begun.
+        self.nextAt = None
+        self.lastAt = None
+        # Counter names, fixed by the first sample.
+        self.fields = None
+        # Values of the first sample, in the order of fields.
+        self.base = None
+        self.previous = None
+        # One row per later sample: milliseconds since the previous sample,
+        # then the change of each counter.
+        self.deltas = []
+
+    def sample(self):
+        now = time.monotonic()
+        counters = read_host_counters()
+        if self.fields is None:
+            self.fields = sorted(counters)
+            self.base = [counters[field] for field in self.fields]
+            self.previous = self.base
+        else:
+            # Counters that vanished, such as an unplugged device, hold still.
+            current = [counters.get(field, previous)
+                       for field, previous in zip(self.fields, self.previous)]
+            self.deltas.append([int(round((now - self.lastAt) * 1000))]
+                               + [c - p for c, p in zip(current, self.previous)])
+            self.previous = current
+        self.lastAt = now
+        self.nextAt = now + self.interval
+
+    #
+    # Compressed telemetry frame payload.
+    #
+    def encode(self):
+        return zlib.compress(bytes(json.dumps({
+            'interval': self.interval,
+            'fields': self.fields or [],
+            'base': self.base or [],
+            'deltas': self.deltas
+        }, separators=(',', ':')), 'UTF-8'))
+
+
+# ############################################################################ #
+# Handler class for identifying selector events.                               #
+# ############################################################################ #
+class Handler:
+    "callable selector key data naming the job and stream an event belongs to"
+
+    def __init__(self, callback, job, stream=None):
+        self.callback = callback
+        self.job = job
+        self.stream = stream
+
+    def __call__(self, key):
+        self.callback(key)
+
+
+# ############################################################################ #
+# ProtocolError exception raised on malformed frames.                          #
+# ############################################################################ #
+class ProtocolError(Exception):
+    "raised when a frame does not match the protocol"
+    pass
 
 
 # ############################################################################ #
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+
+# ############################################################################ #
+# NetJobsBench - loopback scale benchmark for the NetJobs job synchronizer.    #
+#                                                                              #
+# Copyright (c) 2016 DeepStorage, LLC (deepstorage.net)                        #
+#     and Ramon A. Lovato (ramonalovato.com).                                  #
+#                                                                              #
+# See the file LICENSE for copying permission.                                 #
+#                                                                              #
+# Author: Ramon A. Lovato (ramonalovato.com)                                   #
+# For: Deepstorage, LLC (deepstorage.net)                                      #
+#                                                                              #
+# Usage: NetJobsBench.py [--agents=N[,N...]] [--jobs=N] [--timeout-hosts=N]    #
+#                        [--engine=threads|async] [--parse=N[,N...]]           #
+#                        [--report=PATH]                                       #
+#                                                                              #
+# Example: $ NetJobsBench.py --agents=1,10,100 --report=bench.json             #
+# ############################################################################ #
+
+import sys
+import os
+import time
+import datetime
+import json
+import socket
+import subprocess
+import tempfile
+import platform
+import resource
+import sqlite3
+import tracemalloc
+
+import NetJobs
+
+# ############################################################################ #
+# Constants and global variables.                                              #
+# ############################################################################ #
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+COORDINATOR_SCRIPT = os.path.join(BENCH_DIR, 'NetJobs.py')
+AGENT_SCRIPT = os.path.join(BENCH_DIR, 'NetJobsAgent.py')
+# Agent N listens on the loopback address, on the Nth port after this one.
+AGENT_HOST = '127.0.0.1'
+AGENT_PORT_BASE = 17000
+DEFAULT_AGENT_COUNTS = (1, 10, 100, 1000)
+DEFAULT_JOBS = 1
+# Timeout of the jobs of the timeout test, and how long they would otherwise
+# run, in seconds.
+BENCH_TIMEOUT = 2
+BENCH_SLEEP = 30
+# Seconds allowed for every agent to start listening, and for each run of
+# the coordinator.
+AGENT_READY_TIMEOUT = 120
+RUN_TIMEOUT = 600
+READY_POLL = 0.1
+# Target lines per test block of the generated parse benchmark configuration,
+# and parses timed per size (the fastest is reported).
+PARSE_TARGETS_PER_TEST = 1000
+PARSE_REPEAT = 3
+REAP_POLL = 0.01
+USAGE = ('Usage: NetJobsBench.py [--agents=N[,N...]] [--jobs=N] [--timeout-hosts=N] '
+         '[--engine=threads|async] [--parse=N[,N...]] [--report=PATH]')
+
+#
+# Configuration file target of an agent.
+#
+# Params:
+#     index Index of the agent, from 0.
+#
+def agent_address(index):
+    return NetJobs.format_target(AGENT_HOST, AGENT_PORT_BASE + index + 1)
+
+#
+# Start one agent per address.
+#
+# Return:
+#     List of agent processes.
+#
+def start_agents(addresses):
+    agents = []
+    for address in addresses:
+        host, port = NetJobs.parse_target(address)
+        agents.append(subprocess.Popen([sys.executable, AGENT_SCRIPT, '--bind=' + host,
+                                        '--port=%d' % port],
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL))
+    return agents
+
+#
+# Whether the agent at an address answers a status query. A foreign agent
+# may be answering on the port instead, so the process we spawned must
+# still be running, and an agent of another protocol version is not ready.
+#
+# Params:
+#     address Configuration file target of the agent.
+#     agent Agent process listening at the address.
+#
+def agent_ready(address, agent):
+    try:
+        with socket.create_connection(NetJobs.parse_target(address), 1) as sock:
+            sock.sendall(NetJobs.pack_frame(NetJobs.FRAME_STATUS))
+            buffer = b''
+            while True:
+                data = sock.recv(NetJobs.BUFFER_SIZE)
+                if not data:
+                    return False
+                buffer += data
+                frames, buffer = NetJobs.unpack_frames(buffer)
+                if frames:
+                    return frames[0][0] == NetJobs.FRAME_STATUS and agent.poll() is None
+    except (OSError, NetJobs.ProtocolError):
+        return False
+
+#
+# Wait until every agent answers, or exit if one dies or the deadline passes.
+#
+def wait_for_agents(addresses, agents):
+    deadline = time.monotonic() + AGENT_READY_TIMEOUT
+    waiting = list(zip(addresses, agents))
+    while waiting:
+        for agent in [agent for address, agent in waiting if agent.poll() is not None]:
+            stop_agents(agents)
+            exit('ERROR: an agent exited with status %d during startup.' % agent.returncode)
+        waiting = [(address, agent) for address, agent in waiting
+                   if not agent_ready(address, agent)]
+        if waiting:
+            if time.monotonic() > deadline:
+                stop_agents(agents)
+                exit('ERROR: %d agent(s) did not start listening within %d seconds.'
+                     % (len(waiting), AGENT_READY_TIMEOUT))
+            time.sleep(READY_POLL)
+
+def stop_agents(agents):
+    for agent in agents:
+        if agent.poll() is None:
+            agent.terminate()
+    for agent in agents:
+        agent.wait()
+
+#
+# Write the benchmark configuration: a "throughput" test in which every agent
+# runs short jobs, and a "timeouts" test in which some agents run jobs that
+# exceed their timeout.
+#
+def write_config(path, addresses, jobs, timeoutHosts):
+    with open(path, 'w') as f:
+        f.write('throughput:\n-generaltimeout: %ds\n-minhosts: all\n' % RUN_TIMEOUT)
+        for address in addresses:
+            for job in range(jobs):
+                f.write('%s: "true"\n' % address)
+        f.write('end\n\n')
+        if timeoutHosts:
+            f.write('timeouts:\n-minhosts: 0\n')
+            for address in addresses[:timeoutHosts]:
+                f.write('%s: "sleep %d"\n-timeout: %ds\n' % (address, BENCH_SLEEP, BENCH_TIMEOUT))
+            f.write('end\n')
+
+#
+# Run the coordinator on a configuration, recording into a results database.
+#
+# Return:
+#     Exit status of the coordinator.
+#     Dictionary of its wall-clock time, CPU times and maximum resident set
+#     size.
+#
+def run_coordinator(config, database, engine):
+    startTime = time.monotonic()
+    # The configuration is generated anew for every run, so it is not cached.
+    coordinator = subprocess.Popen([sys.executable, COORDINATOR_SCRIPT,
+                                    '--engine=' + engine, '--db=' + database,
+                                    '--no-config-cache', config],
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    # Reap it ourselves to collect its resource usage.
+    deadline = startTime + RUN_TIMEOUT
+    pid = 0
+    while pid == 0 and time.monotonic() < deadline:
+        time.sleep(REAP_POLL)
+        pid, status, rusage = os.wait4(coordinator.pid, os.WNOHANG)
+    if pid == 0:
+        coordinator.kill()
+        pid, status, rusage = os.wait4(coordinator.pid, 0)
+    if os.WIFEXITED(status):
+        coordinator.returncode = os.WEXITSTATUS(status)
+    else:
+        coordinator.returncode = -os.WTERMSIG(status)
+    return coordinator.returncode, {
+        'wall': round(time.monotonic() - startTime, 6),
+        'user': round(rusage.ru_utime, 6),
+        'sys': round(rusage.ru_stime, 6),
+        'maxrss': rusage.ru_maxrss
+    }
+
+#
+# Nearest-rank percentile of a list of numbers, or None if it is empty.
+#
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * share // 100) - 1)]
+
+def distribution(values):
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': max(values)
+    }
+
+def spread(values):
+    values = [value for value in values if value is not None]
+    return max(values) - min(values) if values else None
+
+#
+# Extract the benchmark metrics of a run from its results database.
+#
+def measure(database):
+    connection = sqlite3.connect(database)
+    metrics = {}
+
+    # Preparation, start skew and result ingest of the throughput test.
+    test = connection.execute("SELECT id FROM tests WHERE label = 'throughput'").fetchone()
+    if test is not None:
+        timings = connection.execute('SELECT prep, received FROM timings WHERE test = ?',
+                                     test).fetchall()
+        jobs = connection.execute('SELECT status, spawned, finished FROM jobs WHERE test = ?',
+                                  test).fetchall()
+        finished = [row[2] for row in jobs]
+        ingest = spread(finished)
+        metrics['prep'] = distribution([row[0] for row in timings if row[0] is not None])
+        metrics['skew'] = {
+            'received': spread([row[1] for row in timings]),
+            'spawned': spread([row[1] for row in jobs])
+        }
+        metrics['ingest'] = {
+            'results': len(jobs),
+            'succeeded': sum(1 for row in jobs if row[0] == NetJobs.SUCCESS_STATUS),
+            'seconds': ingest,
+            'resultsPerSecond': len(jobs) / ingest if ingest else None
+        }
+
+    # How late timeouts were detected, from each job's spawn time.
+    test = connection.execute("SELECT id FROM tests WHERE label = 'timeouts'").fetchone()
+    if test is not None:
+        jobs = connection.execute('SELECT status, spawned, finished FROM jobs WHERE test = ?',
+                                  test).fetchall()
+        metrics['timeouts'] = {
+            'expected': len(jobs),
+            'reported': sum(1 for row in jobs if row[0] == NetJobs.TIMEOUT_STATUS),
+            'lateness': distribution([row[2] - row[1] - BENCH_TIMEOUT for row in jobs
+                                      if row[0] == NetJobs.TIMEOUT_STATUS
+                                      and row[1] is not None])
+        }
+
+    connection.close()
+    return metrics
+
+#
+# Benchmark the coordinator against a number of agents.
+#
+# Return:
+#     Dictionary of the metrics of the run.
+#
+def bench(count, jobs, timeoutHosts, engine, workDir):
+    addresses = [agent_address(index) for index in range(count)]
+    config = os.path.join(workDir, 'bench_%d.txt' % count)
+    database = os.path.join(workDir, 'bench_%d.db' % count)
+    write_config(config, addresses, jobs, min(timeoutHosts, count))
+
+    agentsStart = time.monotonic()
+    agents = start_agents(addresses)
+    try:
+        wait_for_agents(addresses, agents)
+        agentsReady = time.monotonic() - agentsStart
+        status, coordinator = run_coordinator(config, database, engine)
+    finally:
+        stop_agents(agents)
+
+    run = {'agents': count, 'jobs': count * jobs, 'agentStartup': round(agentsReady, 6),
+           'exitStatus': status, 'coordinator': coordinator}
+    run.update(measure(database))
+    return run
+
+#
+# Write a configuration of a number of target lines, each on its own host and
+# followed by a timeout line, in blocks of PARSE_TARGETS_PER_TEST. With
+# ranges, each block instead has a single target line naming its hosts with
+# a host range.
+#
+def write_parse_config(path, targets, ranges=False):
+    with open(path, 'w') as f:
+        for index in range(0, targets, PARSE_TARGETS_PER_TEST):
+            last = min(index + PARSE_TARGETS_PER_TEST, targets) - 1
+            f.write('# Generated by NetJobsBench.\ntest%d:\n-generaltimeout: 5m\n'
+                    '-minhosts: 0\n' % (index // PARSE_TARGETS_PER_TEST))
+            if ranges:
+                f.write('vm[%07d-%07d].lab: "./run_benchmark.sh"\n-timeout: 30s\n'
+                        % (index, last))
+            else:
+                for host in range(index, last + 1):
+                    f.write('vm%07d.lab: "./run_benchmark.sh"\n-timeout: 30s\n' % host)
+            f.write('end\n\n')
+
+#
+# Parse a configuration PARSE_REPEAT times.
+#
+# Return:
+#     Fastest parse time.
+#     Peak memory allocated by one parse, in KiB.
+#     Number of tests parsed.
+#
+def time_parse(config):
+    NetJobs.configCache = False
+    times = []
+    for run in range(PARSE_REPEAT):
+        startTime = time.perf_counter()
+        tests = NetJobs.NetJobs(['NetJobs.py', config]).tests
+        times.append(time.perf_counter() - startTime)
+    # Memory is measured separately, as tracing slows the parse down.
+    tracemalloc.start()
+    NetJobs.NetJobs(['NetJobs.py', config])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak // 1024, len(tests)
+
+#
+# Load a configuration PARSE_REPEAT times from the config cache, after one load
+# to fill it.
+#
+# Return:
+#     Fastest load time.
+#
+def time_cached_load(config):
+    NetJobs.configCache = True
+    NetJobs.NetJobs(['NetJobs.py', config])
+    times = []
+    for run in range(PARSE_REPEAT):
+        startTime = time.perf_counter()
+        NetJobs.NetJobs(['NetJobs.py', config])
+        times.append(time.perf_counter() - startTime)
+    return min(times)
+
+#
+# Benchmark the configuration parser on a generated configuration.
+#
+# Return:
+#     Dictionary of the metrics of the run.
+#
+def bench_parse(targets, workDir):
+    config = os.path.join(workDir, 'parse_%d.txt' % targets)
+    write_parse_config(config, targets)
+    with open(config) as f:
+        lines = sum(1 for line in f)
+    seconds, peak, tests = time_parse(config)
+    cachedSeconds = time_cached_load(config)
+
+    # The same hosts and commands, written with host ranges.
+    rangeConfig = os.path.join(workDir, 'parse_%d_ranges.txt' % targets)
+    write_parse_config(rangeConfig, targets, ranges=True)
+    rangeSeconds, rangePeak, rangeTests = time_parse(rangeConfig)
+
+    return {'targets': targets, 'lines': lines, 'bytes': os.path.getsize(config),
+            'tests': tests, 'seconds': seconds, 'linesPerSecond': lines / seconds,
+            'peakMemory': peak, 'cachedSeconds': cachedSeconds,
+            'ranges': {'bytes': os.path.getsize(rangeConfig), 'seconds': rangeSeconds,
+                       'peakMemory': rangePeak}}
+
+#
+# Main.
+#
+def main():
+    "main function"
+
+    counts = None
+    parseSizes = []
+    jobs = DEFAULT_JOBS
+    timeoutHosts = None
+    engine = NetJobs.ENGINE_THREADS
+    reportPath = None
+    for arg in sys.argv[1:]:
+        option, _, value = arg.partition('=')
+        try:
+            if option == '--agents':
+                counts = [int(count) for count in value.split(',')]
+                if min(counts) < 1:
+                    exit(USAGE)
+            elif option == '--jobs' and int(value) > 0:
+                jobs = int(value)
+            elif option == '--timeout-hosts' and int(value) >= 0:
+                timeoutHosts = int(value)
+            elif option == '--engine' and value in NetJobs.ENGINES:
+                engine = value
+            elif option == '--parse':
+                parseSizes = [int(size) for size in value.split(',')]
+                if min(parseSizes) < 1:
+                    exit(USAGE)
+            elif option == '--report' and value:
+                reportPath = value
+            else:
+                exit(USAGE)
+        except ValueError:
+            exit(USAGE)
+    # Without --agents, --parse runs only the parse benchmark.
+    if counts is None:
+        counts = [] if parseSizes else DEFAULT_AGENT_COUNTS
+
+    # Every agent connection takes a descriptor in the coordinator.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'protocolVersion': NetJobs.PROTOCOL_VERSION,
+        'engine': engine,
+        'jobsPerAgent': jobs,
+        'timeout': BENCH_TIMEOUT,
+        'runs': [],
+        'parse': []
+    }
+    with tempfile.TemporaryDirectory(prefix='netjobsbench') as workDir:
+        # Keep the config cache of the parse benchmark out of the user's.
+        NetJobs.CONFIG_CACHE_DIR = os.path.join(workDir, 'cache')
+        for count in counts:
+            print('// NetJobsBench: %d agent(s)...' % count, file=sys.stderr)
+            run = bench(count, jobs, count if timeoutHosts is None else timeoutHosts,
+                        engine, workDir)
+            report['runs'].append(run)
+            print('//     coordinator %.3fs wall, %.3fs CPU, %d KiB; exit status %d.'
+                  % (run['coordinator']['wall'],
+                     run['coordinator']['user'] + run['coordinator']['sys'],
+                     run['coordinator']['maxrss'], run['exitStatus']), file=sys.stderr)
+        for size in parseSizes:
+            print('// NetJobsBench: parsing %d target line(s)...' % size, file=sys.stderr)
+            run = bench_parse(size, workDir)
+            report['parse'].append(run)
+            print('//     %.3fs, %d line(s) per second, %d KiB peak; %.3fs from the config '
+                  'cache; with ranges %.3fs, %d KiB peak.'
+                  % (run['seconds'], run['linesPerSecond'], run['peakMemory'],
+                     run['cachedSeconds'], run['ranges']['seconds'], run['ranges']['peakMemory']),
+                  file=sys.stderr)
+
+    if reportPath is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(reportPath, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+# ############################################################################ #
+# Execute main.                                                                #
+# ############################################################################ #
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# ############################################################################ #
+# Armed mode tests: run a real agent on the loopback interface and check the   #
+# start timings it reports.                                                    #
+#                                                                              #
+# See the file LICENSE for copying permission.                                 #
+#                                                                              #
+# Usage: $ python3 -m unittest discover tests                                  #
+# ############################################################################ #
+
+import sys
+import os
+import time
+import sqlite3
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NetJobs
+import NetJobsBench
+
+AGENT_PORT = 17900
+RUN_TIMEOUT = 60
+
+class ArmedSpawnTimesTest(unittest.TestCase):
+    "spawn times of armed jobs are reported against the right commands"
+
+    def setUp(self):
+        self.workDir = tempfile.TemporaryDirectory(prefix='netjobstest')
+        self.address = NetJobs.format_target(NetJobsBench.AGENT_HOST, AGENT_PORT)
+        self.agents = NetJobsBench.start_agents([self.address])
+        NetJobsBench.wait_for_agents([self.address], self.agents)
+
+    def tearDown(self):
+        NetJobsBench.stop_agents(self.agents)
+        self.workDir.cleanup()
+
+    #
+    # Run a configuration with the coordinator and return the spawn time
+    # recorded for each command, by command.
+    #
+    def run_config(self, lines, *options):
+        config = os.path.join(self.workDir.name, 'config.txt')
+        database = os.path.join(self.workDir.name, 'results.db')
+        with open(config, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        subprocess.run([sys.executable, NetJobsBench.COORDINATOR_SCRIPT,
+                        '--no-config-cache', '--db=' + database] + list(options) + [config],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       timeout=RUN_TIMEOUT, check=True)
+        connection = sqlite3.connect(database)
+        try:
+            return dict(connection.execute('SELECT command, spawned FROM jobs'))
+        finally:
+            connection.close()
+
+    def test_failed_job_before_good_one(self):
+        lines = ['armed:', '-minhosts: 0',
+                 '%s: "no_such_binary_xyz"' % self.address, '-exec: argv',
+                 '%s: "sleep 0.3"' % self.address, '-exec: argv',
+                 'end']
+        for options in ((), ('--armed',)):
+            with self.subTest(options=options):
+                spawned = self.run_config(lines, *options)
+                self.assertIsNone(spawned['no_such_binary_xyz'])
+                self.assertIsNotNone(spawned['sleep 0.3'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# ############################################################################ #
+# Configuration tests: host pattern expansion, -after references, and the      #
+# round trip of compiled configurations through the config cache.              #
+#                                                                              #
+# See the file LICENSE for copying permission.                                 #
+#                                                                              #
+# Usage: $ python3 -m unittest discover tests                                  #
+# ############################################################################ #
+
+import sys
+import os
+import io
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NetJobs
+
+class ExpandHostsTest(unittest.TestCase):
+    "numeric ranges of host patterns expand to every host"
+
+    def test_no_range(self):
+        self.assertEqual(NetJobs.expand_hosts('vm01.lab:17000'), ['vm01.lab:17000'])
+
+    def test_padding(self):
+        self.assertEqual(NetJobs.expand_hosts('vm[08-10].lab'),
+                         ['vm08.lab', 'vm09.lab', 'vm10.lab'])
+        self.assertEqual(NetJobs.expand_hosts('vm[8-10]'), ['vm8', 'vm9', 'vm10'])
+
+    def test_several_ranges(self):
+        self.assertEqual(NetJobs.expand_hosts('10.0.[1-2].[5-6]:[17000-17001]'),
+                         ['10.0.%d.%d:%d' % (a, b, port) for a in (1, 2) for b in (5, 6)
+                          for port in (17000, 17001)])
+
+    def test_invalid_ranges(self):
+        for pattern in ('vm[3-1]', 'vm[0-99999]'):
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(ValueError):
+                    NetJobs.expand_hosts(pattern)
+
+class ConfigTest(unittest.TestCase):
+    "configuration files parse, and load again from the config cache"
+
+    def setUp(self):
+        self.workDir = tempfile.TemporaryDirectory(prefix='netjobstest')
+        self.path = os.path.join(self.workDir.name, 'config.txt')
+        self.cacheDir = os.path.join(self.workDir.name, 'cache')
+        patches = (mock.patch.object(NetJobs, 'CONFIG_CACHE_DIR', self.cacheDir),
+                   mock.patch.object(NetJobs, 'configCache', False))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.workDir.cleanup()
+
+    #
+    # Parse a configuration file.
+    #
+    # Return:
+    #     List of TestConfig.
+    #
+    def load(self, lines):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return NetJobs.NetJobs(['NetJobs.py', self.path]).tests
+
+    #
+    # Parse a configuration file that should be rejected.
+    #
+    # Return:
+    #     Errors reported.
+    #
+    def load_errors(self, lines):
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors), self.assertRaises(SystemExit):
+            self.load(lines)
+        return errors.getvalue()
+
+    def test_groups_and_ranges(self):
+        tests = self.load(['@web = vm[1-2].lab, [fd00::1]:17000',
+                           't:', '@web: echo hi', '-timeout: 3s', 'vm2.lab: echo extra', 'end'])
+        specs = tests[0].specs
+        self.assertEqual(sorted(specs), ['[fd00::1]:17000', 'vm1.lab', 'vm2.lab'])
+        self.assertEqual(specs['vm1.lab'], ['echo hi'])
+        self.assertEqual(specs['vm2.lab'], ['echo hi', 'echo extra'])
+        self.assertEqual(tests[0].timeouts['vm1.lab'], {'echo hi': 3})
+        # Hosts named by the same lines share their specifications.
+        self.assertIs(specs['vm1.lab'], specs['[fd00::1]:17000'])
+
+    def test_after(self):
+        tests = self.load(['a:', 'h1: true', 'end',
+                           'b:', '-after: a', '-exclusive', 'h2: true', 'end'])
+        self.assertEqual(tests[1].after, ('a',))
+        self.assertTrue(tests[1].exclusive)
+
+    def test_after_must_name_earlier_test(self):
+        # Only earlier tests may be named, so dependencies cannot form a cycle.
+        errors = self.load_errors(['a:', '-after: b', 'h1: true', 'end',
+                                   'b:', '-after: a', 'h2: true', 'end'])
+        self.assertIn('-after must name a test defined before test a, not "b"', errors)
+        errors = self.load_errors(['a:', '-after: a', 'h1: true', 'end'])
+        self.assertIn('not "a"', errors)
+
+    def test_cache_round_trip(self):
+        lines = ['a:', '-minhosts: 1', 'h[1-3]: echo "a"', '-exec: argv', '-nice: 5', 'end',
+                 'b:', '-after: a', '-exclusive', 'h1: sleep 1', '-timeout: 2m', 'end']
+        with mock.patch.object(NetJobs, 'configCache', True):
+            parsed = self.load(lines)
+            self.assertEqual(len(os.listdir(self.cacheDir)), 1)
+            with mock.patch.object(NetJobs.NetJobs, 'parse_config',
+                                   side_effect=AssertionError('not loaded from the cache')):
+                cached = NetJobs.NetJobs(['NetJobs.py', self.path]).tests
+
+        for before, after in zip(parsed, cached):
+            for name in ('label', 'generalTimeout', 'minHosts', 'specs', 'timeouts',
+                         'launchModes', 'placements', 'after', 'exclusive'):
+                self.assertEqual(getattr(before, name), getattr(after, name), name)
+        self.assertIs(cached[0].specs['h1'], cached[0].specs['h3'])
+
+    def test_cache_key_mismatch(self):
+        path = os.path.join(self.cacheDir, 'entry' + NetJobs.CONFIG_CACHE_SUFFIX)
+        NetJobs.write_config_cache(path, 'key', [('t', 0, 0, {}, {})])
+        self.assertEqual(NetJobs.read_config_cache(path, 'key'), [('t', 0, 0, {}, {})])
+        self.assertIsNone(NetJobs.read_config_cache(path, 'other'))
+        with open(path, 'wb') as f:
+            f.write(b'not marshal data')
+        self.assertIsNone(NetJobs.read_config_cache(path, 'key'))
+
+    def test_cache_pruned(self):
+        with mock.patch.object(NetJobs, 'CONFIG_CACHE_MAX_ENTRIES', 2):
+            for i in range(4):
+                path = os.path.join(self.cacheDir, '%d%s' % (i, NetJobs.CONFIG_CACHE_SUFFIX))
+                NetJobs.write_config_cache(path, 'key', [])
+                os.utime(path, (i, i))
+        self.assertEqual(sorted(os.listdir(self.cacheDir)),
+                         ['2' + NetJobs.CONFIG_CACHE_SUFFIX, '3' + NetJobs.CONFIG_CACHE_SUFFIX])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# ############################################################################ #
+# Parallel test output: run two tests at once against real agents on the       #
+# loopback interface and check that their results are not mixed up.            #
+#                                                                              #
+# See the file LICENSE for copying permission.                                 #
+#                                                                              #
+# Usage: $ python3 -m unittest discover tests                                  #
+# ############################################################################ #
+
+import sys
+import os
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NetJobs
+import NetJobsBench
+
+AGENT_PORTS = (17910, 17911)
+RUN_TIMEOUT = 60
+
+class ParallelOutputTest(unittest.TestCase):
+    "each results header of a parallel run is followed only by its own results"
+
+    def setUp(self):
+        self.workDir = tempfile.TemporaryDirectory(prefix='netjobstest')
+        self.addresses = [NetJobs.format_target(NetJobsBench.AGENT_HOST, port)
+                          for port in AGENT_PORTS]
+        self.agents = NetJobsBench.start_agents(self.addresses)
+        NetJobsBench.wait_for_agents(self.addresses, self.agents)
+
+    def tearDown(self):
+        NetJobsBench.stop_agents(self.agents)
+        self.workDir.cleanup()
+
+    #
+    # Run a configuration with the coordinator and return its output lines.
+    #
+    def run_config(self, lines, *options):
+        config = os.path.join(self.workDir.name, 'config.txt')
+        with open(config, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        result = subprocess.run([sys.executable, NetJobsBench.COORDINATOR_SCRIPT,
+                                 '--no-config-cache'] + list(options) + [config],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                timeout=RUN_TIMEOUT, check=True)
+        return result.stdout.decode('UTF-8').splitlines()
+
+    def test_parallel_progress(self):
+        lines = []
+        for label, address in zip(('alpha', 'beta'), self.addresses):
+            lines += ['%s:' % label]
+            for i in range(3):
+                lines += ['%s: sleep 0.%d; echo %s' % (address, i + 2, label)]
+            lines += ['end']
+        output = self.run_config(lines, '--parallel=2', '--progress')
+
+        # Result lines of each test, by the label of the header they follow.
+        results = {}
+        label = None
+        for line in output:
+            if line.startswith('\t\t-- ') and line.endswith(' // RESULTS:'):
+                label = line[len('\t\t-- '):-len(' // RESULTS:')]
+                self.assertNotIn(label, results)
+                results[label] = []
+            elif line.lstrip('\t').split(NetJobs.SOCKET_DELIMITER)[0] in self.addresses:
+                self.assertIsNotNone(label, 'result before any header: %r' % line)
+                results[label].append(line)
+
+        self.assertEqual(sorted(results), ['alpha', 'beta'])
+        for label, lines in results.items():
+            self.assertEqual(len(lines), 3)
+            for line in lines:
+                self.assertIn('echo ' + label, line)
+
+if __name__ == '__main__':
+    unittest.main()
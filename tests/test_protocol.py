@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# ############################################################################ #
+# Protocol tests: the frame codec shared by the coordinator and the agent,     #
+# and the clock offset estimated from the acknowledgement and clock samples.   #
+#                                                                              #
+# See the file LICENSE for copying permission.                                 #
+#                                                                              #
+# Usage: $ python3 -m unittest discover tests                                  #
+# ############################################################################ #
+
+import sys
+import os
+import socket
+import struct
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NetJobs
+import NetJobsAgent
+
+class FrameCodecTest(unittest.TestCase):
+    "frames survive packing and unpacking, whole or in pieces"
+
+    def test_round_trip(self):
+        buffer = (NetJobs.pack_frame(NetJobs.FRAME_SPEC, '{"name": "x"}')
+                  + NetJobs.pack_frame(NetJobs.FRAME_PING)
+                  + NetJobs.pack_frame(NetJobs.FRAME_CHUNK, b'\x00\xff'))
+        frames, remainder = NetJobs.unpack_frames(buffer)
+        self.assertEqual(frames, [(NetJobs.FRAME_SPEC, b'{"name": "x"}'),
+                                  (NetJobs.FRAME_PING, b''),
+                                  (NetJobs.FRAME_CHUNK, b'\x00\xff')])
+        self.assertEqual(remainder, b'')
+
+    def test_partial_frame(self):
+        frame = NetJobs.pack_frame(NetJobs.FRAME_RESULT, b'payload')
+        for split in range(len(frame)):
+            with self.subTest(split=split):
+                frames, remainder = NetJobs.unpack_frames(frame[:split])
+                self.assertEqual(frames, [])
+                self.assertEqual(remainder, frame[:split])
+                frames, remainder = NetJobs.unpack_frames(remainder + frame[split:])
+                self.assertEqual(frames, [(NetJobs.FRAME_RESULT, b'payload')])
+                self.assertEqual(remainder, b'')
+
+    def test_other_protocol_version(self):
+        header = struct.pack(NetJobs.FRAME_HEADER, NetJobs.FRAME_MAGIC,
+                             NetJobs.PROTOCOL_VERSION - 1, NetJobs.FRAME_STATUS, 0)
+        with self.assertRaises(NetJobs.ProtocolError):
+            NetJobs.unpack_frames(header)
+        with self.assertRaises(NetJobs.ProtocolError):
+            NetJobs.unpack_frames(b'HTTP/1.1 200 OK\r\n')
+
+    def test_agent_interoperates(self):
+        self.assertEqual(NetJobsAgent.PROTOCOL_VERSION, NetJobs.PROTOCOL_VERSION)
+        self.assertEqual(NetJobsAgent.FRAME_HEADER, NetJobs.FRAME_HEADER)
+        left, right = socket.socketpair()
+        with left, right:
+            NetJobsAgent.send_frame(left, NetJobsAgent.FRAME_DONE, 'done')
+            left.sendall(NetJobs.pack_frame(NetJobs.FRAME_BYE))
+            received = b''
+            while len(received) < 2 * NetJobs.FRAME_HEADER_SIZE + 4:
+                received += right.recv(NetJobs.BUFFER_SIZE)
+            frames, remainder = NetJobs.unpack_frames(received)
+            self.assertEqual(frames, [(NetJobs.FRAME_DONE, b'done'), (NetJobs.FRAME_BYE, b'')])
+            kind, payload, remainder = NetJobsAgent.recv_frame(None, received)
+            self.assertEqual((kind, payload), (NetJobsAgent.FRAME_DONE, b'done'))
+            self.assertEqual(remainder, NetJobs.pack_frame(NetJobs.FRAME_BYE))
+
+class ClockOffsetTest(unittest.TestCase):
+    "the clock offset estimate ignores how long the agent holds the spec"
+
+    DIGEST = 'ab' * 32
+
+    def test_check_ack(self):
+        payload = bytes('%s 105.010000 107.010000' % self.DIGEST, 'UTF-8')
+        self.assertEqual(NetJobs.check_ack('t', NetJobs.FRAME_ACK, payload, self.DIGEST),
+                         (105.01, 107.01))
+
+    def test_check_ack_rejects(self):
+        for kind, payload in ((NetJobs.FRAME_NACK, b'no'),
+                              (NetJobs.FRAME_ACK, bytes(self.DIGEST, 'UTF-8')),
+                              (NetJobs.FRAME_ACK, bytes('cd' * 32 + ' 1 2', 'UTF-8')),
+                              (NetJobs.FRAME_ACK, bytes(self.DIGEST + ' 1 x', 'UTF-8'))):
+            with self.subTest(payload=payload):
+                with self.assertRaises(NetJobs.PrepError):
+                    NetJobs.check_ack('t', kind, payload, self.DIGEST)
+
+    def test_ack_sample(self):
+        # The agent's clock is 5s ahead, each way takes 10ms, and the agent
+        # queues the spec for 2s before acknowledging it.
+        offset, rtt = NetJobs.estimate_clock_offset('t', [], (100.0, (105.01, 107.01), 102.02))
+        self.assertAlmostEqual(offset, 5.0)
+        self.assertAlmostEqual(rtt, 0.02)
+
+    def test_lowest_latency_sample_wins(self):
+        samples = [(200.0, NetJobs.FRAME_SYNC, b'205.004', 200.010),
+                   (201.0, NetJobs.FRAME_SYNC, b'206.001', 201.002)]
+        offset, rtt = NetJobs.estimate_clock_offset('t', samples,
+                                                    (100.0, (105.01, 107.01), 102.02))
+        self.assertAlmostEqual(offset, 5.0)
+        self.assertAlmostEqual(rtt, 0.002)
+
+    def test_bad_sample(self):
+        for kind, payload in ((NetJobs.FRAME_SYNC, b'noon'), (NetJobs.FRAME_PONG, b'1.0')):
+            with self.subTest(payload=payload):
+                with self.assertRaises(NetJobs.PrepError):
+                    NetJobs.estimate_clock_offset('t', [(1.0, kind, payload, 1.1)],
+                                                  (1.0, (1.0, 1.0), 1.1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# ############################################################################ #
+# Scheduler tests: which tests --parallel starts when, given their -after      #
+# dependencies, their targets, -exclusive, and the parallel limit.             #
+#                                                                              #
+# See the file LICENSE for copying permission.                                 #
+#                                                                              #
+# Usage: $ python3 -m unittest discover tests                                  #
+# ############################################################################ #
+
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NetJobs
+
+#
+# Test with one command per target.
+#
+def make_test(label, targets, after=(), exclusive=False):
+    specs = {target: ['true'] for target in targets}
+    timeouts = {target: {'true': NetJobs.TIMEOUT_NONE} for target in targets}
+    return NetJobs.TestConfig(label, NetJobs.TIMEOUT_NONE, 0, specs, timeouts,
+                              after=after, exclusive=exclusive)
+
+def labels(tests):
+    return [test.label for test in tests]
+
+class TestSchedulerTest(unittest.TestCase):
+    "tests start as their dependencies, targets and the limit allow"
+
+    def test_dependencies(self):
+        a = make_test('a', ['h1'])
+        b = make_test('b', ['h2'], after=('a',))
+        c = make_test('c', ['h3'], after=('a', 'b'))
+        d = make_test('d', ['h4'])
+        scheduler = NetJobs.TestScheduler([a, b, c, d], NetJobs.PARALLEL_UNLIMITED)
+        self.assertEqual(labels(scheduler.ready()), ['a', 'd'])
+        self.assertEqual(scheduler.ready(), [])
+        scheduler.finish(a)
+        self.assertEqual(labels(scheduler.ready()), ['b'])
+        scheduler.finish(d)
+        scheduler.finish(b)
+        self.assertEqual(labels(scheduler.ready()), ['c'])
+        scheduler.finish(c)
+        self.assertTrue(scheduler.done())
+
+    def test_repeated_label(self):
+        # -after waits for every earlier test of that label.
+        first = make_test('a', ['h1'])
+        second = make_test('a', ['h2'])
+        b = make_test('b', ['h3'], after=('a',))
+        scheduler = NetJobs.TestScheduler([first, second, b], NetJobs.PARALLEL_UNLIMITED)
+        self.assertEqual(scheduler.ready(), [first, second])
+        scheduler.finish(first)
+        self.assertEqual(scheduler.ready(), [])
+        scheduler.finish(second)
+        self.assertEqual(scheduler.ready(), [b])
+
+    def test_shared_targets(self):
+        a = make_test('a', ['h1', 'h2'])
+        b = make_test('b', ['h2'])
+        c = make_test('c', ['h3'])
+        scheduler = NetJobs.TestScheduler([a, b, c], NetJobs.PARALLEL_UNLIMITED)
+        self.assertEqual(labels(scheduler.ready()), ['a', 'c'])
+        scheduler.finish(a)
+        self.assertEqual(labels(scheduler.ready()), ['b'])
+
+    def test_exclusive(self):
+        a = make_test('a', ['h1'])
+        b = make_test('b', ['h2'], exclusive=True)
+        c = make_test('c', ['h3'])
+        scheduler = NetJobs.TestScheduler([a, b, c], NetJobs.PARALLEL_UNLIMITED)
+        self.assertEqual(labels(scheduler.ready()), ['a', 'c'])
+        scheduler.finish(a)
+        self.assertEqual(scheduler.ready(), [])
+        scheduler.finish(c)
+        self.assertEqual(labels(scheduler.ready()), ['b'])
+        self.assertEqual(scheduler.ready(), [])
+
+    def test_limit(self):
+        tests = [make_test(label, [label]) for label in 'abc']
+        scheduler = NetJobs.TestScheduler(tests, 2)
+        self.assertEqual(labels(scheduler.ready()), ['a', 'b'])
+        scheduler.finish(tests[1])
+        self.assertEqual(labels(scheduler.ready()), ['c'])
+
+    def test_longest_first(self):
+        tests = [make_test(label, [label]) for label in 'abcd']
+        durations = {'a': 1.0, 'b': 30.0, 'd': 5.0}
+        scheduler = NetJobs.TestScheduler(tests, 1, durations)
+        order = []
+        while not scheduler.done():
+            started = scheduler.ready()
+            order += labels(started)
+            for test in started:
+                scheduler.finish(test)
+        # Never run before, so possibly the longest, then longest first.
+        self.assertEqual(order, ['c', 'b', 'd', 'a'])
+
+if __name__ == '__main__':
+    unittest.main()